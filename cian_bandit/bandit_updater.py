@@ -1,32 +1,79 @@
 import json
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from cian_bandit.bandits import SimpleBandit, UCBBandit
 from cian_bandit.bandits import ZeroConversion
+from cian_bandit.engine import BanditEngine
+from cian_bandit.engine import MultipleBanditsPerPageType
+from cian_bandit import instrumentation
 from cian_bandit.metrics import ClickThroughRate
 from cian_bandit.models import Model
+from cian_bandit.rewards import CompositeReward
 import logging
+import numpy as np
 
 logging.basicConfig(format='%(levelname)s:%(message)s', level=logging.INFO)
 
 info_logger = logging.getLogger('info_logger')
 info_logger.setLevel(logging.INFO)
 
-class MultipleBanditsPerPageType(Exception):
-    pass
+
+# models config sections which are not page_types
+CONFIG_SERVICE_KEYS = ('rewards', 'segments')
+# config doc rebuilds on conflicts with other jobs (WeightStorage default)
+PUBLISH_RETRIES = 5
+
+
+def config_page_types(config):
+    """
+    page_types of models config: keys with model versions dicts
+    (skips `config_version`, `updated`, `rewards`, `segments`, ...)
+    """
+    return [
+        key for key, value in config.items()
+        if isinstance(value, dict) and key not in CONFIG_SERVICE_KEYS
+    ]
+
+
+def arms_history_stats(engine, arms):
+    """
+    :return: dict model_version -> raw clicks, shows, events_cnt of arms
+        (history fields for WeightStorage.publish_bulk)
+    """
+    clicks, shows, events_cnt = engine.arm_stats(arms)
+    return {
+        model_version: {'clicks': c, 'shows': s, 'events_cnt': e}
+        for model_version, c, s, e in zip(
+            engine.model_versions[arms], clicks.tolist(), shows.tolist(), events_cnt.tolist()
+        )
+    }
 
 
 class BanditUpdater:
-    def __init__(self, weights_storage, batch, really_update_es):
+    def __init__(self, weights_storage, batch, really_update_es, page_types=None,
+                 profile_path=None, bulk=False):
+        """
+        :param page_types: list of page_types to update, all page_types of config by default
+        :param profile_path: update_bandits runs under cProfile, pstats are dumped there
+            (page_types updated in worker threads are not profiled)
+        :param bulk: publish all page_types as one config version plus per-arm
+            history records in one bulk request instead of a write per page_type
+        """
         self.weights_storage = weights_storage
         self.batch = batch
         self.really_update_es = really_update_es
         self.bandits = None
-        self.page_types = [
-            'mobile',
-            'desktop',
-        ]
+        self.engine = None
+        self.page_types = page_types
+        self.profile_path = profile_path
+        self.bulk = bulk
 
     def init_bandits(self, config):
         self.bandits = []
+        # all page_types share one array-backed engine
+        self.engine = BanditEngine()
+        if self.page_types is None:
+            self.page_types = config_page_types(config)
 
         for page_type in self.page_types:
             model_versions = config[page_type]
@@ -45,24 +92,274 @@ class BanditUpdater:
             bandit = UCBBandit(
                 page_type=page_type,
                 models=models,
-                min_weight=0.05
+                min_weight=0.05,
+                engine=self.engine,
+                # CTR unless rewards of page_type are set in config
+                reward=CompositeReward.from_config(config, page_type),
             )
             self.bandits.append(bandit)
 
-    def update_bandits(self, config):
-        for bandit in self.bandits:
-            try:
+    def set_batch(self, batch):
+        """
+        Next batch for bandits of init_bandits: engine and models are reused,
+        statistics of the previous batch are dropped
+        """
+        self.batch = batch
+        self.engine.reset_totals()
+
+    def publish(self, bandit, config, max_retries=PUBLISH_RETRIES):
+        if self.really_update_es and not self.bulk:
+            pt_config = config[bandit.page_type]
+            self.weights_storage.update_page_type_models_weights(
+                page_type=bandit.page_type,
+                models=bandit.models,
+                page_type_config=pt_config,
+                max_retries=max_retries,
+            )
+
+    def _update_bandit(self, bandit, config, max_retries=PUBLISH_RETRIES):
+        """
+        :param max_retries: config doc rebuilds, see publish
+        :return: (weights, exception), exception is None if update succeeded
+        """
+        try:
+            with instrumentation.span('evaluate'):
                 bandit.evaluate_batch(self.batch)
+            with instrumentation.span('recompute'):
                 bandit.recalc_models_weights()
-                if self.really_update_es:
-                    pt_config = config[bandit.page_type]
-                    self.weights_storage.update_page_type_models_weights(
-                        page_type=bandit.page_type,
-                        models=bandit.models,
-                        page_type_config=pt_config,
-                    )
+            instrumentation.incr('arms_updated', len(bandit.models))
+            # es_read and es_write are timed by weights_storage around actual requests
+            self.publish(bandit, config, max_retries)
+            return bandit.get_models_weights(), None
+        except ZeroConversion as e:
+            instrumentation.incr('zero_conversion')
+            return None, e
+        except Exception as e:
+            return None, e
+
+    def update_bandits(self, config, max_workers=1):
+        """
+        :param max_workers: > 1 updates page_types concurrently in a thread pool
+        :return: dict page_type -> new weights (None if not updated),
+            in self.bandits order whatever order updates finished in
+        ZeroConversion of a page_type is logged, any other error is raised
+        after all page_types are processed
+        """
+        if self.profile_path is not None:
+            return instrumentation.run_profiled(
+                self.profile_path, self._update_bandits, config, max_workers
+            )
+        return self._update_bandits(config, max_workers)
+
+    def _update_bandits(self, config, max_workers):
+        if max_workers > 1 and len(self.bandits) > 1:
+            # every page_type writes its own config version: each one may lose
+            # the compare-and-set to all the others before it gets through
+            max_retries = PUBLISH_RETRIES + len(self.bandits)
+            with ThreadPoolExecutor(max_workers=max_workers) as pool:
+                futures = [
+                    pool.submit(self._update_bandit, bandit, config, max_retries)
+                    for bandit in self.bandits
+                ]
+                outcomes = [future.result() for future in futures]
+        else:
+            outcomes = [self._update_bandit(bandit, config) for bandit in self.bandits]
+
+        results = OrderedDict()
+        error = None
+        for bandit, (weights, exc) in zip(self.bandits, outcomes):
+            results[bandit.page_type] = weights
+            if exc is None:
                 info_logger.info(bandit.page_type)
-                info_logger.info(bandit.get_models_weights())
-            except ZeroConversion as zc:
+                info_logger.info(weights)
+            elif isinstance(exc, ZeroConversion):
                 logging.warning(bandit.page_type)
-                logging.warning(zc)
+                logging.warning(exc)
+            else:
+                logging.error('%s: %r', bandit.page_type, exc)
+                if error is None:
+                    error = exc
+        if self.bulk and self.really_update_es:
+            self.publish_bulk(config, results)
+        if error is not None:
+            raise error
+        return results
+
+    def publish_bulk(self, config, results):
+        """
+        :param results: page_type -> new weights, None if not updated
+        """
+        segments = {}
+        stats = {}
+        for bandit in self.bandits:
+            weights = results[bandit.page_type]
+            # still cant update mobile!
+            if weights is None or bandit.page_type != 'desktop':
+                continue
+            segments[bandit.page_type] = (
+                config[bandit.page_type],
+                weights,
+                {mv: model.metric.value for mv, model in bandit.models.items()},
+            )
+            stats[bandit.page_type] = arms_history_stats(self.engine, bandit.arms)
+        return self.weights_storage.publish_bulk(segments, stats=stats)
+
+
+class SegmentedBanditUpdater(object):
+    """
+    Отдельный бандит на каждый сегмент: page_type x segment_columns
+    (регион, источник трафика, ...), сегменты берутся из данных,
+    model versions сегмента - из конфига его page_type
+    Сегмент - не граф объектов Model/ClickThroughRate, а отрезок общего BanditEngine:
+    batch проходится один раз, веса всех сегментов считаются одним векторным
+    пересчётом, все сегменты пишутся в es одним bulk: документ на сегмент
+    и новая версия конфига со ссылкой на них
+    Ключ сегмента: page_type и значения segment_columns через separator
+    Награды page_type из "rewards" конфига считаются по каждому сегменту,
+    как в BanditUpdater (см. CompositeReward)
+    """
+    def __init__(self, weights_storage, batch, really_update_es, segment_columns=(),
+                 min_weight=0.05, smooth=1000, ucb=True, separator=':'):
+        """
+        :param segment_columns: batch columns of segments, in models config
+            they are "segments": {"columns": [...]}
+        """
+        self.weights_storage = weights_storage
+        self.batch = batch
+        self.really_update_es = really_update_es
+        self.segment_columns = list(segment_columns)
+        self.min_weight = min_weight
+        self.smooth = smooth
+        self.ucb = ucb
+        self.separator = separator
+        self.engine = None
+        # segment key -> page_type
+        self.segments = None
+        # page_types of config with model versions
+        self.page_types = None
+        # page_type -> CompositeReward, page_types without rewards optimize CTR
+        self.rewards = None
+
+    def segment_keys(self, batch):
+        keys = batch['page_type'].astype(str)
+        for column in self.segment_columns:
+            keys = keys + self.separator + batch[column].astype(str)
+        return keys.values
+
+    def batch_segments(self, batch):
+        """
+        :return: OrderedDict segment key -> page_type of batch rows
+            (page_types without model versions in config are skipped)
+        """
+        keys = self.segment_keys(batch)
+        unique_keys, first_rows = np.unique(keys, return_index=True)
+        row_page_types = batch['page_type'].values
+
+        segments = OrderedDict()
+        for key, row in zip(unique_keys, first_rows):
+            page_type = row_page_types[row]
+            if page_type in self.page_types:
+                segments[key] = page_type
+        return segments
+
+    def init_bandits(self, config):
+        self.page_types = set(page_type for page_type in config_page_types(config) if config[page_type])
+        self.segments = self.batch_segments(self.batch)
+        self.rewards = OrderedDict()
+        for page_type in sorted(self.page_types):
+            reward = CompositeReward.from_config(config, page_type)
+            if reward is not None:
+                self.rewards[page_type] = reward
+
+        self.engine = BanditEngine()
+        self.engine.add_page_types(
+            [(key, list(config[page_type])) for key, page_type in self.segments.items()],
+            smooth=self.smooth,
+        )
+
+    def set_batch(self, batch):
+        """
+        Next batch for segments of init_bandits, see BanditUpdater.set_batch
+        :return: False if segments of batch differ from init_bandits ones (call it again):
+            a segment without rows must not be published, as a fresh run would not
+        """
+        self.batch = batch
+        self.engine.reset_totals()
+        return list(self.batch_segments(batch)) == list(self.segments)
+
+    def _reward_clicks(self, batch, keys):
+        """
+        clicks fed to the engine: rows of page_types with rewards get
+        per-arm objective of their segment times shows, as in SimpleBandit
+        :raise MissingRewardColumn: batch lacks a column of the rewards
+        """
+        clicks = batch['clicks'].values.astype(float)
+        if not self.rewards:
+            return clicks
+        shows = batch['shows'].values.astype(float)
+        idx = self.engine.rows_arm_index(keys, batch['model_version'].values)
+        page_types = batch['page_type'].values
+        for page_type, reward in self.rewards.items():
+            reward.check_columns(batch.columns)
+            rows = np.flatnonzero((page_types == page_type) & (idx >= 0))
+            _, objective = reward.evaluate(
+                idx[rows],
+                {column: batch[column].values[rows] for column in reward.columns},
+                len(self.engine),
+            )
+            clicks[rows] = objective[idx[rows]] * shows[rows]
+        return clicks
+
+    def update_bandits(self, config):
+        """
+        :return: dict segment key -> new weights, segments with zero conversions are skipped
+        """
+        engine = self.engine
+        batch = self.batch
+        with instrumentation.span('evaluate'):
+            keys = self.segment_keys(batch)
+            engine.add_rows(
+                page_types=keys,
+                model_versions=batch['model_version'].values,
+                clicks=self._reward_clicks(batch, keys),
+                shows=batch['shows'].values,
+            )
+
+        with instrumentation.span('recompute'):
+            values = engine.conversions()
+            skipped = [
+                key for key in engine.zero_conversion_page_types(values)
+                if self.segments[key] != 'desktop'
+            ]
+            if skipped:
+                logging.warning('no info about conversions: %s', skipped)
+                instrumentation.incr('zero_conversion', len(skipped))
+            if self.ucb:
+                values = values + engine.ucb_bonus()
+            arms = np.flatnonzero(~np.isin(engine.segment, engine.segment_ids(skipped)))
+            engine.set_weights(values[arms], self.min_weight, arms=arms)
+            instrumentation.incr('arms_updated', len(arms))
+
+        results = OrderedDict()
+        publish = {}
+        weights = engine.weights.tolist()
+        conversions = engine.conversions().tolist()
+        skipped = set(skipped)
+        for key, page_type in self.segments.items():
+            if key in skipped:
+                continue
+            arms = engine.arms(key)
+            model_versions = engine.model_versions[arms]
+            results[key] = dict(zip(model_versions, weights[arms]))
+            publish[key] = (
+                config[page_type],
+                results[key],
+                dict(zip(model_versions, conversions[arms])),
+            )
+        info_logger.info('updated %d segments, skipped %d', len(results), len(skipped))
+
+        if self.really_update_es and publish:
+            # segments are docs of their own index, see WeightStorage
+            stats = {key: arms_history_stats(engine, engine.arms(key)) for key in publish}
+            self.weights_storage.publish_bulk(publish, stats=stats, segment_docs=True)
+        return results
@@ -1,8 +1,14 @@
+import abc
+import logging
+import os
 import numpy as np
-import pandas as pd
 
 
-from cian_bandit.weights_storage import WeightStorage, handle_null_conversion
+from cian_bandit.engine import BanditEngine
+from cian_bandit.rewards import MissingRewardColumn
+from cian_bandit.ring_buffer import ArmsRingBuffer
+
+info_logger = logging.getLogger('info_logger')
 
 
 class WrongModelException(Exception):
@@ -13,16 +19,98 @@ class ZeroConversion(Exception):
     pass
 
 
+def _optional_column(columns, name):
+    try:
+        return columns[name]
+    except (KeyError, ValueError):
+        return None
+
+
+def save_arms_state(path, model_versions, step, arrays):
+    """
+    State of a bandit with memory as .npz: arrays plus model_versions and step
+    Write and rename: a crash never leaves half-written state
+    """
+    arrays = dict(arrays)
+    arrays['model_versions'] = np.array(list(model_versions), dtype=str)
+    arrays['step'] = np.array(step)
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        np.savez(f, **arrays)
+    os.replace(tmp_path, path)
+
+
+def load_arms_state(path, model_versions, name):
+    """
+    :param name: bandit name for the log
+    :return: dict of arrays saved by save_arms_state,
+        None if the state is of other model versions
+    """
+    with np.load(path) as saved:
+        arrays = {key: saved[key] for key in saved.files}
+    saved_versions = arrays['model_versions'].tolist()
+    if saved_versions != list(model_versions):
+        info_logger.warning(
+            'model versions changed %s -> %s, %s state is reset',
+            saved_versions,
+            list(model_versions),
+            name,
+        )
+        return None
+    return arrays
+
+
+# sopr_shows fields of a single show record for batch columns
+_RECORD_FIELDS = {'clicks': 'clicked_cnt', 'phones': 'phoned_cnt'}
+
+
+def _records_columns(records, page_type, columns):
+    """
+    Records of page_type as batch columns: model_version and given columns,
+    single shows (records without `shows`) count as shows = 1,
+    their clicked_cnt and phoned_cnt as clicks and phones
+    :raise MissingRewardColumn: a record has no value of a column
+    """
+    columns = [column for i, column in enumerate(columns) if column not in columns[:i]]
+    result = {column: [] for column in ['model_version'] + columns}
+    for record in records:
+        if record.get('page_type', page_type) != page_type:
+            continue
+        result['model_version'].append(record['model_version'])
+        single_show = 'shows' not in record
+        for column in columns:
+            if column in record:
+                value = record[column]
+            elif single_show and column == 'shows':
+                value = 1
+            elif single_show and column in _RECORD_FIELDS:
+                value = record.get(_RECORD_FIELDS[column])
+            elif column == 'clicks':
+                value = 0
+            else:
+                raise MissingRewardColumn('record has no {0}: {1}'.format(column, record))
+            result[column].append(value or 0)
+    return result
+
+
 class SimpleBandit(object):
     """
     На каждый page_type свой бандит
     В этой простейшей версии трафик распределяется пропорционально конверсиям
     Каждой модели отдаётся как минимум min_weight трафика
     j(t) = argmax (\mu_i)
+    Состояние ручек хранится в BanditEngine (общем для всех page_type,
+    если передан), бандит - view над своим slice
     """
-    def __init__(self, page_type, models, min_weight):
+    def __init__(self, page_type, models, min_weight, engine=None, reward=None):
+        """
+        :param reward: CompositeReward, metric to optimize instead of CTR
+        """
         self.page_type = page_type
         self.min_weight = min_weight
+        self.reward = reward
+        # reward name -> per-arm values of the last batch (with reward only)
+        self.rewards = None
         self.models = {}
         for model in models:
             if model.page_type != self.page_type:
@@ -33,69 +121,192 @@ class SimpleBandit(object):
                     )
                 )
             self.models[model.model_version] = model
-       
+
+        if engine is None:
+            engine = BanditEngine()
+        self.engine = engine
+        self.arms = engine.add_page_type(
+            page_type=page_type,
+            model_versions=list(self.models),
+            smooth=[model.metric.smooth for model in self.models.values()],
+        )
+
     def get_models_weights(self):
         weights = {}
         for model_version, model in self.models.items():
             weights[model_version] = model.weight
         return weights
-            
+
+    def _sync_models(self):
+        """
+        Copy arms state from engine arrays to Model and metric objects,
+        WeightStorage reads model.weight and model.metric.value
+        """
+        engine = self.engine
+        arms = self.arms
+        conversions = engine.conversions(arms)
+        rows = zip(
+            self.models.values(),
+            engine.weights[arms].tolist(),
+            engine.clicks[arms].tolist(),
+            engine.shows[arms].tolist(),
+            engine.events_cnt[arms].tolist(),
+            conversions.tolist(),
+        )
+        for model, weight, clicks, shows, events_cnt, conversion in rows:
+            if not np.isnan(weight):
+                model.weight = weight
+            if not np.isnan(shows):
+                model.metric.clicks = clicks
+                model.metric.shows = shows
+                model.metric.events_cnt = events_cnt
+                model.metric.value = conversion
+            elif model.metric.shows is not None:
+                # arm was forgotten (left the window of a non-stationary bandit)
+                model.metric.clicks = None
+                model.metric.shows = None
+                model.metric.events_cnt = None
+                model.metric.value = None
+
     def evaluate_batch(self, batch_data):
         """
         :param batch_data: pd.DataFrame
             aggtegated from pio_recs.sopr_shows
             grouped by page_type, model_version
-            columns: page_type, model_version, clicked_cnt, phoned_cnt
-        """
-        batch_data = batch_data[batch_data['page_type'] == self.page_type]
-        events_cnt = batch_data['shows'].sum()
-        batch_dict = batch_data.to_dict(orient='records')
-        batch_metrics = {}
-
-        for d in batch_dict:
-            batch_metrics[(d['page_type'], d['model_version'])] = d
-
-        for model_version, model_batch in batch_data.groupby('model_version'):
-            if model_version in self.models:
-                this_batch_dict = batch_metrics[(self.page_type, model_version)]
-                self.models[model_version].metric.add_batch(this_batch_dict, events_cnt)
-
-    def _handle_null_weight(self, w):
-        if w is None or pd.isnull(w):
-            w = self.min_weight
-        return w
-
-    def _normalize_weights(self, metric_values):
-        norm = sum(metric_values.values())
-        if norm == 0:
-            norm = 10e-6
-        for model_version, model in self.models.items():
-            metric_value = metric_values[model_version]
-            model.weight = metric_value / norm
-            model.weight = self._handle_null_weight(model.weight)
+            columns: page_type, model_version, clicks, shows
+        """
+        self.evaluate_columns(batch_data)
+
+    def evaluate_columns(self, columns):
+        """
+        Batch of any granularity (aggregates per model, segment or single events)
+        in one pass: rows of the same model_version are summed
+        :param columns: equal length columns by name: dict of arrays,
+            numpy structured array or pd.DataFrame
+            required: `model_version`, `clicks`, `shows`
+            optional: `page_type` (rows of other page_types are skipped)
+        """
+        mask = self._page_type_mask(columns)
+        model_versions, clicks, shows = self._page_type_rows(columns, mask)
+        if self.reward is not None:
+            clicks = self._reward_clicks(columns, mask, model_versions, shows)
+        self.engine.add_rows(self.page_type, model_versions, clicks, shows)
+        self._sync_models()
+
+    def _page_type_mask(self, columns):
+        """
+        :return: bool array of rows of this page_type, None if there is no page_type column
+        """
+        page_types = _optional_column(columns, 'page_type')
+        if page_types is None:
+            return None
+        return np.asarray(page_types) == self.page_type
+
+    def _page_type_rows(self, columns, mask=None):
+        """
+        :return: model_version, clicks, shows arrays of rows of this page_type
+        """
+        model_versions = np.asarray(columns['model_version'])
+        clicks = np.asarray(columns['clicks'])
+        shows = np.asarray(columns['shows'])
+        if mask is None:
+            mask = self._page_type_mask(columns)
+        if mask is not None:
+            model_versions, clicks, shows = model_versions[mask], clicks[mask], shows[mask]
+        return model_versions, clicks, shows
+
+    def _reward_clicks(self, columns, mask, model_versions, shows):
+        """
+        Objective of self.reward as clicks: per-arm objective times shows of every row,
+        so engine conversion (clicks / shows) of arm is its objective
+        :raise MissingRewardColumn: columns lack a column of the reward
+        """
+        shows = np.asarray(shows, dtype=float)
+        idx = self.engine.arm_index(self.page_type, model_versions)
+        known = idx >= 0
+        arms = idx[known] - self.arms.start
+        reward_columns = {}
+        for column in self.reward.columns:
+            values = _optional_column(columns, column)
+            if values is None:
+                raise MissingRewardColumn('batch has no {0} column for rewards {1}'.format(
+                    column, list(self.reward.weights)
+                ))
+            values = np.asarray(values)
+            if mask is not None:
+                values = values[mask]
+            reward_columns[column] = values[known]
+        self.rewards, objective = self.reward.evaluate(arms, reward_columns, len(self.models))
+
+        clicks = np.zeros(len(shows))
+        clicks[known] = objective[arms] * shows[known]
+        return clicks
+
+    def evaluate_records(self, records):
+        """
+        :param records: iterator of dicts with `page_type`, `model_version`
+            and `clicks`, `shows` (aggregates) or `clicked_cnt` (single shows);
+            with reward - also its columns
+        """
+        if self.reward is not None:
+            columns = ['clicks', 'shows'] + self.reward.columns
+            self.evaluate_columns(_records_columns(records, self.page_type, columns))
+            return
+        self.engine.add_records(records, page_type=self.page_type)
+        self._sync_models()
+
+    def _increment_clicks(self, model_versions, clicks, shows, columns):
+        """
+        clicks of add_increment: objective of the increment times shows with reward
+        """
+        if self.reward is None:
+            return clicks
+        increment = {'model_version': model_versions, 'clicks': clicks, 'shows': shows}
+        increment.update(columns or {})
+        return self._reward_clicks(increment, None, model_versions, shows)
+
+    def add_increment(self, model_versions, clicks, shows, columns=None):
+        """
+        Streaming update: accumulate new clicks and shows of this page_type
+        :param model_versions: list of model_version
+        :param clicks: array-like, new clicks per model_version
+        :param shows: array-like, new shows per model_version
+        :param columns: dict column -> array-like per model_version,
+            other columns of the reward (phones, users, ...)
+        """
+        clicks = self._increment_clicks(model_versions, clicks, shows, columns)
+        self.engine.add_increment(
+            page_type=self.page_type,
+            model_versions=model_versions,
+            clicks=clicks,
+            shows=shows,
+        )
+        self._sync_models()
+
+    def _bonus(self):
+        return 0.0
+
+    def _weight_values(self, conversions):
+        """
+        Values to be normalized into weights
+        """
+        return conversions + self._bonus()
 
     def recalc_models_weights(self):
-        metric_values = {
-            model_version: handle_null_conversion(model.metric.value)
-            for model_version, model in self.models.items()
-        }
-        mv = list(metric_values.values())
-        print('previous weights ' + self.page_type, ':', mv)
-        if None in mv or np.allclose(mv, 0.0):
-            print("All conversions are zero")
+        conversions = self.engine.conversions(self.arms)
+        info_logger.debug('previous weights %s: %s', self.page_type, conversions)
+        if np.allclose(conversions, 0.0):
+            info_logger.debug('All conversions are zero')
             if self.page_type != 'desktop':
                 raise ZeroConversion('no info about conversions!')
 
-        self._normalize_weights(metric_values)
-        metric_values = {}
-        for model_version, model in self.models.items():
-            corrected_weight = model.weight
-            corrected_weight = max(self.min_weight, corrected_weight)
-            metric_values[model_version] = corrected_weight
-
-        self._normalize_weights(metric_values)
-        mv = list(metric_values.values())
-        print('new weights ' + self.page_type, ':', mv)
+        weights = self.engine.set_weights(
+            values=self._weight_values(conversions),
+            min_weight=self.min_weight,
+            arms=self.arms,
+        )
+        self._sync_models()
+        info_logger.debug('new weights %s: %s', self.page_type, weights)
 
 
 class UCBBandit(SimpleBandit):
@@ -107,45 +318,209 @@ class UCBBandit(SimpleBandit):
     for more info: https://www.cs.mcgill.ca/~vkules/bandits.pdf
     """
 
-    def _ucb(self, batch_size, num_chosen):
-        if batch_size == 0 or pd.isnull(batch_size):
-            return 0.0
-        return 2 * np.log(batch_size) / max([1, num_chosen])
+    def _bonus(self):
+        return self.engine.ucb_bonus(self.arms)
 
-    def recalc_models_weights(self):
-        metric_values = {
-            model_version: handle_null_conversion(model.metric.value)
-            for model_version, model in self.models.items()
+
+class _NonStationaryUCBBandit(UCBBandit, metaclass=abc.ABCMeta):
+    """
+    UCB over counters kept by the bandit itself instead of a window of last
+    events: every batch holds only new events (since the previous run),
+    counters forget old ones, engine gets their current totals
+    Counters are saved to state_path (.npz) after every batch
+    Subclasses define how counters forget: the abstract methods below
+    """
+    def __init__(self, page_type, models, min_weight, engine=None, state_path=None, reward=None):
+        UCBBandit.__init__(self, page_type, models, min_weight, engine=engine, reward=reward)
+        self.state_path = state_path
+        self.step = 0
+        self._reset_counters()
+        if state_path is not None and os.path.exists(state_path):
+            self.load_state(state_path)
+
+    @abc.abstractmethod
+    def _reset_counters(self):
+        pass
+
+    @abc.abstractmethod
+    def _update_counters(self, clicks, shows, events_cnt):
+        """
+        :param clicks, shows: new clicks and shows per arm
+        :param events_cnt: new events of page_type
+        """
+
+    @abc.abstractmethod
+    def _totals(self):
+        """
+        :return: current clicks, shows per arm and events_cnt
+        """
+
+    @abc.abstractmethod
+    def _counters_arrays(self):
+        """
+        :return: dict name -> np.array of counters for save_state
+        """
+
+    @abc.abstractmethod
+    def _load_counters(self, arrays):
+        pass
+
+    def _add_rows(self, model_versions, clicks, shows):
+        clicks = np.asarray(clicks, dtype=float)
+        shows = np.asarray(shows, dtype=float)
+        n_arms = len(self.models)
+        idx = self.engine.arm_index(self.page_type, model_versions)
+        known = idx >= 0
+        # position of arm in this bandit's slice
+        idx = idx[known] - self.arms.start
+        batch_clicks = np.bincount(idx, weights=clicks[known], minlength=n_arms)
+        batch_shows = np.bincount(idx, weights=shows[known], minlength=n_arms)
+
+        self._update_counters(batch_clicks, batch_shows, shows.sum())
+        self.step += 1
+        self.engine.set_arm_totals(self.arms, *self._totals())
+        self._sync_models()
+        if self.state_path is not None:
+            self.save_state(self.state_path)
+
+    def evaluate_columns(self, columns):
+        mask = self._page_type_mask(columns)
+        model_versions, clicks, shows = self._page_type_rows(columns, mask)
+        if self.reward is not None:
+            clicks = self._reward_clicks(columns, mask, model_versions, shows)
+        self._add_rows(model_versions, clicks, shows)
+
+    def evaluate_records(self, records):
+        columns = ['clicks', 'shows'] + (self.reward.columns if self.reward is not None else [])
+        self.evaluate_columns(_records_columns(records, self.page_type, columns))
+
+    def add_increment(self, model_versions, clicks, shows, columns=None):
+        clicks = self._increment_clicks(model_versions, clicks, shows, columns)
+        self._add_rows(model_versions, clicks, shows)
+
+    def save_state(self, path):
+        save_arms_state(path, self.models, self.step, self._counters_arrays())
+
+    def load_state(self, path):
+        arrays = load_arms_state(path, self.models, type(self).__name__)
+        if arrays is None:
+            return
+        self.step = int(arrays['step'])
+        self._load_counters(arrays)
+        self.engine.set_arm_totals(self.arms, *self._totals())
+        self._sync_models()
+
+
+class DiscountedUCBBandit(_NonStationaryUCBBandit):
+    """
+    Discounted UCB (Garivier, Moulines 2008): клики, показы и число событий
+    умножаются на discount перед прибавлением каждого нового батча,
+    событие k батчей назад весит discount^k
+    Эффективная память ~ 1 / (1 - discount) батчей
+    """
+    def __init__(self, page_type, models, min_weight, engine=None, state_path=None, discount=0.9,
+                 reward=None):
+        self.discount = discount
+        _NonStationaryUCBBandit.__init__(self, page_type, models, min_weight,
+                                         engine=engine, state_path=state_path, reward=reward)
+
+    def _reset_counters(self):
+        n_arms = len(self.models)
+        self.clicks = np.zeros(n_arms)
+        self.shows = np.zeros(n_arms)
+        self.events_cnt = 0.0
+
+    def _update_counters(self, clicks, shows, events_cnt):
+        self.clicks = self.discount * self.clicks + clicks
+        self.shows = self.discount * self.shows + shows
+        self.events_cnt = self.discount * self.events_cnt + events_cnt
+
+    def _totals(self):
+        return self.clicks, self.shows, self.events_cnt
+
+    def _counters_arrays(self):
+        return {
+            'clicks': self.clicks,
+            'shows': self.shows,
+            'events_cnt': np.array(self.events_cnt),
         }
-        mv = list(metric_values.values())
-        print('previous weights ' + self.page_type, ':', mv)
-        if None in mv or np.allclose(mv, 0.0):
-            print("All conversions are zero")
-            if self.page_type != 'desktop':
-                raise ZeroConversion('no info about conversions!')
 
-        for model_version, model in self.models.items():
-            conversion = handle_null_conversion(model.metric.value)
-            ucb = self._ucb(
-                model.metric.events_cnt,
-                model.metric.shows,
-            )
+    def _load_counters(self, arrays):
+        self.clicks = np.array(arrays['clicks'], dtype=float)
+        self.shows = np.array(arrays['shows'], dtype=float)
+        self.events_cnt = float(arrays['events_cnt'])
+
+
+class SlidingWindowUCBBandit(_NonStationaryUCBBandit):
+    """
+    Sliding-Window UCB (Garivier, Moulines 2008): статистика ручек
+    по последним window батчам, кольцевые буферы с инкрементальными суммами
+    """
+    def __init__(self, page_type, models, min_weight, engine=None, state_path=None, window=10,
+                 reward=None):
+        self.window = window
+        _NonStationaryUCBBandit.__init__(self, page_type, models, min_weight,
+                                         engine=engine, state_path=state_path, reward=reward)
 
-            print(model_version, 'ucb =', ucb)
-            ucb_weight = conversion + ucb
+    def _reset_counters(self):
+        n_arms = len(self.models)
+        self.clicks = ArmsRingBuffer(self.window, n_arms)
+        self.shows = ArmsRingBuffer(self.window, n_arms)
+        self.events_cnt = ArmsRingBuffer(self.window, 1)
 
-            metric_values[model_version] = ucb_weight
+    def _update_counters(self, clicks, shows, events_cnt):
+        self.clicks.push(clicks)
+        self.shows.push(shows)
+        self.events_cnt.push([events_cnt])
 
-        self._normalize_weights(metric_values)
-        metric_values = {}
-        for model_version, model in self.models.items():
-            corrected_weight = model.weight
-            corrected_weight = max(self.min_weight, corrected_weight)
-            metric_values[model_version] = corrected_weight
+    def _totals(self):
+        return self.clicks.sum, self.shows.sum, float(self.events_cnt.sum[0])
+
+    def _counters_arrays(self):
+        arrays = {}
+        arrays.update(self.clicks.to_arrays('clicks_'))
+        arrays.update(self.shows.to_arrays('shows_'))
+        arrays.update(self.events_cnt.to_arrays('events_cnt_'))
+        return arrays
+
+    def _load_counters(self, arrays):
+        self.clicks = ArmsRingBuffer.from_arrays(arrays, 'clicks_')
+        self.shows = ArmsRingBuffer.from_arrays(arrays, 'shows_')
+        self.events_cnt = ArmsRingBuffer.from_arrays(arrays, 'events_cnt_')
+
+
+class ThompsonBandit(SimpleBandit):
+    """
+    Beta(1 + clicks, 1 + shows - clicks) posterior of every arm CTR
+    Weight of arm is probability that it is the best one:
+    P(j = argmax theta_i), theta_i ~ Beta(a_i, b_i)
+    Estimated by Monte-Carlo: one (draws x arms) matrix of beta samples,
+    drawn by chunks of at most chunk_size numbers to bound memory
+    """
+    def __init__(self, page_type, models, min_weight, engine=None,
+                 draws=100000, chunk_size=1 << 22, seed=None):
+        SimpleBandit.__init__(self, page_type, models, min_weight, engine=engine)
+        self.draws = draws
+        self.chunk_size = chunk_size
+        self.rng = np.random.default_rng(seed)
 
-        self._normalize_weights(metric_values)
-        mv = list(metric_values.values())
-        print('new weights ' + self.page_type, ':', mv)
+    def _prob_best(self):
+        alpha, beta = self.engine.beta_posteriors(self.arms)
+        n_arms = len(alpha)
+        if n_arms == 0:
+            return np.zeros(0)
+        wins = np.zeros(n_arms)
+        rows = max(1, self.chunk_size // n_arms)
+        done = 0
+        while done < self.draws:
+            size = min(rows, self.draws - done)
+            samples = self.rng.beta(alpha, beta, size=(size, n_arms))
+            wins += np.bincount(samples.argmax(axis=1), minlength=n_arms)
+            done += size
+        return wins / self.draws
+
+    def _weight_values(self, conversions):
+        return self._prob_best()
 
 
 class HeuristicBandit(SimpleBandit):
@@ -153,103 +528,86 @@ class HeuristicBandit(SimpleBandit):
     add memory for last N conversions and decay it's change
     add penalty to winner for too big p-value from ttest (means that it's highly likely that conversions are the same)
     that will make groups distribution more similar
+
+    Память - кольцевые буферы в памяти процесса (ArmsRingBuffer):
+    последние conversion_window конверсий и weights_memory весов без штрафа
+    w_i = softmax(rolling mean конверсий)
+    Лидер по среднему весу в памяти сравнивается парным t-тестом с каждой ручкой,
+    если p-value < critical_pvalue, вес ручки умножается на штраф,
+    который со временем (шаг step) плавно доходит до p-value / critical_pvalue
+    Изменение весов затухает: w = w_prev + change_decay * (w - w_prev)
+    Буферы сохраняются в state_path (.npz) после каждого пересчёта
     """
-    pass
+    def __init__(self, page_type, models, min_weight, engine=None, state_path=None,
+                 conversion_window=20, weights_memory=40, critical_pvalue=0.05,
+                 penalty_ramp_steps=200, change_decay=0.5):
+        SimpleBandit.__init__(self, page_type, models, min_weight, engine=engine)
+        self.state_path = state_path
+        self.conversion_window = conversion_window
+        self.critical_pvalue = critical_pvalue
+        self.penalty_ramp_steps = penalty_ramp_steps
+        self.change_decay = change_decay
+
+        n_arms = len(self.models)
+        self.conversions = ArmsRingBuffer(conversion_window, n_arms)
+        self.true_weights = ArmsRingBuffer(weights_memory, n_arms)
+        self.last_weights = None
+        self.step = 0
+        if state_path is not None and os.path.exists(state_path):
+            self.load_state(state_path)
+
+    def _penalty(self):
+        n_arms = len(self.models)
+        penalty = np.ones(n_arms)
+        if self.step < self.conversion_window or len(self.true_weights) < 2:
+            return penalty
+        leader = int(np.argmax(self.true_weights.mean()))
+        pvalues = self.true_weights.paired_ttest(leader)
+        time_coeff = np.exp((self.step - self.penalty_ramp_steps) / 20.)
+        time_coeff = min(1., max(0., time_coeff))
+        significant = pvalues < self.critical_pvalue
+        penalty[significant] = (
+            (1. - time_coeff) + pvalues[significant] / self.critical_pvalue * time_coeff
+        )
+        return penalty
+
+    def _weight_values(self, conversions):
+        self.conversions.push(conversions)
+        rolling = self.conversions.mean()
+        weights = np.exp(rolling - rolling.max())
+        weights /= weights.sum()
+
+        # memory holds previous steps only
+        penalty = self._penalty()
+        self.true_weights.push(weights)
+        weights = weights * penalty
+        weights /= weights.sum()
+
+        if self.last_weights is not None:
+            weights = self.last_weights + self.change_decay * (weights - self.last_weights)
+        self.last_weights = weights
+        self.step += 1
+        return weights
+
+    def recalc_models_weights(self):
+        SimpleBandit.recalc_models_weights(self)
+        if self.state_path is not None:
+            self.save_state(self.state_path)
+
+    def save_state(self, path):
+        arrays = {}
+        if self.last_weights is not None:
+            arrays['last_weights'] = self.last_weights
+        arrays.update(self.conversions.to_arrays('conversions_'))
+        arrays.update(self.true_weights.to_arrays('true_weights_'))
+        save_arms_state(path, self.models, self.step, arrays)
 
-    # GOVNOKOD FROM JUPYTER:
-    #
-    # CRITICAL_PVALUE = 0.05
-    # WEIGHTS_MEMORY_STEPS = 40
-    #
-    # MAX_TIME_COEFF = np.exp((len(convs_1) * 1. / 3.) / 30.) / 2.
-    # weights_1, weights_2 = [], []
-    # true_ws_1, true_ws_2 = [], []
-    # glide_c1, glide_c2 = [], []
-    # for i in range(1, len(convs_1)):
-    #     try:
-    #         lt_1 = np.mean([convs_1[max(0, i - 20):i]])
-    #         lt_2 = np.mean([convs_2[max(0, i - 20):i]])
-    #     except:
-    #         continue
-    #     glide_c1 += [lt_1]
-    #     glide_c2 += [lt_2]
-    #
-    #     #     w1, w2 = convs_1[i], convs_2[i]
-    #
-    #     #     w1, w2 = lt_1, lt_2
-    #
-    #     w1 = np.exp(lt_1) / np.exp(lt_1 + lt_2)
-    #     w2 = np.exp(lt_2) / np.exp(lt_1 + lt_2)
-    #
-    #     # memory for previous weights
-    #     ltw_1 = [true_ws_1[max(0, i - WEIGHTS_MEMORY_STEPS):i]]
-    #     ltw_2 = [true_ws_2[max(0, i - WEIGHTS_MEMORY_STEPS):i]]
-    #     #     ltw_1 = weights_1[max(0,i-20):i]
-    #     #     ltw_2 = weights_2[max(0,i-20):i]
-    #
-    #     norm = float(w1 + w2)
-    #     true_ws_1 += [w1 / norm]
-    #     true_ws_2 += [w2 / norm]
-    #
-    #     pvalue = 1.
-    #     if i >= 20 and len(ltw_1) >= 1 and np.sum(np.isnan(ltw_1)) == 0:
-    #         #         pass
-    #         #         deltas = ltw_1 - ltw_2
-    #         #         """
-    #         #         This is a two-sided test for the null hypothesis that 2 related or
-    #         #         repeated samples have identical average (expected) values.
-    #         #         """
-    #         #         sts.ttest_rel(ltw_1, ltw_2)
-    #         # if p-value <= alpha -> sets are not equal -> add high penalty for weak group
-    #         #         w1 += ltw_1 * 20.
-    #         #         w2 += ltw_2 * 20.
-    #         _, pvalue = sts.ttest_rel(ltw_1, ltw_2, axis=1)
-    #         print
-    #         pvalue, ' ',
-    #         wg = who_greater(np.mean(ltw_1), np.mean(ltw_2))
-    #         penalty = 1.
-    #
-    #         # add proof by time (i)
-    #         if pvalue < CRITICAL_PVALUE:
-    #             #             print(pvalue)
-    #             #             penalty =
-    #             # min([0.8 + (pvalue/0.05),1])
-    #             # 10 is max coeff at the end
-    #             time_coeff = np.exp(i / 20.) / 2.
-    #             time_coeff = min(1., max(0., time_coeff / MAX_TIME_COEFF))
-    #             penalty = penalty * (1. - time_coeff) \
-    #                       + pvalue / 0.05 * time_coeff
-    #         print
-    #         penalty, ' ',
-    #
-    #         #             print(penalty)
-    #         #             penalty = np.log(1.+pvalue/CRITICAL_PVALUE)#0.95
-    #         #         if pvalue < 10e-6:
-    #         #             penalty = 0.8
-    #
-    #         if wg == 'left':
-    #             #             print '__w1 ',penalty,
-    #             w2 = w2 * penalty
-    #         elif wg == 'right':
-    #             #             print 'w2 ', penalty,
-    #             w1 = w1 * penalty
-    #             # definetely someone is less
-    #     print
-    #     wg
-    #     norm = float(w1 + w2)
-    #     w1 = w1 / norm
-    #     w2 = w2 / norm
-    #
-    #     # #     if i < 10:
-    #     #         w1, w2 = .5,.5
-    #     weights_1 += [w1]
-    #     weights_2 += [w2]
-    # NUM_LAST_WEIGHTS = 200
-    #
-    # def recalc_models_weights(self):
-    #     ws = WeightStorage()
-    #     previous_weights = ws.get_previous_weights(
-    #         page_type=self.page_type,
-    #         num=self.NUM_LAST_WEIGHTS,
-    #     )
-    #
\ No newline at end of file
+    def load_state(self, path):
+        arrays = load_arms_state(path, self.models, 'heuristic bandit')
+        if arrays is None:
+            return
+        self.step = int(arrays['step'])
+        if 'last_weights' in arrays:
+            self.last_weights = np.array(arrays['last_weights'])
+        self.conversions = ArmsRingBuffer.from_arrays(arrays, 'conversions_')
+        self.true_weights = ArmsRingBuffer.from_arrays(arrays, 'true_weights_')
@@ -0,0 +1,98 @@
+import numpy as np
+
+from cian_bandit.bandits import WrongModelException
+
+
+class LinUCBBandit(object):
+    """
+    Контекстный бандит LinUCB (disjoint model, Li et al. 2010)
+    для выбора model_version по признакам запроса (длина истории, регион, ...)
+    score_a(x) = x^T theta_a + alpha * sqrt(x^T A_a^-1 x),
+    A_a = ridge * I + sum x x^T, theta_a = A_a^-1 b_a, b_a = sum r x
+    Храним сразу A_a^-1 и обновляем его формулой Шермана-Моррисона:
+    O(d^2) на событие, без обращения матриц
+    """
+    def __init__(self, page_type, models, n_features, alpha=1.0, ridge=1.0):
+        self.page_type = page_type
+        self.models = {}
+        for model in models:
+            if model.page_type != self.page_type:
+                raise WrongModelException(
+                    'Passed model with {0} page_type, {1} expected'.format(
+                        model.page_type,
+                        self.page_type
+                    )
+                )
+            self.models[model.model_version] = model
+        self.model_versions = np.array(list(self.models), dtype=object)
+        self._index = {mv: i for i, mv in enumerate(self.models)}
+
+        n_arms = len(self.models)
+        self.n_features = n_features
+        self.alpha = alpha
+        self.A_inv = np.tile(np.eye(n_features) / ridge, (n_arms, 1, 1))
+        self.b = np.zeros((n_arms, n_features))
+        self.theta = np.zeros((n_arms, n_features))
+        self.events_cnt = np.zeros(n_arms, dtype=np.int64)
+
+    def arm_index(self, model_versions):
+        index = self._index
+        return np.fromiter(
+            (index.get(mv, -1) for mv in model_versions),
+            dtype=np.int64,
+            count=len(model_versions),
+        )
+
+    def update(self, model_versions, contexts, rewards):
+        """
+        :param model_versions: shown model_version of every event
+        :param contexts: (n, d) array of request features
+        :param rewards: (n,) array, e.g. clicked_cnt > 0
+        Events of one arm are applied in order, events of different arms
+        are applied together: k-th wave updates k-th event of every arm
+        """
+        arms = self.arm_index(model_versions)
+        contexts = np.asarray(contexts, dtype=float)
+        rewards = np.asarray(rewards, dtype=float)
+        known = arms >= 0
+        arms, contexts, rewards = arms[known], contexts[known], rewards[known]
+        if len(arms) == 0:
+            return
+
+        order = np.argsort(arms, kind='stable')
+        arms, contexts, rewards = arms[order], contexts[order], rewards[order]
+        # position of every event among events of its arm
+        starts = np.flatnonzero(np.r_[True, arms[1:] != arms[:-1]])
+        counts = np.diff(np.r_[starts, len(arms)])
+        rank = np.arange(len(arms)) - np.repeat(starts, counts)
+
+        # events of every wave at once: stable sort by rank keeps arms order
+        by_rank = np.argsort(rank, kind='stable')
+        waves = np.split(by_rank, np.cumsum(np.bincount(rank))[:-1])
+        for events in waves:
+            a = arms[events]
+            x = contexts[events]
+            a_inv = self.A_inv[a]
+            a_inv_x = np.einsum('kij,kj->ki', a_inv, x)
+            denom = 1.0 + np.einsum('ki,ki->k', x, a_inv_x)
+            self.A_inv[a] = a_inv - np.einsum('ki,kj->kij', a_inv_x, a_inv_x) / denom[:, None, None]
+        np.add.at(self.b, arms, rewards[:, None] * contexts)
+        np.add.at(self.events_cnt, arms, 1)
+        self.theta = np.einsum('aij,aj->ai', self.A_inv, self.b)
+
+    def score(self, contexts):
+        """
+        :param contexts: (n, d) array
+        :return: (n, arms) array of upper confidence bounds
+        """
+        contexts = np.asarray(contexts, dtype=float)
+        mean = contexts @ self.theta.T
+        x_a_inv = np.einsum('nd,ade->nae', contexts, self.A_inv)
+        var = np.einsum('nae,ne->na', x_a_inv, contexts)
+        return mean + self.alpha * np.sqrt(np.maximum(var, 0.0))
+
+    def choose(self, contexts):
+        """
+        :return: np.array of chosen model_version for every request
+        """
+        return self.model_versions[np.argmax(self.score(contexts), axis=1)]
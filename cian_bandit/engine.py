@@ -0,0 +1,327 @@
+import numpy as np
+
+
+NULL_CONVERSION = 10e-6
+
+
+class MultipleBanditsPerPageType(Exception):
+    pass
+
+
+class UnknownPageType(Exception):
+    pass
+
+
+class BanditEngine(object):
+    """
+    Состояние всех ручек всех page_type в непрерывных numpy-массивах
+    Ручки одного page_type лежат подряд, page_type -> slice
+    Все шаги пересчёта весов (UCB, нормировка, min_weight) делаются
+    сразу над массивами, в том числе над несколькими page_type за раз
+    Бандиты (SimpleBandit, UCBBandit) - тонкие обёртки над своим slice
+    """
+    def __init__(self):
+        self.page_types = []
+        self.model_versions = []
+        self._slices = {}
+        self._segment_ids = {}
+        self._index = {}
+        # segment id (page_type number) of every arm
+        self.segment = np.zeros(0, dtype=np.int64)
+        self.smooth = np.zeros(0)
+        self.clicks = np.zeros(0)
+        self.shows = np.zeros(0)
+        self.events_cnt = np.zeros(0)
+        self.weights = np.zeros(0)
+
+    def __len__(self):
+        return len(self.model_versions)
+
+    def add_page_type(self, page_type, model_versions, smooth):
+        """
+        :param model_versions: list[str]
+        :param smooth: float or list[float], added to shows of every arm
+        :return: slice of page_type arms
+        """
+        self.add_page_types([(page_type, model_versions)], smooth)
+        return self._slices[page_type]
+
+    def add_page_types(self, page_types_model_versions, smooth):
+        """
+        Register many page_types (segments) with one reallocation of arrays
+        :param page_types_model_versions: list of (page_type, model_versions)
+        :param smooth: float or per-arm list of all new arms
+        """
+        start = len(self.model_versions)
+        segments = []
+        for page_type, model_versions in page_types_model_versions:
+            if page_type in self._slices:
+                raise MultipleBanditsPerPageType(
+                    'page_type {0} is already registered'.format(page_type)
+                )
+            model_versions = list(model_versions)
+            first = len(self.model_versions)
+            segment_id = len(self.page_types)
+            self.page_types.append(page_type)
+            self._slices[page_type] = slice(first, first + len(model_versions))
+            self._segment_ids[page_type] = segment_id
+            for i, model_version in enumerate(model_versions):
+                self._index[(page_type, model_version)] = first + i
+            self.model_versions.extend(model_versions)
+            segments.append(np.full(len(model_versions), segment_id, dtype=np.int64))
+
+        n = len(self.model_versions) - start
+        empty = np.full(n, np.nan)
+        self.segment = np.concatenate([self.segment] + segments)
+        self.smooth = np.concatenate([self.smooth, np.broadcast_to(np.asarray(smooth, dtype=float), n)])
+        self.clicks = np.concatenate([self.clicks, empty])
+        self.shows = np.concatenate([self.shows, empty])
+        self.events_cnt = np.concatenate([self.events_cnt, empty])
+        self.weights = np.concatenate([self.weights, empty])
+
+    def reset_totals(self):
+        """
+        All arms become never evaluated, weights are kept:
+        the engine is reused for the next batch (daemon)
+        """
+        self.clicks.fill(np.nan)
+        self.shows.fill(np.nan)
+        self.events_cnt.fill(np.nan)
+
+    def arms(self, page_type):
+        if page_type not in self._slices:
+            raise UnknownPageType('page_type {0} is not registered'.format(page_type))
+        return self._slices[page_type]
+
+    def segment_ids(self, page_types):
+        return [self._segment_ids[page_type] for page_type in page_types]
+
+    def arm_index(self, page_type, model_versions):
+        """
+        :return: np.array of arm indices, -1 for unknown model versions
+        """
+        index = self._index
+        return np.fromiter(
+            (index.get((page_type, mv), -1) for mv in model_versions),
+            dtype=np.int64,
+            count=len(model_versions),
+        )
+
+    def rows_arm_index(self, page_types, model_versions):
+        """
+        arm_index for rows of many page_types (segments)
+        :return: np.array of arm indices, -1 for unknown page_types and model versions
+        """
+        index = self._index
+        return np.fromiter(
+            (index.get(key, -1) for key in zip(page_types, model_versions)),
+            dtype=np.int64,
+            count=len(model_versions),
+        )
+
+    def add_batch(self, page_type, model_versions, clicks, shows):
+        """
+        Overwrite clicks and shows of arms found in batch (as ClickThroughRate.add_batch)
+        events_cnt is total shows of page_type, including unknown model versions
+        :param model_versions: sequence of model_version, one per row
+        :param clicks: array-like, aggregated clicks per row
+        :param shows: array-like, aggregated shows per row
+        """
+        self.arms(page_type)
+        self.add_rows(page_type, model_versions, clicks, shows)
+
+    def _set_totals(self, clicks, shows, seen, events_cnt):
+        """
+        :param clicks, shows: per-arm totals of batch
+        :param seen: per-arm bool, arm has rows in batch
+        :param events_cnt: per-page_type total shows of batch
+        """
+        idx = np.flatnonzero(seen)
+        self.clicks[idx] = clicks[idx]
+        self.shows[idx] = shows[idx] + self.smooth[idx]
+        self.events_cnt[idx] = events_cnt[self.segment[idx]]
+
+    def add_rows(self, page_types, model_versions, clicks, shows):
+        """
+        add_batch for rows of many page_types (segments) in one pass
+        Rows of one arm are summed, so rows may be aggregates or single events
+        rows of unregistered page_types are ignored
+        :param page_types: page_type of every row or one page_type of all rows
+        """
+        clicks = np.asarray(clicks, dtype=float)
+        shows = np.asarray(shows, dtype=float)
+        n_rows = len(shows)
+        index = self._index
+        if isinstance(page_types, str):
+            segment_id = self._segment_ids.get(page_types, -1)
+            row_segment = np.full(n_rows, segment_id, dtype=np.int64)
+            keys = ((page_types, mv) for mv in model_versions)
+        else:
+            segment_ids = self._segment_ids
+            row_segment = np.fromiter(
+                (segment_ids.get(page_type, -1) for page_type in page_types),
+                dtype=np.int64,
+                count=n_rows,
+            )
+            keys = zip(page_types, model_versions)
+        idx = np.fromiter(
+            (index.get(key, -1) for key in keys),
+            dtype=np.int64,
+            count=n_rows,
+        )
+
+        registered = row_segment >= 0
+        events_cnt = np.bincount(
+            row_segment[registered],
+            weights=shows[registered],
+            minlength=len(self.page_types),
+        )
+        known = idx >= 0
+        idx = idx[known]
+        n = len(self)
+        self._set_totals(
+            clicks=np.bincount(idx, weights=clicks[known], minlength=n),
+            shows=np.bincount(idx, weights=shows[known], minlength=n),
+            seen=np.bincount(idx, minlength=n) > 0,
+            events_cnt=events_cnt,
+        )
+
+    def add_records(self, records, page_type=None):
+        """
+        add_rows for an iterator of dicts, in one pass without intermediate tables
+        Aggregated records have `clicks` and `shows`,
+        single shows (pio_recs.sopr_shows rows) have `clicked_cnt`
+        :param page_type: take only records of this page_type
+        """
+        n = len(self)
+        clicks = [0.0] * n
+        shows = [0.0] * n
+        seen = [False] * n
+        events_cnt = [0.0] * len(self.page_types)
+        index = self._index
+        segment_ids = self._segment_ids
+        for record in records:
+            record_page_type = record.get('page_type', page_type)
+            if page_type is not None and record_page_type != page_type:
+                continue
+            segment_id = segment_ids.get(record_page_type)
+            if segment_id is None:
+                continue
+            record_shows = record.get('shows', 1)
+            events_cnt[segment_id] += record_shows
+            i = index.get((record_page_type, record['model_version']))
+            if i is None:
+                continue
+            clicks[i] += record.get('clicks', record.get('clicked_cnt', 0)) or 0
+            shows[i] += record_shows
+            seen[i] = True
+        self._set_totals(
+            clicks=np.array(clicks),
+            shows=np.array(shows),
+            seen=np.array(seen, dtype=bool),
+            events_cnt=np.array(events_cnt),
+        )
+
+    def add_increment(self, page_type, model_versions, clicks, shows):
+        """
+        Streaming counterpart of add_batch: accumulate new clicks and shows
+        events_cnt grows by all new shows of page_type
+        """
+        arms = self.arms(page_type)
+        clicks = np.asarray(clicks, dtype=float)
+        shows = np.asarray(shows, dtype=float)
+        events_cnt = shows.sum()
+
+        idx = self.arm_index(page_type, model_versions)
+        known = idx >= 0
+        idx = idx[known]
+        first = np.isnan(self.shows[idx])
+        self.clicks[idx[first]] = 0.0
+        self.shows[idx[first]] = self.smooth[idx[first]]
+        np.add.at(self.clicks, idx, clicks[known])
+        np.add.at(self.shows, idx, shows[known])
+        self.events_cnt[arms] = np.nan_to_num(self.events_cnt[arms]) + events_cnt
+
+    def set_arm_totals(self, arms, clicks, shows, events_cnt):
+        """
+        Overwrite raw clicks and shows of arms with totals kept outside
+        (decayed or windowed counters), smooth is added to shows
+        Arms with no shows (never shown or out of the window) become never evaluated
+        :param events_cnt: events_cnt of the arms' page_type
+        """
+        idx = np.arange(len(self))[arms]
+        clicks = np.asarray(clicks, dtype=float)
+        shows = np.asarray(shows, dtype=float)
+        seen = shows > 0
+        self.clicks[idx] = np.where(seen, clicks, np.nan)
+        self.shows[idx] = np.where(seen, shows + self.smooth[idx], np.nan)
+        self.events_cnt[idx] = np.where(seen, events_cnt, np.nan)
+
+    def conversions(self, arms=slice(None)):
+        """
+        CTR of arms, never evaluated arms get NULL_CONVERSION
+        """
+        with np.errstate(divide='ignore', invalid='ignore'):
+            value = self.clicks[arms] / self.shows[arms]
+        return np.where(np.isnan(value), NULL_CONVERSION, value)
+
+    def ucb_bonus(self, arms=slice(None)):
+        """
+        2 ln(t) / n_i, where t is events_cnt and n_i is (smoothed) shows of arm
+        """
+        events_cnt = self.events_cnt[arms]
+        observed = events_cnt > 0
+        with np.errstate(divide='ignore', invalid='ignore'):
+            bonus = 2 * np.log(events_cnt) / np.fmax(1, self.shows[arms])
+        return np.where(observed, bonus, 0.0)
+
+    def beta_posteriors(self, arms=slice(None)):
+        """
+        Beta(1 + clicks, 1 + shows - clicks) with raw (not smoothed) shows
+        :return: alpha, beta arrays
+        """
+        clicks = np.nan_to_num(self.clicks[arms])
+        shows = np.nan_to_num(self.shows[arms] - self.smooth[arms])
+        fails = np.maximum(shows - clicks, 0.0)
+        return 1.0 + clicks, 1.0 + fails
+
+    def arm_stats(self, arms=slice(None)):
+        """
+        Raw (not smoothed) counters of arms for history records, 0 for never evaluated
+        :return: clicks, shows, events_cnt arrays
+        """
+        return (
+            np.nan_to_num(self.clicks[arms]),
+            np.nan_to_num(self.shows[arms] - self.smooth[arms]),
+            np.nan_to_num(self.events_cnt[arms]),
+        )
+
+    def zero_conversion_page_types(self, values):
+        """
+        :param values: metric values of all arms
+        :return: list of page_types where all values are ~0 (or there are no arms)
+        """
+        nonzero = np.bincount(
+            self.segment,
+            weights=~np.isclose(values, 0.0),
+            minlength=len(self.page_types),
+        )
+        return [pt for pt, cnt in zip(self.page_types, nonzero) if cnt == 0]
+
+    def _normalize(self, values, segment, min_weight):
+        norm = np.bincount(segment, weights=values, minlength=len(self.page_types))
+        norm[norm == 0] = 10e-6
+        weights = values / norm[segment]
+        return np.where(np.isnan(weights), min_weight, weights)
+
+    def set_weights(self, values, min_weight, arms=slice(None)):
+        """
+        Normalize values inside every page_type, clamp to min_weight, normalize again
+        :param values: metric values (conversion, conversion + ucb, ...) of arms
+        :param min_weight: float or array of per-arm min weights
+        """
+        segment = self.segment[arms]
+        weights = self._normalize(values, segment, min_weight)
+        weights = np.maximum(min_weight, weights)
+        self.weights[arms] = self._normalize(weights, segment, min_weight)
+        return self.weights[arms]
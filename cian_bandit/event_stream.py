@@ -0,0 +1,239 @@
+import json
+import logging
+import os
+import socket
+import time
+from collections import defaultdict
+
+import numpy as np
+
+from cian_bandit.bandits import ZeroConversion
+from cian_bandit import instrumentation
+
+info_logger = logging.getLogger('info_logger')
+
+
+class JsonlEventReader(object):
+    """
+    Инкрементальное чтение append-only jsonl лога показов
+    Одна строка - один показ в формате pio_recs.sopr_shows:
+    {"page_type": "desktop", "model_version": "9", "clicked_cnt": 1}
+    Помним offset, недописанную последнюю строку оставляем до следующего чтения
+    Если файл стал короче offset (ротация), читаем его с начала
+    """
+    def __init__(self, path, from_start=True):
+        self.path = path
+        self.offset = 0
+        if not from_start and os.path.exists(path):
+            self.offset = os.path.getsize(path)
+
+    def read(self):
+        """
+        :return: list[dict], events appended since previous read
+        """
+        if not os.path.exists(self.path):
+            return []
+        if os.path.getsize(self.path) < self.offset:
+            self.offset = 0
+        with open(self.path, 'rb') as f:
+            f.seek(self.offset)
+            chunk = f.read()
+        end = chunk.rfind(b'\n') + 1
+        self.offset += end
+        return parse_lines(chunk[:end].splitlines())
+
+
+class SocketEventReader(object):
+    """
+    То же, что JsonlEventReader, но события приходят строками json по tcp
+    read() не блокируется дольше timeout секунд
+    """
+    def __init__(self, host, port, timeout=0.1, bufsize=1 << 16):
+        self.address = (host, port)
+        self.timeout = timeout
+        self.bufsize = bufsize
+        self._sock = None
+        self._tail = b''
+
+    def _connect(self):
+        if self._sock is None:
+            self._sock = socket.create_connection(self.address)
+            self._sock.settimeout(self.timeout)
+        return self._sock
+
+    def read(self):
+        sock = self._connect()
+        chunks = [self._tail]
+        while True:
+            try:
+                data = sock.recv(self.bufsize)
+            except socket.timeout:
+                break
+            if not data:
+                # peer closed connection, reconnect on next read
+                sock.close()
+                self._sock = None
+                break
+            chunks.append(data)
+        chunk = b''.join(chunks)
+        end = chunk.rfind(b'\n') + 1
+        self._tail = chunk[end:]
+        return parse_lines(chunk[:end].splitlines())
+
+    def close(self):
+        if self._sock is not None:
+            self._sock.close()
+            self._sock = None
+
+
+def parse_lines(lines):
+    events = []
+    for line in lines:
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            events.append(json.loads(line))
+        except ValueError:
+            info_logger.warning('skipped broken event line: %r', line[:200])
+    return events
+
+
+def aggregate_events(events):
+    """
+    Sufficient statistics of new events
+    Events without page_type or model_version or with non-numeric clicked_cnt
+    are skipped
+    :return: ({page_type: {model_version: [clicks, shows]}}, number of skipped events)
+    """
+    stats = defaultdict(lambda: defaultdict(lambda: [0, 0]))
+    malformed = 0
+    for event in events:
+        try:
+            page_type = event['page_type']
+            model_version = str(event['model_version'])
+            clicks = int(event.get('clicked_cnt') or 0)
+        except (KeyError, TypeError, ValueError, AttributeError):
+            malformed += 1
+            if malformed == 1:
+                info_logger.warning('skipped malformed event: %r', event)
+            continue
+        row = stats[page_type][model_version]
+        row[0] += clicks
+        row[1] += 1
+    return stats, malformed
+
+
+class StreamingUpdater(object):
+    """
+    Онлайн-режим BanditUpdater: вместо перезаписи метрик свежим агрегатом
+    из presto копим клики и показы по новым событиям лога
+    Веса пересчитываются на каждом poll с новыми событиями, а публикуются,
+    если прошло publish_interval секунд или какой-то вес изменился
+    больше чем на change_threshold с последней публикации
+    Битые события пропускаются и считаются (malformed_cnt), ошибка публикации
+    логируется, page_type остаётся к публикации на следующем poll;
+    после ошибок run ждёт экспоненциально дольше, до max_backoff секунд
+    """
+    def __init__(self, updater, reader, config, publish_interval=60., change_threshold=0.05,
+                 clock=time.time):
+        self.updater = updater
+        self.reader = reader
+        self.config = config
+        self.publish_interval = publish_interval
+        self.change_threshold = change_threshold
+        self.clock = clock
+        self.events_cnt = 0
+        self.malformed_cnt = 0
+        self.publish_errors = 0
+        # publishing of some page_type failed on the last poll
+        self.last_poll_failed = False
+        self._published_weights = {}
+        self._published_at = {}
+        # page_types with new events since last publication
+        self._dirty = set()
+        if updater.bandits is None:
+            updater.init_bandits(config)
+        for bandit in updater.bandits:
+            # the log gives clicks and shows only: fail now, not on the first event
+            if bandit.reward is not None:
+                bandit.reward.check_columns(['clicks', 'shows'])
+
+    def _should_publish(self, bandit, weights, now):
+        page_type = bandit.page_type
+        if page_type not in self._published_weights:
+            return True
+        if now - self._published_at[page_type] >= self.publish_interval:
+            return True
+        change = np.abs(weights - self._published_weights[page_type])
+        return bool(np.max(change, initial=0.0) >= self.change_threshold)
+
+    def poll(self):
+        """
+        Read new events, update statistics, republish weights if needed
+        :return: list of published page_types
+        """
+        events = self.reader.read()
+        stats, malformed = aggregate_events(events)
+        self.events_cnt += len(events) - malformed
+        if malformed:
+            self.malformed_cnt += malformed
+            instrumentation.incr('malformed_events', malformed)
+        now = self.clock()
+        published = []
+        self.last_poll_failed = False
+
+        for bandit in self.updater.bandits:
+            page_type = bandit.page_type
+            pt_stats = stats.get(page_type)
+            if pt_stats:
+                model_versions = list(pt_stats)
+                clicks, shows = zip(*pt_stats.values())
+                bandit.add_increment(model_versions, clicks, shows)
+                self._dirty.add(page_type)
+            if page_type not in self._dirty:
+                continue
+            try:
+                bandit.recalc_models_weights()
+            except ZeroConversion as zc:
+                self._dirty.discard(page_type)
+                logging.warning(page_type)
+                logging.warning(zc)
+                continue
+
+            weights = bandit.engine.weights[bandit.arms].copy()
+            if self._should_publish(bandit, weights, now):
+                try:
+                    self.updater.publish(bandit, self.config)
+                except Exception:
+                    # stays dirty: published again on the next poll
+                    logging.exception('publishing %s failed', page_type)
+                    instrumentation.incr('publish_errors')
+                    self.publish_errors += 1
+                    self.last_poll_failed = True
+                    continue
+                self._published_weights[page_type] = weights
+                self._published_at[page_type] = now
+                self._dirty.discard(page_type)
+                published.append(page_type)
+                info_logger.info(page_type)
+                info_logger.info(bandit.get_models_weights())
+        return published
+
+    def run(self, poll_interval=1.0, max_polls=None, max_backoff=60., sleep=time.sleep):
+        """
+        :param max_backoff: longest sleep after consecutive failed polls
+        """
+        polls = 0
+        failures = 0
+        while max_polls is None or polls < max_polls:
+            try:
+                self.poll()
+                failed = self.last_poll_failed
+            except Exception:
+                logging.exception('streaming poll failed')
+                instrumentation.incr('poll_errors')
+                failed = True
+            failures = failures + 1 if failed else 0
+            polls += 1
+            sleep(min(max_backoff, poll_interval * 2 ** failures))
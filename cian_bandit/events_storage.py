@@ -1,8 +1,12 @@
-from cian_bandit.presto import set_username
-from cian_bandit.presto import run_sql
-
 from cian_bandit.metrics_sql import metrics_sql_columns
+from cian_bandit.metrics_sql import metrics_group_columns
+from cian_bandit.metrics_sql import metrics_group_dtype
 from cian_bandit.metrics_sql import metrics_sql
+from cian_bandit.metrics_sql import metrics_windows_dtype
+from cian_bandit.metrics_sql import metrics_windows_sql
+from cian_bandit import instrumentation
+from datetime import date, timedelta
+import numpy as np
 import pandas as pd
 import json
 import os
@@ -12,24 +16,195 @@ class NotDownloadedBatch(Exception):
     pass
 
 
-class EventsStorage:
-    def __init__(self, last_events_cnt):
-        self.username = os.environ['PRESTO_USER']
-        self.last_events_cnt = last_events_cnt
+class PrestoEventsBackend(object):
+    """
+    Агрегаты metrics_sql по pio_recs.sopr_shows в presto
+    """
+    def __init__(self, presto_client=None, username=None):
+        if presto_client is None:
+            from cian_bandit.presto import PrestoClient
+            if username is None:
+                username = os.environ['PRESTO_USER']
+            presto_client = PrestoClient(username=username)
+        self.presto_client = presto_client
+
+    def download(self, last_events_cnt, group_columns=()):
+        """
+        :param group_columns: segment columns, see metrics_sql
+        """
+        sql = metrics_sql(last_events_cnt, group_columns)
+        result = self.presto_client.fetch_arrays(sql, dtype=metrics_group_dtype(group_columns))
+        return pd.DataFrame(result)
+
+    def download_many(self, last_events_cnts, group_columns=()):
+        """
+        All windows in one query: sopr_shows is scanned once
+        """
+        sql = metrics_windows_sql(last_events_cnts, group_columns)
+        dtype = metrics_windows_dtype(last_events_cnts, group_columns)
+        result = self.presto_client.fetch_arrays(sql, dtype=dtype)
+        return split_windows(result, last_events_cnts, group_columns)
+
+
+def split_windows(result, last_events_cnts, group_columns=()):
+    """
+    :param result: metrics_windows_sql result, structured array or pd.DataFrame
+    :return: dict last_events_cnt -> batch with `metrics_group_columns(group_columns)`
+    """
+    columns = metrics_group_columns(group_columns)
+    batches = {}
+    for cnt in last_events_cnts:
+        batch = {column: np.asarray(result[column]) for column in columns[:len(group_columns) + 1]}
+        for column in metrics_sql_columns[1:]:
+            batch[column] = np.asarray(result['{0}_{1}'.format(column, cnt)])
+        batches[cnt] = pd.DataFrame(batch, columns=columns)
+    return batches
+
+
+# sopr_shows columns metrics_sql needs
+SOPR_SHOWS_COLUMNS = [
+    'model_version',
+    'cid',
+    'clicked_cnt',
+    'phoned_cnt',
+    'recommended_dadd',
+    'ptn_dadd',
+]
+
+
+def event_order_from_last(events, group_columns=()):
+    """
+    rank() over (partition by group_columns, model_version order by recommended_dadd desc)
+    """
+    return events.groupby(list(group_columns) + ['model_version'])['recommended_dadd'].rank(
+        method='min',
+        ascending=False,
+    ).values
 
-    def _download_batch(self):
-        sql = metrics_sql(self.last_events_cnt)
 
-        set_username(self.username)
-        result = run_sql(sql, rs=True)
+def aggregate_last_events(events, last_events_cnt, order_from_last=None, group_columns=()):
+    """
+    metrics_sql in pandas: last_events_cnt freshest events of every model_version
+    (ties by recommended_dadd are all taken, as rank() does) aggregated
+    into metrics_sql_columns
+    :param events: pd.DataFrame with SOPR_SHOWS_COLUMNS and group_columns
+    :param order_from_last: precomputed event_order_from_last(events, group_columns)
+    :param group_columns: segment columns, see metrics_sql
+    """
+    keys = list(group_columns) + ['model_version']
+    if order_from_last is None:
+        order_from_last = event_order_from_last(events, group_columns)
+    events = events[order_from_last <= last_events_cnt]
+    # case when x = 0 then Null else cid: null x counts as non zero
+    clicked_cid = events['cid'].where(events['clicked_cnt'] != 0)
+    phoned_cid = events['cid'].where(events['phoned_cnt'] != 0)
 
-        if result is None or len(result) == 0:
-            raise NotDownloadedBatch("presto didnt return data")
+    grouped = events.assign(clicked_cid=clicked_cid, phoned_cid=phoned_cid).groupby(
+        keys,
+        sort=True,
+    )
+    batch = pd.DataFrame({
+        'clicks': grouped['clicked_cnt'].sum(),
+        'phones': grouped['phoned_cnt'].sum(),
+        'shows': grouped.size(),
+        'users': grouped['cid'].nunique(),
+        'click_bounced': grouped['clicked_cid'].nunique(),
+        'phone_bounced': grouped['phoned_cid'].nunique(),
+    }).reset_index()
+    for column in keys:
+        batch[column] = batch[column].astype(str)
+    for column in metrics_sql_columns[1:]:
+        batch[column] = batch[column].astype(np.int64)
+    return batch[metrics_group_columns(group_columns)]
 
-        batch = pd.DataFrame(result)
-        batch.columns = metrics_sql_columns
+
+class LocalEventsBackend(object):
+    """
+    Те же агрегаты по локальным файлам в формате pio_recs.sopr_shows
+    (parquet или csv): для бэкфиллов, реплеев и офлайн-запусков без кластера
+    Читаются только нужные колонки, файлы открываются через memory map
+    :param days: as `ptn_dadd >= current_date - interval 'days' day`,
+        None reads all events of files
+    :param current_date: date of the run, today by default
+    """
+    def __init__(self, paths, days=1, current_date=None):
+        if isinstance(paths, str):
+            paths = [paths]
+        self.paths = list(paths)
+        self.days = days
+        self.current_date = current_date
+
+    def _read_file(self, path, group_columns=()):
+        columns = SOPR_SHOWS_COLUMNS + list(group_columns)
+        if path.endswith('.parquet') or path.endswith('.pq'):
+            return pd.read_parquet(path, columns=columns, memory_map=True)
+        return pd.read_csv(
+            path,
+            usecols=columns,
+            memory_map=True,
+            dtype={column: str for column in ['model_version'] + list(group_columns)},
+        )
+
+    def read_events(self, group_columns=()):
+        events = [self._read_file(path, group_columns) for path in self.paths]
+        events = pd.concat(events, ignore_index=True) if len(events) > 1 else events[0]
+        if self.days is not None:
+            current_date = self.current_date or date.today()
+            min_date = pd.Timestamp(current_date - timedelta(days=self.days))
+            events = events[pd.to_datetime(events['ptn_dadd']) >= min_date]
+        return events.assign(recommended_dadd=pd.to_datetime(events['recommended_dadd']))
+
+    def download(self, last_events_cnt, group_columns=()):
+        events = self.read_events(group_columns)
+        return aggregate_last_events(events, last_events_cnt, group_columns=group_columns)
+
+    def download_many(self, last_events_cnts, group_columns=()):
+        """
+        Files are read and events are ranked once for all windows
+        """
+        events = self.read_events(group_columns)
+        order_from_last = event_order_from_last(events, group_columns)
+        return {
+            cnt: aggregate_last_events(events, cnt, order_from_last, group_columns)
+            for cnt in last_events_cnts
+        }
+
+
+class EventsStorage:
+    def __init__(self, last_events_cnt, presto_client=None, backend=None):
+        """
+        :param backend: PrestoEventsBackend (default) or LocalEventsBackend
+        """
+        self.last_events_cnt = last_events_cnt
+        if backend is None:
+            backend = PrestoEventsBackend(presto_client=presto_client)
+        self.backend = backend
+
+    def _download_batch(self, group_columns=()):
+        with instrumentation.span('events_download'):
+            batch = self.backend.download(self.last_events_cnt, group_columns)
+        instrumentation.incr('rows_fetched', len(batch))
+        if len(batch) == 0:
+            raise NotDownloadedBatch("events backend didnt return data")
         self.batch = batch
 
-    def get_batch(self):
-        self._download_batch()
+    def get_batches(self, last_events_cnts, group_columns=()):
+        """
+        Batches for several windows in one go
+        :param group_columns: segment columns, see metrics_sql
+        :return: dict last_events_cnt -> batch
+        """
+        with instrumentation.span('events_download'):
+            batches = self.backend.download_many(last_events_cnts, group_columns)
+        instrumentation.incr('rows_fetched', sum(len(batch) for batch in batches.values()))
+        for batch in batches.values():
+            if len(batch) == 0:
+                raise NotDownloadedBatch("events backend didnt return data")
+        return batches
+
+    def get_batch(self, group_columns=()):
+        """
+        :param group_columns: segment columns, see metrics_sql
+        """
+        self._download_batch(group_columns)
         return self.batch
@@ -0,0 +1,232 @@
+import fcntl
+import json
+import os
+
+import numpy as np
+
+
+class HistoryFormatError(Exception):
+    pass
+
+
+MAGIC = b'CBHIST01'
+HEADER_SIZE = 16
+# records scanned per step by HistoryStore.last, from the tail of the file
+LAST_CHUNK = 4096
+
+# page_type and model_version are codes of strings from the keys file
+HISTORY_DTYPE = np.dtype([
+    ('timestamp', '<f8'),
+    ('page_type', '<i4'),
+    ('model_version', '<i4'),
+    ('prob', '<f8'),
+    ('conversion', '<f8'),
+    ('shows', '<i8'),
+    ('clicks', '<i8'),
+])
+
+
+class HistoryStore(object):
+    """
+    Локальная история весов и конверсий ручек: (timestamp, page_type,
+    model_version, prob, conversion, shows, clicks)
+    Файл - 16 байт заголовка и записи фиксированного размера HISTORY_DTYPE,
+    читается через np.memmap без разбора; строки page_type и model_version
+    хранятся кодами, сами строки - в соседнем файл path + '.keys' (jsonl)
+    Только дописывание, записи идут по неубывающему timestamp:
+    диапазоны по времени ищутся бинарным поиском
+    Писателей может быть несколько (демон, запуски из cron, стриминг):
+    append держит flock на файле данных и под ним дочитывает чужие ключи
+    и последний timestamp; читателей - сколько угодно, без блокировок
+    """
+    def __init__(self, path):
+        self.path = path
+        self.keys_path = path + '.keys'
+        self._keys = []
+        self._codes = {}
+        self._keys_size = 0
+        self._mmap = None
+        self._mmap_size = None
+        self.last_timestamp = None
+
+        if not os.path.exists(path):
+            with open(path, 'wb') as f:
+                f.write(MAGIC + np.array(HISTORY_DTYPE.itemsize, dtype='<i8').tobytes())
+        with open(path, 'rb') as f:
+            header = f.read(HEADER_SIZE)
+        if header[:len(MAGIC)] != MAGIC or \
+                int(np.frombuffer(header[len(MAGIC):], dtype='<i8')[0]) != HISTORY_DTYPE.itemsize:
+            raise HistoryFormatError('{0} is not a history store'.format(path))
+        self._load_keys()
+        records = self.records()
+        if len(records) > 0:
+            self.last_timestamp = float(records['timestamp'][-1])
+
+    def __len__(self):
+        return (os.path.getsize(self.path) - HEADER_SIZE) // HISTORY_DTYPE.itemsize
+
+    def _load_keys(self):
+        if not os.path.exists(self.keys_path):
+            return
+        size = os.path.getsize(self.keys_path)
+        if size == self._keys_size:
+            return
+        with open(self.keys_path, 'rb') as f:
+            f.seek(self._keys_size)
+            for line in f:
+                if not line.endswith(b'\n'):
+                    # being written by another process: read it next time
+                    break
+                key = json.loads(line.decode('utf-8'))
+                self._codes[key] = len(self._keys)
+                self._keys.append(key)
+                self._keys_size += len(line)
+
+    def _read_last_timestamp(self, f):
+        """
+        :param f: data file opened for reading
+        """
+        n = (os.fstat(f.fileno()).st_size - HEADER_SIZE) // HISTORY_DTYPE.itemsize
+        if n == 0:
+            return None
+        f.seek(HEADER_SIZE + (n - 1) * HISTORY_DTYPE.itemsize)
+        return float(np.frombuffer(f.read(8), dtype='<f8')[0])
+
+    def _code(self, key, create=False):
+        key = str(key)
+        code = self._codes.get(key)
+        if code is None and create:
+            code = len(self._keys)
+            with open(self.keys_path, 'a') as f:
+                f.write(json.dumps(key) + '\n')
+            self._keys_size = os.path.getsize(self.keys_path)
+            self._codes[key] = code
+            self._keys.append(key)
+        return code
+
+    def key(self, code):
+        return self._keys[code]
+
+    def append(self, timestamp, page_type, model_versions, probs, conversions, shows=None, clicks=None):
+        """
+        One bandit step: a record per arm, written with one write call
+        Under flock of the data file: keys and the last timestamp written
+        by other instances are read before codes are assigned
+        """
+        with open(self.path, 'rb+') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                self._load_keys()
+                self.last_timestamp = self._read_last_timestamp(f)
+                if self.last_timestamp is not None and timestamp < self.last_timestamp:
+                    raise ValueError('history is append-only: {0} is older than {1}'.format(
+                        timestamp, self.last_timestamp
+                    ))
+                n = len(model_versions)
+                step = np.zeros(n, dtype=HISTORY_DTYPE)
+                step['timestamp'] = timestamp
+                step['page_type'] = self._code(page_type, create=True)
+                step['model_version'] = [self._code(mv, create=True) for mv in model_versions]
+                step['prob'] = probs
+                step['conversion'] = conversions
+                if shows is not None:
+                    step['shows'] = shows
+                if clicks is not None:
+                    step['clicks'] = clicks
+                f.seek(0, os.SEEK_END)
+                f.write(step.tobytes())
+                f.flush()
+                self.last_timestamp = timestamp
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def records(self):
+        """
+        :return: read-only memmap of all records (re-mapped when the file has grown)
+        """
+        size = os.path.getsize(self.path)
+        if size != self._mmap_size:
+            n = (size - HEADER_SIZE) // HISTORY_DTYPE.itemsize
+            if n == 0:
+                self._mmap = np.zeros(0, dtype=HISTORY_DTYPE)
+            else:
+                self._mmap = np.memmap(self.path, dtype=HISTORY_DTYPE, mode='r',
+                                       offset=HEADER_SIZE, shape=(n,))
+            self._mmap_size = size
+            self._load_keys()
+        return self._mmap
+
+    def _select(self, records, page_type=None, model_version=None):
+        mask = np.ones(len(records), dtype=bool)
+        for field, key in (('page_type', page_type), ('model_version', model_version)):
+            if key is not None:
+                code = self._code(key)
+                if code is None:
+                    return records[:0]
+                mask &= records[field] == code
+        return records[mask] if not mask.all() else records
+
+    def range(self, start=None, end=None, page_type=None, model_version=None):
+        """
+        Records with start <= timestamp < end
+        :return: structured array of HISTORY_DTYPE
+        """
+        records = self.records()
+        timestamps = records['timestamp']
+        lo = 0 if start is None else np.searchsorted(timestamps, start, side='left')
+        hi = len(records) if end is None else np.searchsorted(timestamps, end, side='left')
+        return self._select(records[lo:hi], page_type, model_version)
+
+    def last(self, n, page_type=None, model_version=None):
+        """
+        Last n records (of page_type / model_version if given), oldest first
+        Chunks are scanned backward from the tail until n records match
+        """
+        records = self.records()
+        if page_type is None and model_version is None:
+            return records[max(0, len(records) - n):]
+        parts = []
+        found = 0
+        hi = len(records)
+        while hi > 0 and found < n:
+            lo = max(0, hi - max(LAST_CHUNK, n))
+            selected = self._select(records[lo:hi], page_type, model_version)
+            parts.append(selected)
+            found += len(selected)
+            hi = lo
+        if not parts:
+            return records[:0]
+        selected = np.concatenate(parts[::-1]) if len(parts) > 1 else parts[0]
+        return selected[max(0, len(selected) - n):]
+
+    def arm_series(self, page_type, num):
+        """
+        Last num steps of page_type as a matrix
+        :return: (timestamps, model_versions, probs, conversions),
+            probs and conversions are (steps, arms) arrays, oldest step first,
+            nan where an arm was absent at a step
+        """
+        records = self._select(self.records(), page_type)
+        steps, step_index = np.unique(records['timestamp'], return_inverse=True)
+        first_step = max(0, len(steps) - num)
+        keep = step_index >= first_step
+        records, step_index = records[keep], step_index[keep] - first_step
+        codes, arm_index = np.unique(records['model_version'], return_inverse=True)
+
+        probs = np.full((len(steps) - first_step, len(codes)), np.nan)
+        conversions = np.full_like(probs, np.nan)
+        probs[step_index, arm_index] = records['prob']
+        conversions[step_index, arm_index] = records['conversion']
+        model_versions = [self.key(code) for code in codes]
+        return steps[first_step:], model_versions, probs, conversions
+
+    def previous_weights(self, page_type, num):
+        """
+        As WeightStorage.get_previous_weights: model_version -> list of
+        last num probs, newest first
+        """
+        _, model_versions, probs, _ = self.arm_series(page_type, num)
+        return {
+            model_version: probs[::-1, i][~np.isnan(probs[::-1, i])].tolist()
+            for i, model_version in enumerate(model_versions)
+        }
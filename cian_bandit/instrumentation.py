@@ -0,0 +1,176 @@
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+
+
+class _NullSpan(object):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+_NULL_SPAN = _NullSpan()
+
+
+class NullInstrumentation(object):
+    """
+    Выключенная инструментация (по умолчанию): span и incr ничего не делают
+    """
+    enabled = False
+
+    def span(self, name):
+        return _NULL_SPAN
+
+    def incr(self, name, value=1):
+        pass
+
+
+class _Span(object):
+    def __init__(self, instrumentation, name):
+        self.instrumentation = instrumentation
+        self.name = name
+        self.started = None
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.instrumentation.add_span(self.name, time.perf_counter() - self.started)
+        return False
+
+
+class Instrumentation(object):
+    """
+    Время стадий пайплайна обновления (чтение конфига, загрузка событий,
+    evaluate, пересчёт весов, запись в es) и счётчики (строки событий,
+    обновлённые ручки, ZeroConversion, ретраи записи в es)
+    Значения накапливаются за всё время жизни процесса, выгружаются
+    в текстовый файл prometheus (textfile collector node_exporter) или jsonl
+    Потокобезопасно: update_bandits может работать в пуле потоков
+    """
+    enabled = True
+
+    def __init__(self, clock=time.time):
+        self.clock = clock
+        self._lock = threading.Lock()
+        # name -> [count, seconds]
+        self.spans = OrderedDict()
+        self.counters = OrderedDict()
+
+    def span(self, name):
+        """
+        with instrumentation.span('evaluate'): ...
+        """
+        return _Span(self, name)
+
+    def add_span(self, name, seconds):
+        with self._lock:
+            stats = self.spans.setdefault(name, [0, 0.0])
+            stats[0] += 1
+            stats[1] += seconds
+
+    def incr(self, name, value=1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                'timestamp': self.clock(),
+                'spans': OrderedDict(
+                    (name, {'count': count, 'seconds': seconds})
+                    for name, (count, seconds) in self.spans.items()
+                ),
+                'counters': OrderedDict(self.counters),
+            }
+
+    def to_prometheus(self, prefix='cian_bandit'):
+        snapshot = self.snapshot()
+        lines = [
+            '# TYPE {0}_stage_seconds_total counter'.format(prefix),
+        ]
+        for name, stats in snapshot['spans'].items():
+            lines.append('{0}_stage_seconds_total{{stage="{1}"}} {2!r}'.format(
+                prefix, name, stats['seconds']
+            ))
+        lines.append('# TYPE {0}_stage_runs_total counter'.format(prefix))
+        for name, stats in snapshot['spans'].items():
+            lines.append('{0}_stage_runs_total{{stage="{1}"}} {2}'.format(
+                prefix, name, stats['count']
+            ))
+        for name, value in snapshot['counters'].items():
+            lines.append('# TYPE {0}_{1}_total counter'.format(prefix, name))
+            lines.append('{0}_{1}_total {2}'.format(prefix, name, value))
+        lines.append('# TYPE {0}_last_export_timestamp_seconds gauge'.format(prefix))
+        lines.append('{0}_last_export_timestamp_seconds {1!r}'.format(prefix, snapshot['timestamp']))
+        return '\n'.join(lines) + '\n'
+
+    def write_prometheus(self, path, prefix='cian_bandit'):
+        """
+        Atomic rewrite: the collector never reads a half-written file
+        """
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            f.write(self.to_prometheus(prefix))
+        os.replace(tmp_path, path)
+
+    def append_json_line(self, path):
+        with open(path, 'a') as f:
+            f.write(json.dumps(self.snapshot()) + '\n')
+
+    def export(self, path, fmt='prometheus'):
+        """
+        :param fmt: 'prometheus' or 'jsonl'
+        """
+        if fmt == 'prometheus':
+            self.write_prometheus(path)
+        elif fmt == 'jsonl':
+            self.append_json_line(path)
+        else:
+            raise ValueError('unknown metrics format {0}'.format(fmt))
+
+
+def run_profiled(path, func, *args, **kwargs):
+    """
+    Call func under cProfile and dump pstats to path
+    (python -m pstats path, snakeviz path)
+    Only the calling thread is profiled
+    """
+    import cProfile
+
+    profiler = cProfile.Profile()
+    try:
+        return profiler.runcall(func, *args, **kwargs)
+    finally:
+        profiler.dump_stats(path)
+
+
+_current = NullInstrumentation()
+
+
+def get_instrumentation():
+    return _current
+
+
+def set_instrumentation(instrumentation):
+    """
+    :param instrumentation: Instrumentation, None switches it off
+    :return: previous one
+    """
+    global _current
+    previous = _current
+    _current = instrumentation if instrumentation is not None else NullInstrumentation()
+    return previous
+
+
+def span(name):
+    return _current.span(name)
+
+
+def incr(name, value=1):
+    _current.incr(name, value)
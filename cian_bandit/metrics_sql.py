@@ -1,3 +1,8 @@
+import re
+
+import numpy as np
+
+
 metrics_sql_columns = [
     'model_version',
     'clicks',
@@ -8,18 +13,64 @@ metrics_sql_columns = [
     'phone_bounced'
 ]
 
-metrics_sql = lambda last_events_cnt: """
+# model_version and segment columns: longer values raise presto.ColumnOverflow
+KEY_DTYPE = 'U64'
+
+# typed columns of metrics_sql result for PrestoClient.iter_arrays
+metrics_sql_dtype = np.dtype(
+    [('model_version', KEY_DTYPE)] +
+    [(column, np.int64) for column in metrics_sql_columns[1:]]
+)
+
+
+def check_group_columns(group_columns):
+    """
+    Segment columns go into sql as is: only plain sopr_shows column names
+    """
+    for column in group_columns:
+        if not re.match(r'^[a-z_][a-z0-9_]*$', column) or column in metrics_sql_columns:
+            raise ValueError('bad segment column {0!r}'.format(column))
+    return list(group_columns)
+
+
+def metrics_group_columns(group_columns=()):
+    """
+    Columns of metrics_sql grouped by group_columns: group columns first
+    """
+    return check_group_columns(group_columns) + metrics_sql_columns
+
+
+def metrics_group_dtype(group_columns=()):
+    return np.dtype(
+        [(column, KEY_DTYPE) for column in check_group_columns(group_columns)] +
+        metrics_sql_dtype.descr
+    )
+
+
+def _select_columns(group_columns):
+    return ''.join('{0},\n                '.format(column) for column in group_columns)
+
+
+def metrics_sql(last_events_cnt, group_columns=()):
+    """
+    :param group_columns: sopr_shows columns of segments (region, ...):
+        last_events_cnt events are taken and aggregated
+        per model_version of every segment
+    """
+    group_columns = check_group_columns(group_columns)
+    partition = ', '.join(group_columns + ['model_version'])
+    return """
 -- вытаскиваем действия по каждой модели с номерами 
 -- строк по убыванию даты (первый = самый последний)
 WITH ranked_rows AS (
         SELECT 
-                model_version,
+                {2}model_version,
                 cid,
                 clicked_cnt,
                 phoned_cnt,
                 recommended_dadd,
                 rank() OVER (
-                    PARTITION BY model_version 
+                    PARTITION BY {1} 
                     ORDER BY recommended_dadd DESC) 
                 AS event_order_from_last
         FROM pio_recs.sopr_shows 
@@ -29,7 +80,7 @@ WITH ranked_rows AS (
 -- для каждой модели - самые свежие 
 -- last_events_cnt действий и агрегируем
 SELECT
-        model_version,
+        {3}model_version,
         sum(clicked_cnt) clicks, 
         sum(phoned_cnt) phones, 
         count(*) shows, 
@@ -40,6 +91,82 @@ SELECT
                        then Null else cid end) phone_bounced
 FROM ranked_rows
 WHERE event_order_from_last <= {0}
-GROUP BY model_version
-""".format(str(last_events_cnt))
+GROUP BY {1}
+""".format(
+        str(last_events_cnt),
+        partition,
+        _select_columns(group_columns),
+        ''.join('{0},\n        '.format(column) for column in group_columns),
+    )
+
+
+def metrics_windows_columns(last_events_cnts, group_columns=()):
+    """
+    Columns of metrics_windows_sql: group_columns, model_version, then
+    `metrics_sql_columns` of every window suffixed with _<last_events_cnt>
+    """
+    return check_group_columns(group_columns) + ['model_version'] + [
+        '{0}_{1}'.format(column, cnt)
+        for cnt in last_events_cnts
+        for column in metrics_sql_columns[1:]
+    ]
+
 
+def metrics_windows_dtype(last_events_cnts, group_columns=()):
+    columns = metrics_windows_columns(last_events_cnts, group_columns)
+    keys = len(group_columns) + 1
+    return np.dtype(
+        [(column, KEY_DTYPE) for column in columns[:keys]] +
+        [(column, np.int64) for column in columns[keys:]]
+    )
+
+
+def metrics_windows_sql(last_events_cnts, group_columns=()):
+    """
+    metrics_sql for several windows at once: sopr_shows is scanned
+    and ranked once, every window is a conditional aggregate
+    """
+    group_columns = check_group_columns(group_columns)
+    partition = ', '.join(group_columns + ['model_version'])
+    aggregates = []
+    for cnt in last_events_cnts:
+        in_window = 'event_order_from_last <= {0}'.format(int(cnt))
+        out_of_window = 'event_order_from_last > {0}'.format(int(cnt))
+        aggregates += [
+            'coalesce(sum(case when {0} then clicked_cnt end), 0) clicks_{1}'.format(in_window, cnt),
+            'coalesce(sum(case when {0} then phoned_cnt end), 0) phones_{1}'.format(in_window, cnt),
+            'count(case when {0} then 1 end) shows_{1}'.format(in_window, cnt),
+            'count(distinct case when {0} then cid end) users_{1}'.format(in_window, cnt),
+            'count(distinct case when {0} then Null when clicked_cnt = 0 '
+            'then Null else cid end) click_bounced_{1}'.format(out_of_window, cnt),
+            'count(distinct case when {0} then Null when phoned_cnt = 0 '
+            'then Null else cid end) phone_bounced_{1}'.format(out_of_window, cnt),
+        ]
+    return """
+WITH ranked_rows AS (
+        SELECT 
+                {3}model_version,
+                cid,
+                clicked_cnt,
+                phoned_cnt,
+                recommended_dadd,
+                rank() OVER (
+                    PARTITION BY {2} 
+                    ORDER BY recommended_dadd DESC) 
+                AS event_order_from_last
+        FROM pio_recs.sopr_shows 
+        WHERE ptn_dadd >= current_date - interval '1' day
+)
+
+SELECT
+        {2},
+        {0}
+FROM ranked_rows
+WHERE event_order_from_last <= {1}
+GROUP BY {2}
+""".format(
+        ',\n        '.join(aggregates),
+        int(max(last_events_cnts)),
+        partition,
+        _select_columns(group_columns),
+    )
@@ -0,0 +1,281 @@
+"""
+Microbenchmarks of bandit hot paths
+
+    python -m cian_bandit.microbench                      # run and print
+    python -m cian_bandit.microbench --save benchmarks/baseline.json
+    python -m cian_bandit.microbench --compare benchmarks/baseline.json
+
+Cases are measured in units of a calibration workload run in the same process,
+so a baseline saved on one machine is comparable on another one.
+--compare exits with 1 if any case got slower than baseline by more than --tolerance
+"""
+import argparse
+import json
+import sys
+import time
+from collections import OrderedDict
+
+import numpy as np
+import pandas as pd
+
+from cian_bandit.bandits import HeuristicBandit
+from cian_bandit.bandits import SimpleBandit
+from cian_bandit.bandits import ThompsonBandit
+from cian_bandit.bandits import UCBBandit
+from cian_bandit.contextual import LinUCBBandit
+from cian_bandit.metrics import ClickThroughRate
+from cian_bandit.models import Model
+from cian_bandit.weights_storage import WeightStorage
+
+
+BANDIT_CLASSES = OrderedDict([
+    ('simple', SimpleBandit),
+    ('ucb', UCBBandit),
+    ('thompson', ThompsonBandit),
+    ('heuristic', HeuristicBandit),
+])
+ARM_COUNTS = (2, 20, 200)
+BATCH_ROWS = (1000, 100000)
+QUICK_ARM_COUNTS = (2, 20)
+QUICK_BATCH_ROWS = (1000,)
+# relative times are still noisy (turbo, cache sizes, numpy builds differ)
+DEFAULT_TOLERANCE = 0.5
+
+
+def measure(func, repeat=5, min_seconds=0.05):
+    """
+    Seconds per call: calls are grouped in loops of at least min_seconds,
+    best of repeat loops (as timeit)
+    """
+    number = 1
+    while True:
+        started = time.perf_counter()
+        for _ in range(number):
+            func()
+        elapsed = time.perf_counter() - started
+        if elapsed >= min_seconds or number >= 1 << 20:
+            break
+        number *= 10
+    best = elapsed / number
+    for _ in range(repeat - 1):
+        started = time.perf_counter()
+        for _ in range(number):
+            func()
+        best = min(best, (time.perf_counter() - started) / number)
+    return best
+
+
+def calibration_case(seed=0):
+    """
+    Fixed workload of the kind the cases do (numpy over a batch,
+    python loop over dicts): its time is the unit of results
+    """
+    rng = np.random.default_rng(seed)
+    values = rng.random(10000)
+    arms = rng.integers(0, 20, 10000)
+    rows = [{'clicks': i, 'shows': i + 1} for i in range(200)]
+
+    def calibrate():
+        np.bincount(arms, weights=values, minlength=20)
+        np.sort(values)
+        for row in rows:
+            row['clicks'] * 1.0 / row['shows']
+    return calibrate
+
+
+def make_models(n_arms, page_type='desktop'):
+    return [
+        Model(page_type, str(i), ClickThroughRate(), str(i))
+        for i in range(n_arms)
+    ]
+
+
+def make_batch(n_arms, n_rows, seed=0, page_type='desktop'):
+    """
+    n_rows event-level rows spread over n_arms arms
+    """
+    rng = np.random.default_rng(seed)
+    model_versions = rng.integers(0, n_arms, n_rows).astype(str)
+    return pd.DataFrame({
+        'page_type': page_type,
+        'model_version': model_versions,
+        'clicks': rng.binomial(1, 0.05, n_rows),
+        'shows': np.ones(n_rows, dtype=np.int64),
+    })
+
+
+class _MemoryEs(object):
+    """
+    es client stand-in: docs go through json as they would over http
+    """
+    def __init__(self, source):
+        self.last = json.dumps(source)
+
+    def search(self, **kwargs):
+        return {'hits': {'hits': [{'_source': json.loads(self.last)}]}}
+
+    def create(self, body, **kwargs):
+        self.last = json.dumps(body)
+
+
+def make_weight_storage(n_arms):
+    section = {
+        str(i): {
+            'prob': 1.0 / n_arms,
+            'conversion': 0.05,
+            'parameters': {
+                'es_index': 'item_correlations_desktop_alias',
+                'must_not_fields': ['phone'],
+                'item_boost': 1.0,
+                'last_history_views': 20,
+                'last_history_phones': 20,
+            },
+        }
+        for i in range(n_arms)
+    }
+    storage = WeightStorage(hosts=['localhost'], cache_ttl=0)
+    storage.es_client = _MemoryEs({'desktop': section, 'mobile': {}, 'config_version': 1})
+    return storage, section
+
+
+def cases(arm_counts=ARM_COUNTS, batch_rows=BATCH_ROWS):
+    """
+    :return: OrderedDict case name -> callable
+    """
+    result = OrderedDict()
+    for n_arms in arm_counts:
+        for n_rows in batch_rows:
+            bandit = SimpleBandit('desktop', make_models(n_arms), min_weight=0.05)
+            batch = make_batch(n_arms, n_rows)
+            result['evaluate_batch/arms={0}/rows={1}'.format(n_arms, n_rows)] = (
+                lambda bandit=bandit, batch=batch: bandit.evaluate_batch(batch)
+            )
+
+        for n_rows in batch_rows:
+            # time per event must not grow with the batch: compare rows cases
+            linucb = LinUCBBandit('desktop', make_models(n_arms), n_features=4)
+            rng = np.random.default_rng(0)
+            events = (
+                rng.integers(0, n_arms, n_rows).astype(str),
+                rng.random((n_rows, 4)),
+                rng.random(n_rows) < 0.05,
+            )
+            result['LinUCBBandit.update/arms={0}/rows={1}'.format(n_arms, n_rows)] = (
+                lambda linucb=linucb, events=events: linucb.update(*events)
+            )
+
+        aggregated = make_batch(n_arms, 10000 * n_arms).groupby(
+            ['page_type', 'model_version'], as_index=False
+        ).sum()
+        for name, bandit_cls in BANDIT_CLASSES.items():
+            bandit = bandit_cls('desktop', make_models(n_arms), min_weight=0.05)
+            bandit.evaluate_batch(aggregated)
+            result['recalc_models_weights/{0}/arms={1}'.format(name, n_arms)] = bandit.recalc_models_weights
+
+        metrics = [ClickThroughRate() for _ in range(n_arms)]
+        rows = aggregated.to_dict('records')
+
+        def add_batches(metrics=metrics, rows=rows):
+            for metric, row in zip(metrics, rows):
+                metric.add_batch(row, 10000)
+        result['ClickThroughRate.add_batch/arms={0}'.format(n_arms)] = add_batches
+
+        storage, section = make_weight_storage(n_arms)
+        models = {model.model_version: model for model in make_models(n_arms)}
+        for model in models.values():
+            model.weight = 1.0 / n_arms
+            model.metric.value = 0.05
+        result['WeightStorage.config_doc/arms={0}'.format(n_arms)] = (
+            lambda storage=storage, models=models, section=section:
+            storage.update_page_type_models_weights('desktop', models, section)
+        )
+    return result
+
+
+def run(arm_counts=ARM_COUNTS, batch_rows=BATCH_ROWS, repeat=5, min_seconds=0.05, names=None):
+    """
+    :param names: substrings, run only cases matching any of them
+    :return: OrderedDict case name -> seconds per call
+    """
+    results = OrderedDict()
+    for name, func in cases(arm_counts, batch_rows).items():
+        if names and not any(part in name for part in names):
+            continue
+        results[name] = measure(func, repeat=repeat, min_seconds=min_seconds)
+    return results
+
+
+def calibrate(repeat=5, min_seconds=0.05):
+    """
+    :return: seconds per call of calibration_case
+    """
+    return measure(calibration_case(), repeat=repeat, min_seconds=min_seconds)
+
+
+def relative(results, unit):
+    """
+    :return: OrderedDict case name -> time in units of calibration
+    """
+    return OrderedDict((name, seconds / unit) for name, seconds in results.items())
+
+
+def compare(results, baseline, tolerance=DEFAULT_TOLERANCE):
+    """
+    :param results, baseline: dicts case name -> relative time
+    :return: list of (case name, baseline, result) slower than
+        baseline * (1 + tolerance); cases missing in baseline are skipped
+    """
+    return [
+        (name, baseline[name], seconds)
+        for name, seconds in results.items()
+        if name in baseline and seconds > baseline[name] * (1 + tolerance)
+    ]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='bandit hot paths microbenchmarks')
+    parser.add_argument('--quick', action='store_true', help='small arm counts and batches only')
+    parser.add_argument('--filter', action='append', help='run cases containing this substring')
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--save', type=str, help='write results as a new baseline')
+    parser.add_argument('--compare', type=str, help='baseline json to check for regressions')
+    parser.add_argument('--tolerance', type=float, default=DEFAULT_TOLERANCE)
+    args = parser.parse_args(argv)
+
+    if args.quick:
+        arm_counts, batch_rows = QUICK_ARM_COUNTS, QUICK_BATCH_ROWS
+    else:
+        arm_counts, batch_rows = ARM_COUNTS, BATCH_ROWS
+    # calibration before and after the cases: the faster one is the unit
+    unit = calibrate(repeat=args.repeat)
+    results = run(arm_counts, batch_rows, repeat=args.repeat, names=args.filter)
+    unit = min(unit, calibrate(repeat=args.repeat))
+    ratios = relative(results, unit)
+
+    baseline = {}
+    if args.compare is not None:
+        with open(args.compare, 'r') as f:
+            saved = json.load(f)
+        if 'relative' not in saved:
+            raise ValueError('{0} has absolute timings, save it again'.format(args.compare))
+        baseline = saved['relative']
+    print('{0:<50} {1:>12.1f} us'.format('calibration', unit * 1e6))
+    for name, seconds in results.items():
+        line = '{0:<50} {1:>12.1f} us {2:>10.3f} units'.format(name, seconds * 1e6, ratios[name])
+        if name in baseline:
+            line += '  x{0:.2f}'.format(ratios[name] / baseline[name])
+        print(line)
+
+    if args.save is not None:
+        with open(args.save, 'w') as f:
+            json.dump({'relative': ratios}, f, indent=2)
+            f.write('\n')
+
+    regressions = compare(ratios, baseline, args.tolerance)
+    for name, before, after in regressions:
+        print('REGRESSION {0}: {1:.3f} -> {2:.3f} units'.format(name, before, after))
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
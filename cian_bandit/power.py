@@ -0,0 +1,102 @@
+import math
+from statistics import NormalDist
+
+import numpy as np
+import pandas as pd
+
+
+def required_events(ctr, other_ctr, alpha=0.05, power=0.8):
+    """
+    Events per arm for a two-sided two-proportion z-test to tell
+    ctr from other_ctr with significance alpha and given power
+    :param ctr: float or np.array
+    :return: np.array, inf where CTRs are equal
+    """
+    ctr = np.asarray(ctr, dtype=float)
+    other_ctr = np.asarray(other_ctr, dtype=float)
+    z_alpha = NormalDist().inv_cdf(1 - alpha / 2)
+    z_power = NormalDist().inv_cdf(power)
+    ctr_mean = (ctr + other_ctr) / 2
+    pooled = z_alpha * np.sqrt(2 * ctr_mean * (1 - ctr_mean))
+    separate = z_power * np.sqrt(ctr * (1 - ctr) + other_ctr * (1 - other_ctr))
+    gap = np.abs(ctr - other_ctr)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        n = (pooled + separate) ** 2 / (gap * gap)
+    return np.where(gap > 0, np.ceil(n), math.inf)
+
+
+def default_windows(last_events_cnt):
+    """
+    Candidate windows up to last_events_cnt
+    """
+    return sorted({max(1, last_events_cnt // 10), max(1, last_events_cnt // 5),
+                   max(1, last_events_cnt // 2), last_events_cnt})
+
+
+def _choose_arms_windows(largest, windows, alpha, power):
+    """
+    :param largest: arms of one bandit in the largest window
+    :return: list of windows, one per row of largest, the same for all rows
+    """
+    if len(largest) < 2:
+        return [windows[-1]] * len(largest)
+
+    ctrs = np.asarray(largest['clicks'], dtype=float) / np.maximum(
+        1, np.asarray(largest['shows'], dtype=float)
+    )
+    order = np.argsort(ctrs)
+    reference = np.full(len(ctrs), ctrs[order[-1]])
+    reference[order[-1]] = ctrs[order[-2]]
+    needed = required_events(ctrs, reference, alpha=alpha, power=power)
+
+    candidates = np.array(windows, dtype=float)
+    # first candidate covering needed events, the largest one if none does
+    chosen = np.minimum(np.searchsorted(candidates, needed), len(windows) - 1)
+    # one window for all arms of the bandit: UCB bonus 2ln(events_cnt)/shows
+    # and smoothing would favour arms of shorter windows otherwise
+    return [windows[chosen.max()]] * len(largest)
+
+
+def arm_keys(batch, group_columns=()):
+    """
+    model_version of every row, (segment values..., model_version) with group_columns
+    """
+    if not group_columns:
+        return list(batch['model_version'])
+    return list(zip(*[batch[column] for column in list(group_columns) + ['model_version']]))
+
+
+def choose_windows(batches, alpha=0.05, power=0.8, group_columns=()):
+    """
+    Window of a bandit: the smallest candidate with enough events to tell
+    its leader from the runner-up, shared by all arms of the bandit
+    CTRs are estimated on the largest window
+    :param batches: dict last_events_cnt -> batch with `metrics_sql_columns`
+    :param group_columns: segment columns, a segment is a bandit with its own window
+    :return: dict arm_keys -> last_events_cnt
+    """
+    windows = sorted(batches)
+    largest = batches[windows[-1]]
+    if not group_columns:
+        chosen = _choose_arms_windows(largest, windows, alpha, power)
+    else:
+        chosen = [None] * len(largest)
+        for rows in largest.groupby(list(group_columns)).indices.values():
+            segment_windows = _choose_arms_windows(largest.iloc[rows], windows, alpha, power)
+            for row, cnt in zip(rows, segment_windows):
+                chosen[row] = cnt
+    return dict(zip(arm_keys(largest, group_columns), chosen))
+
+
+def adaptive_batch(batches, alpha=0.05, power=0.8, group_columns=()):
+    """
+    Batch with every bandit (page_type or segment) aggregated over its own window
+    :return: (batch, dict arm_keys -> last_events_cnt)
+    """
+    chosen = choose_windows(batches, alpha=alpha, power=power, group_columns=group_columns)
+    parts = []
+    for cnt, batch in sorted(batches.items()):
+        in_window = [chosen.get(key) == cnt for key in arm_keys(batch, group_columns)]
+        parts.append(batch[in_window])
+    batch = pd.concat(parts, ignore_index=True)
+    return batch, chosen
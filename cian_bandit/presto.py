@@ -3,9 +3,14 @@
 под python2. Нужно разобраться с импортом hive_conf
 to be deleted/
 """
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
 from contextlib import closing
 from pyhive import presto
+import numpy as np
 import pandas as pd
+import requests
+import threading
 #from py_common.hive_conf import presto_config
 # want to run locally without py_common
 
@@ -18,6 +23,9 @@ presto_config = {
 
 
 def set_username(username):
+    """
+    deprecated: mutates global config, not thread safe, use PrestoClient
+    """
     presto_config["username"] = username
 
 
@@ -32,6 +40,157 @@ def run_sql(sql_body, rs=True):
             if rs:
                 return presto_cursor.fetchall()
 
+
+class ColumnOverflow(Exception):
+    pass
+
+
+def _max_chars(dtype):
+    """
+    :return: length of fixed-size string dtype, None for other dtypes
+    """
+    if dtype.kind == 'U':
+        return dtype.itemsize // 4
+    if dtype.kind == 'S':
+        return dtype.itemsize
+    return None
+
+
+def fill_columns(buffer, rows):
+    """
+    Write fetched rows into structured array buffer column by column
+    null values become zeros (empty strings)
+    :raise ColumnOverflow: a string is longer than its field (numpy would truncate it)
+    """
+    for i, name in enumerate(buffer.dtype.names):
+        column = buffer[name]
+        default = column.dtype.type()
+        values = [default if row[i] is None else row[i] for row in rows]
+        max_chars = _max_chars(column.dtype)
+        if max_chars is not None:
+            too_long = [value for value in values if len(value) > max_chars]
+            if too_long:
+                raise ColumnOverflow('{0} value {1!r} is longer than {2} chars'.format(
+                    name, too_long[0], max_chars
+                ))
+        column[:len(rows)] = values
+
+
+class PrestoClient(object):
+    """
+    Presto клиент без глобального состояния:
+    credentials задаются клиенту (или отдельному вызову),
+    http-соединения переиспользуются из пула общей requests.Session,
+    одновременно выполняется не больше pool_size запросов
+    run_sql - синхронно, run_sql_async / as_completed / run_many - из asyncio
+    """
+    def __init__(self, username, host=None, port=None, catalog=None, pool_size=4):
+        self.config = {
+            'host': host or presto_config['host'],
+            'port': port or presto_config['port'],
+            'username': username,
+            'catalog': catalog or presto_config['catalog'],
+        }
+        self.pool_size = pool_size
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(
+            pool_connections=1,
+            pool_maxsize=pool_size,
+        )
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self._slots = threading.BoundedSemaphore(pool_size)
+        self._executor = ThreadPoolExecutor(max_workers=pool_size)
+
+    def get_connection(self, username=None):
+        config = dict(self.config)
+        if username is not None:
+            config['username'] = username
+        return presto.connect(requests_session=self.session, **config)
+
+    def run_sql(self, sql_body, rs=True, username=None):
+        with self._slots:
+            with closing(self.get_connection(username)) as presto_conn:
+                with closing(presto_conn.cursor()) as presto_cursor:
+                    presto_cursor.execute(sql_body)
+                    if rs:
+                        return presto_cursor.fetchall()
+
+    def iter_arrays(self, sql_body, dtype, arraysize=10000, username=None):
+        """
+        Stream result with fetchmany into one preallocated numpy structured array
+        Memory is bounded by arraysize rows whatever the result size
+        :param dtype: np.dtype with fields in select order (e.g. metrics_sql_dtype)
+        :return: iterator of structured arrays, views of the same buffer:
+            copy a chunk to keep it after the next one is fetched
+        """
+        dtype = np.dtype(dtype)
+        buffer = np.zeros(arraysize, dtype=dtype)
+        with self._slots:
+            with closing(self.get_connection(username)) as presto_conn:
+                with closing(presto_conn.cursor()) as presto_cursor:
+                    presto_cursor.arraysize = arraysize
+                    presto_cursor.execute(sql_body)
+                    while True:
+                        rows = presto_cursor.fetchmany(arraysize)
+                        if not rows:
+                            break
+                        fill_columns(buffer, rows)
+                        yield buffer[:len(rows)]
+
+    def fetch_arrays(self, sql_body, dtype, arraysize=10000, username=None):
+        """
+        Whole result as a structured array without materializing python tuples
+        :return: np.array of dtype
+        """
+        dtype = np.dtype(dtype)
+        result = np.zeros(arraysize, dtype=dtype)
+        size = 0
+        for chunk in self.iter_arrays(sql_body, dtype, arraysize, username):
+            if size + len(chunk) > len(result):
+                grown = np.zeros(max(2 * len(result), size + len(chunk)), dtype=dtype)
+                grown[:size] = result[:size]
+                result = grown
+            result[size:size + len(chunk)] = chunk
+            size += len(chunk)
+        return result[:size]
+
+    async def run_sql_async(self, sql_body, rs=True, username=None):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            self._executor,
+            lambda: self.run_sql(sql_body, rs=rs, username=username),
+        )
+
+    async def as_completed(self, queries, username=None):
+        """
+        Run queries concurrently, yield results as soon as they are ready
+        :param queries: dict key -> sql
+        :return: async iterator of (key, rows)
+        """
+        async def run(key, sql_body):
+            return key, await self.run_sql_async(sql_body, username=username)
+
+        tasks = [run(key, sql_body) for key, sql_body in queries.items()]
+        for task in asyncio.as_completed(tasks):
+            yield await task
+
+    def run_many(self, queries, username=None):
+        """
+        Blocking helper: run queries concurrently
+        :param queries: dict key -> sql
+        :return: dict key -> rows
+        """
+        async def collect():
+            return {key: rows async for key, rows in self.as_completed(queries, username)}
+
+        return asyncio.run(collect())
+
+    def close(self):
+        self._executor.shutdown(wait=True)
+        self.session.close()
+
+
 """
 /to be deleted
 and replaced with
@@ -0,0 +1,99 @@
+from collections import OrderedDict
+
+import numpy as np
+
+
+class UnknownReward(Exception):
+    pass
+
+
+class MissingRewardColumn(Exception):
+    pass
+
+
+# reward -> (numerator, denominator) columns of metrics_sql batch
+REWARDS = OrderedDict([
+    # clicks per show
+    ('ctr', ('clicks', 'shows')),
+    # phone calls per show
+    ('phone_conversion', ('phones', 'shows')),
+    # clicks per user who saw recommendations: not a probability,
+    # several clicks of one user make it > 1
+    ('user_ctr', ('clicks', 'users')),
+    # clicking users per show: repeated clicks of one user
+    # (clicked, bounced back, clicked again) are counted once
+    ('bounce_adjusted_ctr', ('click_bounced', 'shows')),
+    # calling users per user
+    ('user_phone_conversion', ('phone_bounced', 'users')),
+])
+
+
+class CompositeReward(object):
+    """
+    Взвешенная сумма нескольких наград по одному батчу:
+    objective = sum_k w_k * numerator_k / denominator_k по каждой ручке
+    Нужные колонки суммируются по ручкам один раз (bincount по каждой колонке),
+    все награды считаются из этих сумм векторно
+    В models_config.json: "rewards": {"desktop": {"ctr": 0.7, "phone_conversion": 0.3}}
+    Бонус UCB считается в масштабе вероятности (CTR), а objective - в масштабе
+    суммы w_k * награда_k: user_ctr бывает больше 1, и с весом 1 бонус
+    исследования для него относительно меньше, чем для ctr; чтобы сохранить
+    исследование, вес user_ctr делят на типичное число кликов на пользователя
+    Награду считают все пути загрузки бандита (батч, записи, инкременты);
+    если нужной колонки нет, бросается MissingRewardColumn
+    """
+    def __init__(self, weights):
+        """
+        :param weights: dict reward name -> weight in objective
+        """
+        unknown = [name for name in weights if name not in REWARDS]
+        if unknown:
+            raise UnknownReward('unknown rewards {0}, known: {1}'.format(unknown, list(REWARDS)))
+        self.weights = OrderedDict(weights)
+        self.columns = []
+        for name in self.weights:
+            for column in REWARDS[name]:
+                if column not in self.columns:
+                    self.columns.append(column)
+
+    @classmethod
+    def from_config(cls, config, page_type):
+        """
+        :return: CompositeReward of page_type from models config,
+            None if page_type has no rewards (plain CTR)
+        """
+        weights = config.get('rewards', {}).get(page_type)
+        if not weights:
+            return None
+        return cls(weights)
+
+    def check_columns(self, available):
+        """
+        :raise MissingRewardColumn: objective needs columns missing from available
+        """
+        missing = [column for column in self.columns if column not in available]
+        if missing:
+            raise MissingRewardColumn('rewards {0} need columns {1}'.format(
+                list(self.weights), missing
+            ))
+
+    def evaluate(self, arms, columns, n_arms):
+        """
+        :param arms: arm index (0..n_arms-1) of every row
+        :param columns: dict column -> array, rows aligned with arms
+        :return: (dict reward name -> per-arm values, per-arm objective),
+            arms without denominator get 0
+        """
+        totals = {
+            column: np.bincount(arms, weights=np.asarray(columns[column], dtype=float), minlength=n_arms)
+            for column in self.columns
+        }
+        rewards = OrderedDict()
+        objective = np.zeros(n_arms)
+        for name, weight in self.weights.items():
+            numerator, denominator = REWARDS[name]
+            with np.errstate(divide='ignore', invalid='ignore'):
+                value = totals[numerator] / totals[denominator]
+            rewards[name] = np.where(totals[denominator] > 0, value, 0.0)
+            objective += weight * rewards[name]
+        return rewards, objective
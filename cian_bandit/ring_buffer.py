@@ -0,0 +1,116 @@
+import numpy as np
+
+
+class ArmsRingBuffer(object):
+    """
+    Кольцевой буфер последних capacity значений каждой ручки
+    (строка = шаг бандита, столбец = ручка)
+    Суммы, суммы квадратов и произведения с опорной ручкой по окну
+    поддерживаются инкрементально: push стоит O(arms)
+    Раз в capacity шагов суммы пересчитываются заново, чтобы не копилась
+    ошибка округления
+    """
+    def __init__(self, capacity, n_arms):
+        self.capacity = capacity
+        self.n_arms = n_arms
+        self.values = np.zeros((capacity, n_arms))
+        self.pos = 0
+        self.count = 0
+        self.ref = None
+        self._resync()
+
+    def __len__(self):
+        return self.count
+
+    def _filled(self):
+        return self.values[:self.count]
+
+    def _resync(self):
+        filled = self._filled()
+        self.sum = filled.sum(axis=0)
+        self.sumsq = (filled * filled).sum(axis=0)
+        if self.ref is None:
+            self.cross = np.zeros(self.n_arms)
+        else:
+            self.cross = (filled * filled[:, self.ref:self.ref + 1]).sum(axis=0)
+
+    def push(self, row):
+        row = np.asarray(row, dtype=float)
+        if self.count == self.capacity:
+            old = self.values[self.pos]
+            self.sum -= old
+            self.sumsq -= old * old
+            if self.ref is not None:
+                self.cross -= old * old[self.ref]
+        else:
+            self.count += 1
+        self.values[self.pos] = row
+        self.sum += row
+        self.sumsq += row * row
+        if self.ref is not None:
+            self.cross += row * row[self.ref]
+        self.pos = (self.pos + 1) % self.capacity
+        if self.pos == 0:
+            self._resync()
+
+    def last(self):
+        if self.count == 0:
+            return None
+        return self.values[(self.pos - 1) % self.capacity]
+
+    def window(self):
+        """
+        :return: (count, n_arms) array, oldest row first
+        """
+        if self.count < self.capacity:
+            return self._filled().copy()
+        return np.roll(self.values, -self.pos, axis=0)
+
+    def mean(self):
+        return self.sum / max(1, self.count)
+
+    def set_reference(self, ref):
+        if ref != self.ref:
+            self.ref = ref
+            self._resync()
+
+    def paired_ttest(self, ref):
+        """
+        Paired t-test of every arm against arm ref over the window
+        (two-sided, as scipy.stats.ttest_rel)
+        :return: array of p-values, 1.0 for ref itself
+        """
+        # scipy is heavy to import and needed only here
+        from scipy.special import stdtr
+
+        self.set_reference(ref)
+        n = self.count
+        if n < 2:
+            return np.ones(self.n_arms)
+        d_mean = (self.sum[ref] - self.sum) / n
+        d_sq = (self.sumsq[ref] + self.sumsq - 2 * self.cross) / n
+        d_var = np.maximum(d_sq - d_mean * d_mean, 0.0) * n / (n - 1)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            t = d_mean / np.sqrt(d_var / n)
+        pvalues = 2 * stdtr(n - 1, -np.abs(t))
+        # constant difference: identical arms or certainly different ones
+        pvalues = np.where(np.isnan(t), 1.0, pvalues)
+        pvalues[ref] = 1.0
+        return pvalues
+
+    def to_arrays(self, prefix):
+        return {
+            prefix + 'values': self.values,
+            prefix + 'pos': np.array(self.pos),
+            prefix + 'count': np.array(self.count),
+        }
+
+    @classmethod
+    def from_arrays(cls, arrays, prefix):
+        values = arrays[prefix + 'values']
+        buf = cls(values.shape[0], values.shape[1])
+        buf.values = np.array(values, dtype=float)
+        buf.pos = int(arrays[prefix + 'pos'])
+        buf.count = int(arrays[prefix + 'count'])
+        buf._resync()
+        return buf
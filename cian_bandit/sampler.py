@@ -0,0 +1,143 @@
+import random
+import threading
+
+import numpy as np
+
+from cian_bandit.bandit_updater import config_page_types
+
+
+class NoWeightsForPageType(Exception):
+    pass
+
+
+class AliasTable(object):
+    """
+    Walker alias table (Vose construction): O(n) build, O(1) draw
+    Раскладываем n ручек на n ячеек одинаковой ширины, в каждой ячейке
+    не больше двух ручек: своя с вероятностью prob[i] и alias[i]
+    """
+    def __init__(self, model_versions, weights):
+        weights = np.asarray(weights, dtype=float)
+        weights = np.where(np.isnan(weights) | (weights < 0), 0.0, weights)
+        norm = weights.sum()
+        if len(weights) == 0 or norm <= 0:
+            raise NoWeightsForPageType('no positive weights to sample from')
+
+        n = len(weights)
+        scaled = weights * n / norm
+        prob = np.ones(n)
+        alias = np.arange(n)
+        small = [i for i in range(n) if scaled[i] < 1.0]
+        large = [i for i in range(n) if scaled[i] >= 1.0]
+        scaled = scaled.tolist()
+        while small and large:
+            s = small.pop()
+            l = large.pop()
+            prob[s] = scaled[s]
+            alias[s] = l
+            scaled[l] = scaled[l] + scaled[s] - 1.0
+            if scaled[l] < 1.0:
+                small.append(l)
+            else:
+                large.append(l)
+        # leftovers are 1.0 up to rounding errors
+
+        self.n = n
+        self.model_versions = np.asarray(model_versions, dtype=object)
+        self.prob = prob
+        self.alias = alias
+        # python lists for the single draw path: no numpy scalar overhead
+        self._versions = list(model_versions)
+        self._prob = prob.tolist()
+        self._alias_versions = [self._versions[a] for a in alias.tolist()]
+        self._rng = np.random.default_rng()
+
+    def choice(self, rand=random.random):
+        u = rand() * self.n
+        i = int(u)
+        if u - i < self._prob[i]:
+            return self._versions[i]
+        return self._alias_versions[i]
+
+    def sample(self, n, rng=None):
+        """
+        :param rng: np.random.Generator, own generator by default
+        :return: np.array of n model_versions
+        """
+        if rng is None:
+            rng = self._rng
+        u = rng.random(n) * self.n
+        i = u.astype(np.int64)
+        own = (u - i) < self.prob[i]
+        return self.model_versions[np.where(own, i, self.alias[i])]
+
+
+class WeightSampler(object):
+    """
+    In-process выбор model_version по весам из конфига бандита
+    Таблицы строятся один раз на config_version и подменяются целиком
+    одним присваиванием, так что читатели никогда не видят полуобновлённое состояние
+    Обращения к Elasticsearch только в refresh(), не на каждый запрос
+    """
+    def __init__(self, weights_storage=None, config_doc=None):
+        self.weights_storage = weights_storage
+        self.config_version = None
+        self._tables = {}
+        self._lock = threading.Lock()
+        if config_doc is not None:
+            self.load(config_doc)
+
+    @staticmethod
+    def _build_tables(source):
+        tables = {}
+        # service sections (rewards, segments pointer) are not page_types
+        for page_type in config_page_types(source):
+            models = source[page_type]
+            if len(models) == 0:
+                continue
+            model_versions = list(models)
+            weights = [models[mv].get('prob') for mv in model_versions]
+            weights = [np.nan if w is None else w for w in weights]
+            try:
+                tables[page_type] = AliasTable(model_versions, weights)
+            except NoWeightsForPageType:
+                continue
+        return tables
+
+    def load(self, config_doc):
+        """
+        :param config_doc: es hit from WeightStorage.get_last_config_doc or its `_source`
+        :return: True if tables were swapped
+        """
+        source = config_doc.get('_source', config_doc)
+        version = source.get('config_version')
+        with self._lock:
+            if version is not None and version == self.config_version:
+                return False
+            tables = self._build_tables(source)
+            self._tables = tables
+            self.config_version = version
+        return True
+
+    def refresh(self):
+        """
+        Read last config doc from weights storage, rebuild tables if config_version changed
+        """
+        return self.load(self.weights_storage.get_last_config_doc())
+
+    def _table(self, page_type):
+        table = self._tables.get(page_type)
+        if table is None:
+            raise NoWeightsForPageType(
+                'no weights for page_type {0} in config version {1}'.format(
+                    page_type,
+                    self.config_version,
+                )
+            )
+        return table
+
+    def choice(self, page_type):
+        return self._table(page_type).choice()
+
+    def sample(self, page_type, n, rng=None):
+        return self._table(page_type).sample(n, rng=rng)
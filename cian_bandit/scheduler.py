@@ -0,0 +1,119 @@
+import fcntl
+import json
+import logging
+import os
+import random
+import signal
+import threading
+import time
+
+from cian_bandit import instrumentation
+
+info_logger = logging.getLogger('info_logger')
+
+
+class AlreadyRunning(Exception):
+    pass
+
+
+class ConfigWatcher(object):
+    """
+    models_config.json, перечитываемый при изменении mtime файла
+    Битый json не роняет демона: остаётся предыдущий конфиг
+    """
+    def __init__(self, path):
+        self.path = path
+        self.mtime = None
+        self.config = None
+
+    def get(self):
+        mtime = os.stat(self.path).st_mtime
+        if mtime != self.mtime:
+            try:
+                with instrumentation.span('config_read'), open(self.path, 'r') as f:
+                    config = json.load(f)
+            except ValueError as e:
+                if self.config is None:
+                    raise
+                logging.warning('bad config %s, keep previous one: %s', self.path, e)
+                return self.config
+            if self.mtime is not None:
+                info_logger.info('reloaded %s', self.path)
+            self.mtime = mtime
+            self.config = config
+        return self.config
+
+
+class ProcessLock(object):
+    """
+    Non-blocking flock: a cron launch and a daemon never update at the same time
+    """
+    def __init__(self, path):
+        self.path = path
+        self._file = None
+
+    def __enter__(self):
+        self._file = open(self.path, 'w')
+        try:
+            fcntl.flock(self._file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError:
+            self._file.close()
+            self._file = None
+            raise AlreadyRunning('{0} is locked by another process'.format(self.path))
+        return self
+
+    def __exit__(self, *exc_info):
+        fcntl.flock(self._file, fcntl.LOCK_UN)
+        self._file.close()
+        self._file = None
+
+
+class IntervalScheduler(object):
+    """
+    Запускает job каждые interval секунд (+ случайный jitter) в одном потоке
+    Запуски не перекрываются: если job работал дольше interval,
+    пропущенные тики не догоняются, следующий запуск - по расписанию
+    Ошибка job логируется и не останавливает демона
+    SIGTERM/SIGINT: текущий запуск доделывается, затем выход
+    """
+    def __init__(self, interval, jitter=0.0, clock=time.time, wait=None):
+        """
+        :param wait: callable(seconds) between runs, waiting on stop() by default
+            (tests pass a fake one along with a fake clock)
+        """
+        self.interval = interval
+        self.jitter = jitter
+        self.clock = clock
+        self.stopped = threading.Event()
+        self.wait = wait if wait is not None else self.stopped.wait
+        self.runs = 0
+        self.failures = 0
+
+    def stop(self, *args):
+        self.stopped.set()
+
+    def install_signal_handlers(self):
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+
+    def run(self, job, max_runs=None):
+        next_run = self.clock()
+        while not self.stopped.is_set():
+            if max_runs is not None and self.runs >= max_runs:
+                break
+            try:
+                job()
+            except Exception:
+                self.failures += 1
+                logging.exception('scheduled update failed')
+            self.runs += 1
+
+            now = self.clock()
+            next_run += self.interval
+            if next_run < now:
+                skipped = int((now - next_run) // self.interval) + 1
+                info_logger.warning('update took longer than interval, skipped %d ticks', skipped)
+                next_run += skipped * self.interval
+            delay = next_run - now + random.uniform(0.0, self.jitter)
+            # default wait wakes up at once on stop()
+            self.wait(max(0.0, delay))
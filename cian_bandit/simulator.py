@@ -0,0 +1,143 @@
+import time
+
+import numpy as np
+import pandas as pd
+
+from cian_bandit.bandits import ZeroConversion
+from cian_bandit.metrics import ClickThroughRate
+from cian_bandit.models import Model
+
+
+class TrafficSimulator(object):
+    """
+    Офлайн-симуляция трафика для бандитов с интерфейсом
+    evaluate_columns / recalc_models_weights / get_models_weights
+    Раунд = пересчёт бандита: batch_size показов распределяются по текущим весам,
+    клики ~ Binomial(shows, ctr), в бандит отдаётся агрегат последних
+    window_rounds раундов (как окно последних событий в metrics_sql)
+    CTR может дрейфовать: drift - изменение CTR ручки за раунд
+    Regret считается в ожидании: sum(shows_i * (max ctr - ctr_i))
+    """
+    def __init__(self, true_ctrs, batch_size=10000, window_rounds=5, drift=None,
+                 page_type='desktop', seed=None):
+        """
+        :param true_ctrs: dict model_version -> initial CTR
+        :param drift: dict model_version -> CTR change per round
+        """
+        self.model_versions = list(true_ctrs)
+        self.true_ctrs = np.array([true_ctrs[mv] for mv in self.model_versions], dtype=float)
+        self.drift = np.zeros(len(self.model_versions))
+        if drift is not None:
+            self.drift = np.array([drift.get(mv, 0.0) for mv in self.model_versions], dtype=float)
+        self.batch_size = batch_size
+        self.window_rounds = window_rounds
+        self.page_type = page_type
+        self.seed = seed
+
+    @classmethod
+    def from_logged_ctrs(cls, batch, page_type='desktop', **kwargs):
+        """
+        Simulator whose true CTRs are CTRs of a logged metrics batch (metrics_sql_columns)
+        Not a replay: traffic is still simulated (shows by current weights,
+        Binomial clicks), logged events only fix the CTR of every arm
+        """
+        batch = batch[batch['page_type'] == page_type] if 'page_type' in batch else batch
+        true_ctrs = {
+            model_version: clicks * 1.0 / max(1, shows)
+            for model_version, clicks, shows in zip(
+                batch['model_version'], batch['clicks'], batch['shows']
+            )
+        }
+        return cls(true_ctrs, page_type=page_type, **kwargs)
+
+    def make_models(self, metric_factory=ClickThroughRate):
+        return [
+            Model(
+                page_type=self.page_type,
+                model_version=model_version,
+                metric=metric_factory(),
+                name=model_version,
+            )
+            for model_version in self.model_versions
+        ]
+
+    def ctrs(self, round_num):
+        return np.clip(self.true_ctrs + self.drift * round_num, 0.0, 1.0)
+
+    def run(self, bandit, rounds):
+        """
+        :param bandit: bandit over self.make_models()
+        :return: dict with cumulative_regret (per round), convergence_round,
+            rounds_per_second, events_per_second, weights (per round)
+        """
+        rng = np.random.default_rng(self.seed)
+        n_arms = len(self.model_versions)
+        weights = np.full(n_arms, 1.0 / n_arms)
+        window_clicks = np.zeros((self.window_rounds, n_arms))
+        window_shows = np.zeros((self.window_rounds, n_arms))
+        regret = np.zeros(rounds)
+        weights_history = np.zeros((rounds, n_arms))
+        best_history = np.zeros(rounds, dtype=bool)
+        # columns for evaluate_columns: no DataFrame per round
+        columns = {'model_version': np.array(self.model_versions)}
+
+        started = time.time()
+        for round_num in range(rounds):
+            ctrs = self.ctrs(round_num)
+            shows = rng.multinomial(self.batch_size, weights)
+            clicks = rng.binomial(shows, ctrs)
+            regret[round_num] = np.dot(shows, ctrs.max() - ctrs)
+
+            slot = round_num % self.window_rounds
+            window_clicks[slot] = clicks
+            window_shows[slot] = shows
+            columns['clicks'] = window_clicks.sum(axis=0)
+            columns['shows'] = window_shows.sum(axis=0)
+            try:
+                bandit.evaluate_columns(columns)
+                bandit.recalc_models_weights()
+                new_weights = bandit.get_models_weights()
+                weights = np.array([new_weights[mv] for mv in self.model_versions], dtype=float)
+            except ZeroConversion:
+                pass
+            weights_history[round_num] = weights
+            best_history[round_num] = np.argmax(weights) == np.argmax(ctrs)
+        elapsed = max(time.time() - started, 1e-9)
+
+        # first round since which the best arm always has the largest weight
+        not_best = np.flatnonzero(~best_history)
+        if len(not_best) == 0:
+            convergence_round = 0
+        elif not_best[-1] == rounds - 1:
+            convergence_round = None
+        else:
+            convergence_round = int(not_best[-1] + 1)
+
+        return {
+            'cumulative_regret': np.cumsum(regret),
+            'convergence_round': convergence_round,
+            'rounds_per_second': rounds / elapsed,
+            'events_per_second': rounds * self.batch_size / elapsed,
+            'weights': weights_history,
+        }
+
+
+def benchmark(bandit_factories, simulator, rounds):
+    """
+    Run every bandit through the same simulated traffic
+    :param bandit_factories: dict name -> callable(page_type, models) -> bandit
+    :return: pd.DataFrame, one row per bandit
+    """
+    rows = []
+    for name, factory in bandit_factories.items():
+        bandit = factory(simulator.page_type, simulator.make_models())
+        result = simulator.run(bandit, rounds)
+        rows.append({
+            'bandit': name,
+            'regret': result['cumulative_regret'][-1],
+            'regret_per_event': result['cumulative_regret'][-1] / (rounds * simulator.batch_size),
+            'convergence_round': result['convergence_round'],
+            'rounds_per_second': result['rounds_per_second'],
+            'events_per_second': result['events_per_second'],
+        })
+    return pd.DataFrame(rows)
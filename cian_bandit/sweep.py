@@ -0,0 +1,126 @@
+import itertools
+import math
+import os
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+
+import numpy as np
+import pandas as pd
+
+from cian_bandit.bandits import HeuristicBandit
+from cian_bandit.bandits import SimpleBandit
+from cian_bandit.bandits import ThompsonBandit
+from cian_bandit.bandits import UCBBandit
+from cian_bandit.metrics import ClickThroughRate
+from cian_bandit.simulator import TrafficSimulator
+
+
+BANDIT_CLASSES = {
+    'simple': SimpleBandit,
+    'ucb': UCBBandit,
+    'thompson': ThompsonBandit,
+    'heuristic': HeuristicBandit,
+}
+
+# values used in production (BanditUpdater.init_bandits, ClickThroughRate, job.py)
+DEFAULT_PARAMS = {
+    'bandit': 'ucb',
+    'min_weight': 0.05,
+    'smooth': 1000,
+    'min_confident_shows': 10000,
+    'last_events_cnt': 50000,
+}
+
+
+def grid(param_grid):
+    """
+    :param param_grid: dict param -> list of values
+    :return: list of param dicts, all combinations
+    """
+    names = list(param_grid)
+    return [
+        dict(zip(names, values))
+        for values in itertools.product(*[param_grid[name] for name in names])
+    ]
+
+
+def random_search(param_space, n, seed=0):
+    """
+    :param param_space: dict param -> list of values (choice)
+        or (low, high) tuple (uniform, ints if both bounds are ints)
+    :return: list of n param dicts
+    """
+    rng = np.random.default_rng(seed)
+    configs = []
+    for _ in range(n):
+        config = {}
+        for name, space in param_space.items():
+            if isinstance(space, tuple):
+                low, high = space
+                if isinstance(low, int) and isinstance(high, int):
+                    config[name] = int(rng.integers(low, high + 1))
+                else:
+                    config[name] = float(rng.uniform(low, high))
+            else:
+                config[name] = space[rng.integers(len(space))]
+        configs.append(config)
+    return configs
+
+
+def run_config(config, seed, simulator_kwargs, rounds):
+    """
+    Simulate one configuration, top-level to be picklable for the process pool
+    last_events_cnt (per model_version) is turned into simulator window of rounds
+    """
+    params = dict(DEFAULT_PARAMS, **config)
+    simulator = TrafficSimulator(seed=seed, **simulator_kwargs)
+    n_arms = len(simulator.model_versions)
+    simulator.window_rounds = max(
+        1, int(math.ceil(params['last_events_cnt'] * n_arms * 1.0 / simulator.batch_size))
+    )
+    models = simulator.make_models(partial(
+        ClickThroughRate,
+        smooth=params['smooth'],
+        min_confident_shows=params['min_confident_shows'],
+    ))
+    bandit_cls = BANDIT_CLASSES[params['bandit']]
+    kwargs = {}
+    if bandit_cls is ThompsonBandit:
+        kwargs['seed'] = seed
+    bandit = bandit_cls(simulator.page_type, models, params['min_weight'], **kwargs)
+
+    result = simulator.run(bandit, rounds)
+    row = dict(params)
+    row.update({
+        'seed': seed,
+        'regret': result['cumulative_regret'][-1],
+        'regret_per_event': result['cumulative_regret'][-1] / (rounds * simulator.batch_size),
+        'convergence_round': result['convergence_round'],
+        'rounds_per_second': result['rounds_per_second'],
+    })
+    return row
+
+
+def sweep(configs, simulator_kwargs, rounds, processes=None, seed=0):
+    """
+    Run configurations in a process pool (all cores by default)
+    Every configuration gets its own seed spawned from `seed`,
+    so results do not depend on the number of processes or scheduling
+    :param simulator_kwargs: TrafficSimulator kwargs except seed
+    :return: pd.DataFrame, one row per configuration, sorted by regret
+    """
+    seeds = [
+        int(child.generate_state(1)[0])
+        for child in np.random.SeedSequence(seed).spawn(len(configs))
+    ]
+    run = partial(run_config, simulator_kwargs=simulator_kwargs, rounds=rounds)
+    if processes is None:
+        processes = os.cpu_count() or 1
+
+    if processes == 1:
+        rows = list(map(run, configs, seeds))
+    else:
+        chunksize = max(1, len(configs) // (4 * processes))
+        with ProcessPoolExecutor(max_workers=processes) as pool:
+            rows = list(pool.map(run, configs, seeds, chunksize=chunksize))
+    return pd.DataFrame(rows).sort_values('regret').reset_index(drop=True)
@@ -1,15 +1,36 @@
-from elasticsearch import Elasticsearch
-from elasticsearch import helpers
 from collections import defaultdict
 from datetime import datetime
 import json
-import pandas as pd
+import logging
 import time
 import os
+import uuid
+
+from cian_bandit import instrumentation
+
+# per-arm records of every published config version
+HISTORY_INDEX = 'bandit_ml_recs_history'
+# weights of segments: a doc per segment, the config doc keeps only a pointer
+SEGMENTS_INDEX = 'bandit_ml_recs_segments'
+
+
+def models_section(page_type_config, weights, conversions):
+    """
+    Config doc section: page_type_config of every model_version with new prob and conversion
+    """
+    section = {}
+    for model_version, model_config in page_type_config.items():
+        section[model_version] = dict(model_config)
+        section[model_version]['prob'] = weights[model_version]
+        section[model_version]['conversion'] = handle_null_conversion(
+            conversions[model_version]
+        )
+    return section
 
 
 def handle_null_conversion(c):
-    if c is None or pd.isnull(c):
+    # c != c is true only for nan
+    if c is None or c != c:
         c = 10e-6
     return c
 
@@ -53,34 +74,104 @@ class WeightStorage:
         'updated': '2018-03-20 00:22:33',
         'config_version': 1
     }
+    Segments (SegmentedBanditUpdater) are not fields of the config doc:
+    thousands of them would hit index.mapping.total_fields.limit.
+    Every segment is a doc of SEGMENTS_INDEX with id '<run_id>:<segment key>'
+    and fields segment, run_id, models (as a page_type section),
+    the config doc points at them:
+        'segments': {'index': 'bandit_ml_recs_segments', 'run_id': '...', 'keys': [...]}
     """
-    def __init__(self, hosts=None):
+    def __init__(self, hosts=None, cache_ttl=5.0, clock=time.time, history_store=None):
+        """
+        :param cache_ttl: seconds a cached last config doc may be served
+            without asking es, 0 disables the cache
+        :param history_store: HistoryStore, every published version is appended there
+            and get_previous_weights reads it instead of es
+        """
         if hosts is None:
             hosts = os.environ['ES_HOSTS'].split(',')
-        self.es_client = Elasticsearch(hosts=hosts, maxsize=1)
+        self.hosts = hosts
+        self._es_client = None
+        self.cache_ttl = cache_ttl
+        self.clock = clock
+        # (config doc, time it was read or written)
+        self._cached = None
+        self.cache_hits = 0
+        self.cache_misses = 0
+        self.history_store = history_store
 
-    def get_last_config_doc(self):
+    @property
+    def es_client(self):
         """
-        config is stored as es doc with id=0
-        will be overwritten every time
-        :return: config json from es
+        elasticsearch is imported and connected on first use:
+        serving processes with cached or sampled weights never pay for it
         """
-        last_result = self.es_client.search(
-            index='bandit_ml_recs',
-            doc_type='bandit_config',
-            sort='config_version:desc',
-        )['hits']['hits']
+        if self._es_client is None:
+            from elasticsearch import Elasticsearch
+            self._es_client = Elasticsearch(hosts=self.hosts, maxsize=1)
+        return self._es_client
+
+    @es_client.setter
+    def es_client(self, es_client):
+        self._es_client = es_client
+
+    def _cache_config_doc(self, config_doc):
+        """
+        Keep the newest config_version: an es search lagging behind
+        our own write never replaces it
+        """
+        cached = self._cached
+        if cached is not None:
+            cached_version = int(cached[0]['_source']['config_version'])
+            if cached_version > int(config_doc['_source']['config_version']):
+                self._cached = (cached[0], self.clock())
+                return cached[0]
+        self._cached = (config_doc, self.clock())
+        return config_doc
+
+    def invalidate_cache(self):
+        self._cached = None
+
+    def cache_stats(self):
+        return {'hits': self.cache_hits, 'misses': self.cache_misses}
+
+    def get_last_config_doc(self, max_age=None):
+        """
+        Read-through cached, config docs written by this instance are cached at once
+        :param max_age: staleness bound in seconds for this call, cache_ttl by default,
+            0 forces es search
+        :return: config json from es (shared with cache, do not modify)
+        """
+        if max_age is None:
+            max_age = self.cache_ttl
+        cached = self._cached
+        if cached is not None and self.clock() - cached[1] < max_age:
+            self.cache_hits += 1
+            return cached[0]
+        self.cache_misses += 1
+
+        with instrumentation.span('es_read'):
+            last_result = self.es_client.search(
+                index='bandit_ml_recs',
+                doc_type='bandit_config',
+                sort='config_version:desc',
+            )['hits']['hits']
 
         if len(last_result) == 0:
             raise NotFoundBanditConfig("No bandit config document")
 
         last_result = last_result[0]
-        return last_result
+        if self.cache_ttl <= 0:
+            return last_result
+        return self._cache_config_doc(last_result)
 
     def get_previous_weights(self, page_type, num):
         """
         Get list of last num weights per every page_type->model_version
+        (newest first if history_store is set)
         """
+        if self.history_store is not None:
+            return self.history_store.previous_weights(page_type, num)
         last_result = self.es_client.search(
             index='bandit_ml_recs',
             doc_type='bandit_config',
@@ -99,33 +190,295 @@ class WeightStorage:
                 weights[model_version] += [prob]
         return weights
 
-    def update_page_type_models_weights(self, page_type, models, page_type_config):
+    def _next_config_doc(self, previous_source, sections):
+        """
+        :param sections: dict page_type (or segment) -> new doc section
+        """
+        doc = dict(previous_source)
+        doc.update(sections)
+        doc['updated'] = str(datetime.now())[:19]
+        doc['config_version'] = int(previous_source['config_version']) + 1
+        return doc
+
+    def _create_config_doc(self, doc):
+        """
+        Compare-and-set write: doc id is config_version and op_type is create,
+        so only one writer can create every version.
+        refresh=wait_for makes the new version visible to search on return
+        """
+        with instrumentation.span('es_write'):
+            self.es_client.create(
+                index='bandit_ml_recs',
+                doc_type='bandit_config',
+                id=str(doc['config_version']),
+                body=doc,
+                refresh='wait_for',
+            )
+
+    def _record_history(self, doc, sections, stats):
+        """
+        Local history of a version already created in es: a failed append
+        (clock stepped back) is logged, not raised - the version is published
+        """
+        if self.history_store is None:
+            return
+        timestamp = self.clock()
+        for key, section in sections.items():
+            key_stats = stats.get(key, {})
+            model_versions = list(section)
+            arm_stats = [key_stats.get(mv, {}) for mv in model_versions]
+            try:
+                self.history_store.append(
+                    timestamp=timestamp,
+                    page_type=key,
+                    model_versions=model_versions,
+                    probs=[section[mv]['prob'] for mv in model_versions],
+                    conversions=[section[mv]['conversion'] for mv in model_versions],
+                    shows=[arm.get('shows', 0) for arm in arm_stats],
+                    clicks=[arm.get('clicks', 0) for arm in arm_stats],
+                )
+            except ValueError as e:
+                logging.warning('history of config_version %s (%s) not recorded: %s',
+                                doc['config_version'], key, e)
+
+    def _compare_and_set(self, sections, max_retries, write):
+        """
+        Retry loop of compare-and-set writes shared by _publish and publish_bulk:
+        doc is rebuilt on top of the last version until write gets it through
+        :param write: callable(doc) creating config doc version,
+            raises ConflictError if another writer holds the version
+        :return: (config doc, what write returned)
+        :raise NotUpdatedConfig: max_retries + 1 writes conflicted
+        """
+        from elasticsearch.exceptions import ConflictError
+
+        previous_result = self.get_last_config_doc()
+        for _ in range(max_retries + 1):
+            doc = self._next_config_doc(
+                previous_source=previous_result['_source'],
+                sections=sections,
+            )
+            try:
+                result = write(doc)
+            except ConflictError:
+                instrumentation.incr('es_retries')
+                # another job has written this version: realtime get it and retry on top of it
+                with instrumentation.span('es_read'):
+                    previous_result = self.es_client.get(
+                        index='bandit_ml_recs',
+                        doc_type='bandit_config',
+                        id=str(doc['config_version']),
+                    )
+                continue
+            if self.cache_ttl > 0:
+                self._cache_config_doc({
+                    '_id': str(doc['config_version']),
+                    '_source': doc,
+                })
+            return doc, result
+        raise NotUpdatedConfig(
+            "Couldnt update bandit config document: {0} conflicts".format(max_retries + 1)
+        )
+
+    def _publish(self, sections, max_retries, stats=None):
+        """
+        :param stats: as in publish_bulk, for history_store
+        """
+        doc, _ = self._compare_and_set(sections, max_retries, self._create_config_doc)
+        self._record_history(doc, sections, stats or {})
+        return doc
+
+    def update_page_type_models_weights(self, page_type, models, page_type_config, max_retries=5):
         """
         :param models: list[Model]
+        :param max_retries: how many times to rebuild the doc on top of
+            a concurrently written version
         """
         if page_type != 'desktop':
             # still cant update mobile!
             return
-        previous_result = self.get_last_config_doc()
-        previous_version = int(previous_result['_source']['config_version'])
-        doc = dict(previous_result['_source'])
-        doc[page_type] = page_type_config
+        section = page_type_config
+        stats = {}
         for model_version, model in models.items():
-            doc[page_type][model_version]['prob'] = model.weight
+            section[model_version]['prob'] = model.weight
             conversion = handle_null_conversion(model.metric.value)
-            doc[page_type][model_version]['conversion'] = conversion
-        doc['updated'] = str(datetime.now())[:19]
-        doc['config_version'] = int(previous_result['_source']['config_version']) + 1
-        doc = dict(doc)
-        self.es_client.index(
-            index='bandit_ml_recs',
-            doc_type='bandit_config',
-            body=doc,
-        )
-        # wait for config to be indexed
-        time.sleep(3)
-        new_version = self.get_last_config_doc()['_source']['config_version']
+            section[model_version]['conversion'] = conversion
+            metric = model.metric
+            if getattr(metric, 'shows', None) is not None:
+                stats[model_version] = {
+                    'clicks': metric.clicks,
+                    'shows': metric.shows - getattr(metric, 'smooth', 0),
+                }
+        return self._publish({page_type: section}, max_retries, stats={page_type: stats})
+
+    def _history_actions(self, doc, sections, stats, run_id):
+        """
+        One record per arm; ids do not depend on config_version,
+        so a retry after conflict overwrites records of the lost attempt
+        """
+        for key, section in sections.items():
+            key_stats = stats.get(key, {})
+            for model_version, model_config in section.items():
+                record = {
+                    'config_version': doc['config_version'],
+                    'updated': doc['updated'],
+                    'segment': key,
+                    'model_version': model_version,
+                    'prob': model_config['prob'],
+                    'conversion': model_config['conversion'],
+                }
+                record.update(key_stats.get(model_version, {}))
+                yield {
+                    '_op_type': 'index',
+                    '_index': HISTORY_INDEX,
+                    '_type': 'bandit_history',
+                    '_id': '{0}:{1}:{2}'.format(run_id, key, model_version),
+                    '_source': record,
+                }
+
+    def _segment_actions(self, sections, run_id):
+        """
+        A doc per segment; ids do not depend on config_version
+        """
+        for key, section in sections.items():
+            yield {
+                '_op_type': 'index',
+                '_index': SEGMENTS_INDEX,
+                '_type': 'bandit_segment',
+                '_id': '{0}:{1}'.format(run_id, key),
+                '_source': {'segment': key, 'run_id': run_id, 'models': section},
+            }
+
+    def _delete_history(self, sections, run_id, segment_docs=False):
+        """
+        History records (and segment docs) of a run whose config doc
+        was never created describe weights nobody served: remove them
+        """
+        from elasticsearch import helpers
+
+        actions = [
+            {
+                '_op_type': 'delete',
+                '_index': HISTORY_INDEX,
+                '_type': 'bandit_history',
+                '_id': '{0}:{1}:{2}'.format(run_id, key, model_version),
+            }
+            for key, section in sections.items()
+            for model_version in section
+        ]
+        if segment_docs:
+            actions += [
+                {
+                    '_op_type': 'delete',
+                    '_index': SEGMENTS_INDEX,
+                    '_type': 'bandit_segment',
+                    '_id': '{0}:{1}'.format(run_id, key),
+                }
+                for key in sections
+            ]
+        with instrumentation.span('es_write'):
+            _, errors = helpers.bulk(self.es_client, actions, raise_on_error=False)
+        # 404: the record was not written in the first place
+        errors = [error for error in errors if list(error.values())[0].get('status') != 404]
+        for error in errors:
+            logging.warning('orphaned history record not deleted (run_id %s): %s', run_id, error)
+        return errors
+
+    def publish_bulk(self, segments, stats=None, max_retries=5, segment_docs=False):
+        """
+        New config doc version with all segments and per-arm history records
+        in one bulk request
+        :param segments: dict segment key (or page_type) -> (page_type_config, weights, conversions)
+        :param stats: dict segment key -> model_version -> extra history fields
+            (clicks, shows, events_cnt, ...)
+        :param segment_docs: write segments as docs of SEGMENTS_INDEX
+            and only a pointer to them into the config doc
+        :return: (config doc, list of failed history items as returned by helpers.bulk),
+            None if there is nothing to publish
+        Config doc is created with op_type create as in _publish: on conflict
+        the whole bulk is rebuilt on top of the concurrent version;
+        if it is never created, history records of the run are deleted
+        """
+        from elasticsearch import helpers
+        from elasticsearch.exceptions import ConflictError
+
+        sections = {
+            key: models_section(page_type_config, weights, conversions)
+            for key, (page_type_config, weights, conversions) in segments.items()
+        }
+        if not sections:
+            return None
+        stats = stats or {}
+        run_id = uuid.uuid4().hex
+
+        doc_sections = sections
+        if segment_docs:
+            # segment docs go first: the config doc must never point at missing ones
+            with instrumentation.span('es_write'):
+                _, errors = helpers.bulk(
+                    self.es_client,
+                    list(self._segment_actions(sections, run_id)),
+                    raise_on_error=False,
+                    refresh='wait_for',
+                )
+            if errors:
+                self._delete_history(sections, run_id, segment_docs)
+                raise NotUpdatedConfig(
+                    "Couldnt write {0} segment docs: {1}".format(len(errors), errors[0])
+                )
+            doc_sections = {'segments': {
+                'index': SEGMENTS_INDEX,
+                'run_id': run_id,
+                'keys': sorted(sections),
+            }}
+
+        def write(doc):
+            """
+            :return: failed history items
+            """
+            config_id = str(doc['config_version'])
+            actions = [{
+                '_op_type': 'create',
+                '_index': 'bandit_ml_recs',
+                '_type': 'bandit_config',
+                '_id': config_id,
+                '_source': doc,
+            }]
+            actions.extend(self._history_actions(doc, sections, stats, run_id))
+            with instrumentation.span('es_write'):
+                _, errors = helpers.bulk(
+                    self.es_client,
+                    actions,
+                    raise_on_error=False,
+                    refresh='wait_for',
+                )
+
+            config_error = None
+            history_errors = []
+            for error in errors:
+                # items report the concrete index, not the alias written to:
+                # the config doc is the only create of the bulk
+                op_type, item = list(error.items())[0]
+                if op_type == 'create' and item.get('_id') == config_id:
+                    config_error = item
+                else:
+                    history_errors.append(error)
+            if config_error is None:
+                return history_errors
+            if config_error.get('status') == 409:
+                raise ConflictError(409, 'version_conflict_engine_exception', config_error)
+            raise NotUpdatedConfig(
+                "Couldnt update bandit config document: {0}".format(config_error)
+            )
 
-        if previous_version == new_version:
-            print(previous_version, 'vs', new_version)
-            raise NotUpdatedConfig("Couldnt update bandit config document")
+        try:
+            doc, history_errors = self._compare_and_set(doc_sections, max_retries, write)
+        except NotUpdatedConfig:
+            # weights of the run are never served: no history of them
+            self._delete_history(sections, run_id, segment_docs)
+            raise
+        self._record_history(doc, sections, stats)
+        for error in history_errors:
+            logging.warning('history record not written: %s', error)
+        instrumentation.incr('es_history_errors', len(history_errors))
+        return doc, history_errors
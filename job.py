@@ -1,23 +1,129 @@
 import json
+import logging
 import os
 import sys
 import datetime
 import argparse
 from cian_bandit.weights_storage import WeightStorage
-from cian_bandit.events_storage import EventsStorage
-from cian_bandit.bandit_updater import BanditUpdater
+from cian_bandit.history_store import HistoryStore
+from cian_bandit.events_storage import EventsStorage, LocalEventsBackend
+from cian_bandit.bandit_updater import BanditUpdater, SegmentedBanditUpdater, config_page_types
+from cian_bandit.power import adaptive_batch, default_windows
+from cian_bandit.event_stream import JsonlEventReader, StreamingUpdater
+from cian_bandit.scheduler import AlreadyRunning, ConfigWatcher, IntervalScheduler, ProcessLock
+from cian_bandit import instrumentation
 
 os.environ['LAST_EVENTS_CNT'] = str(50000)
 os.environ['ES_HOSTS'] = 'hdes01-data.cian.tech,hdes02-data.cian.tech,hdes03-data.cian.tech'
 os.environ['PRESTO_USER'] = 'alaktionov'
 
 
+MODELS_CONFIG_PATH = './models_config.json'
+
+
 def read_models_config():
-    with open('./models_config.json', 'r') as f:
+    with instrumentation.span('config_read'), open(MODELS_CONFIG_PATH, 'r') as f:
         conf = json.load(f)
     return conf
 
 
+def with_page_type(batch, config):
+    """
+    page_type of events (a segment column or "segments": {"page_type": ...}
+    of models config while sopr_shows has no page_type), only model versions
+    of config are kept
+    """
+    if 'page_type' not in batch.columns:
+        page_type = config.get('segments', {}).get('page_type')
+        if page_type is None:
+            raise KeyError('models config: events have no page_type column, set segments.page_type')
+        batch = batch.assign(page_type=page_type)
+    known = {
+        (page_type, model_version)
+        for page_type in config_page_types(config)
+        for model_version in config[page_type]
+    }
+    in_config = [arm in known for arm in zip(batch['page_type'], batch['model_version'])]
+    return batch[in_config]
+
+
+def load_batch(events_storage, config, windows=None, alpha=0.05, power=0.8):
+    """
+    :param windows: candidate last_events_cnts, every bandit (page_type or segment)
+        takes the smallest one separating its leader from the runner-up
+        with alpha and power (see cian_bandit.power);
+        events_storage.last_events_cnt for all bandits if None
+    Events are grouped by "segments": {"columns": [...]} of models config
+    """
+    group_columns = config.get('segments', {}).get('columns', [])
+    if windows is None:
+        return with_page_type(events_storage.get_batch(group_columns), config)
+    # all candidate windows come from one query
+    batches = {
+        cnt: with_page_type(batch, config)
+        for cnt, batch in events_storage.get_batches(windows, group_columns).items()
+    }
+    batch, chosen = adaptive_batch(batches, alpha=alpha, power=power, group_columns=group_columns)
+    print('events windows:', chosen)
+    return batch
+
+
+class UpdateRunner(object):
+    """
+    Одно обновление бандитов по свежему батчу событий
+    Апдейтер и его BanditEngine переживают запуски демона: пересоздаются
+    только при смене конфига (или новых сегментах), иначе получают новый батч
+    Сегменты, кроме page_type, получают по бандиту (SegmentedBanditUpdater)
+    """
+    def __init__(self, weights_storage, events_storage, really_update_es, workers=1,
+                 windows=None, alpha=0.05, power=0.8, profile_path=None, bulk=False):
+        self.weights_storage = weights_storage
+        self.events_storage = events_storage
+        self.really_update_es = really_update_es
+        self.workers = workers
+        self.windows = windows
+        self.alpha = alpha
+        self.power = power
+        self.profile_path = profile_path
+        self.bulk = bulk
+        self.config = None
+        self.updater = None
+
+    def _make_updater(self, config, batch):
+        segment_columns = [
+            column for column in config.get('segments', {}).get('columns', [])
+            if column != 'page_type'
+        ]
+        if segment_columns:
+            updater = SegmentedBanditUpdater(
+                weights_storage=self.weights_storage,
+                batch=batch,
+                really_update_es=self.really_update_es,
+                segment_columns=segment_columns,
+            )
+        else:
+            updater = BanditUpdater(
+                weights_storage=self.weights_storage,
+                batch=batch,
+                really_update_es=self.really_update_es,
+                profile_path=self.profile_path,
+                bulk=self.bulk,
+            )
+        updater.init_bandits(config)
+        return updater
+
+    def run(self, config):
+        batch = load_batch(self.events_storage, config, self.windows, self.alpha, self.power)
+        # ConfigWatcher returns the same object until the file changes
+        if config is not self.config or self.updater.set_batch(batch) is False:
+            self.updater = self._make_updater(config, batch)
+            self.config = config
+
+        if isinstance(self.updater, SegmentedBanditUpdater):
+            return self.updater.update_bandits(config)
+        return self.updater.update_bandits(config, max_workers=self.workers)
+
+
 def main():
     parser = argparse.ArgumentParser()
     parser.add_argument(
@@ -25,37 +131,192 @@ def main():
         type=int,
         help='True if update es bandit doc (affects production!)',
     )
+    parser.add_argument(
+        '--events-log',
+        type=str,
+        help='jsonl log of shows: stream it instead of presto batches',
+    )
+    parser.add_argument(
+        '--events-file',
+        type=str,
+        action='append',
+        help='parquet/csv file of sopr_shows to read instead of presto, may be repeated',
+    )
+    parser.add_argument(
+        '--events-days',
+        type=int,
+        default=1,
+        help='with --events-file: take events of last N days, 0 for all events of files',
+    )
+    parser.add_argument(
+        '--windows',
+        type=str,
+        help='comma separated candidate last_events_cnts, '
+             'fractions of LAST_EVENTS_CNT by default',
+    )
+    parser.add_argument(
+        '--alpha',
+        type=float,
+        default=0.05,
+        help='significance of CTR gap the events window has to detect',
+    )
+    parser.add_argument(
+        '--power',
+        type=float,
+        default=0.8,
+        help='power of CTR gap the events window has to detect',
+    )
+    parser.add_argument(
+        '--publish-interval',
+        type=float,
+        default=60.,
+        help='streaming mode: republish weights at least every N seconds',
+    )
+    parser.add_argument(
+        '--change-threshold',
+        type=float,
+        default=0.05,
+        help='streaming mode: republish weights once any of them changed that much',
+    )
+    parser.add_argument(
+        '--workers',
+        type=int,
+        default=1,
+        help='update page_types concurrently in that many threads',
+    )
+    parser.add_argument(
+        '--daemon',
+        action='store_true',
+        help='keep running and update every --interval seconds instead of one update',
+    )
+    parser.add_argument(
+        '--interval',
+        type=float,
+        default=60.,
+        help='daemon mode: seconds between updates',
+    )
+    parser.add_argument(
+        '--jitter',
+        type=float,
+        default=5.,
+        help='daemon mode: random extra delay up to that many seconds',
+    )
+    parser.add_argument(
+        '--metrics-file',
+        type=str,
+        help='export stage timings and counters to this file after every update',
+    )
+    parser.add_argument(
+        '--metrics-format',
+        choices=['prometheus', 'jsonl'],
+        default='prometheus',
+        help='prometheus textfile (rewritten) or json lines (appended)',
+    )
+    parser.add_argument(
+        '--bulk',
+        action='store_true',
+        help='write all page_types and per-arm history records in one es bulk request',
+    )
+    parser.add_argument(
+        '--history-file',
+        type=str,
+        help='append published weights and conversions to this local history store',
+    )
+    parser.add_argument(
+        '--profile',
+        type=str,
+        help='dump cProfile stats of bandits update to this file',
+    )
+    parser.add_argument(
+        '--lock-file',
+        type=str,
+        default='/tmp/multiarmed_bandit_update.lock',
+        help='only one process holding this lock updates bandits',
+    )
     args = parser.parse_args()
     really_update_es = False
     if args.update is not None and args.update == 1:
         really_update_es = True
     print('Updating ES:', really_update_es)
 
-    weights_storage = WeightStorage()
+    if args.metrics_file is not None:
+        instrumentation.set_instrumentation(instrumentation.Instrumentation())
+
+    history_store = None
+    if args.history_file is not None:
+        history_store = HistoryStore(args.history_file)
+    weights_storage = WeightStorage(history_store=history_store)
     last_config_doc = weights_storage.get_last_config_doc()
     print('previous config:', json.dumps(last_config_doc, indent=2))
 
-    # todo: calc last_events_cnt for desired p-value and power
-    last_events_cnt = int(os.environ['LAST_EVENTS_CNT'])
-    events_storage = EventsStorage(last_events_cnt)
-    batch = events_storage.get_batch()
-
-    # hardcode desktop page_type because mobile data is not collected yet
-    # todo: rm this
-    batch['page_type'] = 'desktop'
+    if args.events_log is not None:
+        config = read_models_config()
+        updater = BanditUpdater(
+            weights_storage=weights_storage,
+            batch=None,
+            really_update_es=really_update_es,
+        )
+        streaming_updater = StreamingUpdater(
+            updater=updater,
+            reader=JsonlEventReader(args.events_log),
+            config=config,
+            publish_interval=args.publish_interval,
+            change_threshold=args.change_threshold,
+        )
+        streaming_updater.run()
+        return
 
-    config = read_models_config()
-    correct_models = config['desktop']
-    batch = batch[batch['model_version'].isin(correct_models)]
+    # largest window, models with clear CTR gap take smaller ones
+    last_events_cnt = int(os.environ['LAST_EVENTS_CNT'])
+    if args.windows:
+        windows = sorted(int(cnt) for cnt in args.windows.split(','))
+    else:
+        windows = default_windows(last_events_cnt)
+    backend = None
+    if args.events_file:
+        backend = LocalEventsBackend(args.events_file, days=args.events_days or None)
+    events_storage = EventsStorage(last_events_cnt, backend=backend)
 
-    updater = BanditUpdater(
+    runner = UpdateRunner(
         weights_storage=weights_storage,
-        batch=batch,
+        events_storage=events_storage,
         really_update_es=really_update_es,
+        workers=args.workers,
+        windows=windows,
+        alpha=args.alpha,
+        power=args.power,
+        profile_path=args.profile,
+        bulk=args.bulk,
     )
 
-    updater.init_bandits(config)
-    updater.update_bandits(config)
+    def update(config):
+        try:
+            with instrumentation.span('update'):
+                runner.run(config)
+        finally:
+            if args.metrics_file is not None:
+                instrumentation.get_instrumentation().export(args.metrics_file, args.metrics_format)
+
+    if args.daemon:
+        def locked_update():
+            # the lock is held per update only: cron launches keep working in between
+            try:
+                with ProcessLock(args.lock_file):
+                    update(config_watcher.get())
+            except AlreadyRunning as e:
+                logging.warning('update skipped: %s', e)
+
+        # es and presto clients, updater and its engine stay warm,
+        # config is reread only when the file changes
+        config_watcher = ConfigWatcher(MODELS_CONFIG_PATH)
+        scheduler = IntervalScheduler(interval=args.interval, jitter=args.jitter)
+        scheduler.install_signal_handlers()
+        scheduler.run(locked_update)
+        print('stopped after', scheduler.runs, 'updates')
+        return
+
+    with ProcessLock(args.lock_file):
+        update(read_models_config())
 
     config = weights_storage.get_last_config_doc()
     print('new config:', json.dumps(config, indent=2))
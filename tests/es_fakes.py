@@ -0,0 +1,78 @@
+"""
+In-memory es stand-ins shared by weights storage tests
+"""
+from elasticsearch.exceptions import ConflictError
+
+from cian_bandit.weights_storage import SEGMENTS_INDEX
+
+
+class FakeConflictingEs(object):
+    """
+    In-memory stand-in for the es client: `create` fails with conflict
+    while another writer holds the version, `search` lags behind writes
+    and always returns the first version
+    """
+    def __init__(self, source, taken_versions):
+        self.docs = {str(source['config_version']): source}
+        for version in taken_versions:
+            self.docs[str(version)] = dict(source, config_version=version, updated='other job')
+        self.created = []
+        self.searches = 0
+        # helpers.bulk writes, see fake_bulk
+        self.bulks = 0
+        self.history = {}
+        self.segments = {}
+
+    def search(self, **kwargs):
+        self.searches += 1
+        last = str(min(int(v) for v in self.docs))
+        return {'hits': {'hits': [{'_source': self.docs[last]}]}}
+
+    def get(self, id, **kwargs):
+        return {'_source': self.docs[id]}
+
+    def create(self, id, body, refresh, **kwargs):
+        assert refresh == 'wait_for'
+        if id in self.docs:
+            raise ConflictError(409, 'version_conflict_engine_exception', {})
+        self.docs[id] = body
+        self.created.append(id)
+
+
+def fake_bulk(client, actions, raise_on_error=True, refresh=None, **kwargs):
+    """
+    helpers.bulk over FakeConflictingEs: create conflicts as es does,
+    history records with `fail` field are rejected
+    """
+    assert not raise_on_error
+    success, errors = 0, []
+    if all(action['_op_type'] == 'delete' for action in actions):
+        for action in actions:
+            docs = client.segments if action['_index'] == SEGMENTS_INDEX else client.history
+            if docs.pop(action['_id'], None) is None:
+                errors.append({'delete': {'_index': action['_index'], '_id': action['_id'], 'status': 404}})
+            else:
+                success += 1
+        return success, errors
+
+    assert refresh == 'wait_for'
+    client.bulks += 1
+    for action in actions:
+        item = {'_index': action['_index'], '_id': action['_id']}
+        if action['_op_type'] == 'create':
+            # es reports the index behind the alias
+            item['_index'] = 'bandit_ml_recs_v2'
+            if action['_id'] in client.docs:
+                errors.append({'create': dict(item, status=409, error='version conflict')})
+                continue
+            client.docs[action['_id']] = action['_source']
+            client.created.append(action['_id'])
+        elif action['_source'].get('fail'):
+            errors.append({'index': dict(item, status=400, error='mapper_parsing_exception')})
+            continue
+        elif action['_index'] == SEGMENTS_INDEX:
+            client.segments[action['_id']] = action['_source']
+        else:
+            client.history[action['_id']] = action['_source']
+        success += 1
+    return success, errors
@@ -3,19 +3,23 @@ from cian_bandit.presto import run_sql
 
 from cian_bandit.metrics_sql import metrics_sql_columns
 from cian_bandit.metrics_sql import metrics_sql
+import numpy as np
 import pandas as pd
 import json
 from cian_bandit.weights_storage import WeightStorage
 from cian_bandit.bandit_updater import BanditUpdater
+from cian_bandit.bandit_updater import SegmentedBanditUpdater
 from elasticsearch import Elasticsearch
 import pytest
 import os
+import threading
 from scipy.stats import poisson
 from scipy.stats import bernoulli
 import logging
 from unittest import TestCase
 
 from cian_bandit.bandits import SimpleBandit
+from cian_bandit.bandits import UCBBandit
 from cian_bandit.bandits import ZeroConversion
 from cian_bandit.metrics import ClickThroughRate
 from cian_bandit.models import Model
@@ -157,3 +161,222 @@ def test_bandit_updater(set_previous_config):
 
     # first <= second <= third
     assert new_weights['7']['prob'] < new_weights['8']['prob'] < new_weights['9']['prob'], 'wrong order after evaluation!'
+
+
+class OverlappingWeightStorage(object):
+    """
+    Records writes; a write waits until `parties` writes are in progress
+    at once, so sequential writes time out on the barrier
+    """
+    def __init__(self, parties):
+        self.barrier = threading.Barrier(parties, timeout=5)
+        self.written = []
+        self.retries = []
+
+    def update_page_type_models_weights(self, page_type, models, page_type_config, max_retries=5):
+        self.barrier.wait()
+        self.written.append(page_type)
+        self.retries.append(max_retries)
+
+
+def test_concurrent_update_bandits():
+    page_types = ['mobile', 'desktop', 'tablet', 'app']
+    models_config = {page_type: {'1': {}, '2': {}} for page_type in page_types}
+    rows = []
+    for page_type in page_types:
+        clicks = 0 if page_type == 'mobile' else 300
+        rows += [[page_type, '1', clicks, 10000], [page_type, '2', 2 * clicks, 10000]]
+    batch = pd.DataFrame(rows, columns=['page_type', 'model_version', 'clicks', 'shows'])
+
+    # mobile fails before writing: the other three writes overlap
+    storage = OverlappingWeightStorage(parties=3)
+    updater = BanditUpdater(storage, batch, True)
+    updater.page_types = page_types
+    updater.init_bandits(models_config)
+
+    results = updater.update_bandits(models_config, max_workers=4)
+
+    # mobile has zero conversions and is isolated from the others
+    assert list(results) == page_types
+    assert results['mobile'] is None
+    assert sorted(storage.written) == sorted(page_types[1:])
+    # a page_type may lose the config version to every other one
+    assert all(retries >= len(page_types) + 5 for retries in storage.retries)
+    for page_type in page_types[1:]:
+        assert results[page_type]['1'] < results[page_type]['2']
+
+
+class RecordingWeightStorage(object):
+    def __init__(self):
+        self.written = []
+
+    def publish_bulk(self, segments, stats=None, segment_docs=False):
+        assert segment_docs
+        self.written.append(segments)
+
+
+def test_segmented_updater():
+    rng = np.random.default_rng(0)
+    regions = ['region_{0}'.format(i) for i in range(300)]
+    models_config = {
+        'config_version': 2,
+        'desktop': {'9': {'parameters': {}}, '10': {'parameters': {}}},
+        'mobile': {'1': {'parameters': {}}, '2': {'parameters': {}}},
+    }
+    rows = []
+    for region in regions:
+        for page_type, model_versions in [('desktop', ['9', '10', 'old']), ('mobile', ['1', '2'])]:
+            for i, model_version in enumerate(model_versions):
+                shows = 10000
+                clicks = 0 if page_type == 'mobile' and region == 'region_0' else rng.binomial(shows, 0.01 * (i + 1))
+                rows.append([page_type, region, model_version, clicks, shows])
+    batch = pd.DataFrame(rows, columns=['page_type', 'region', 'model_version', 'clicks', 'shows'])
+
+    storage = RecordingWeightStorage()
+    updater = SegmentedBanditUpdater(storage, batch, True, segment_columns=['region'])
+    updater.init_bandits(models_config)
+    results = updater.update_bandits(models_config)
+
+    assert len(updater.segments) == 600
+    assert len(results) == 599
+    assert 'mobile:region_0' not in results
+    assert results['desktop:region_7']['9'] < results['desktop:region_7']['10']
+    assert np.isclose(sum(results['mobile:region_7'].values()), 1.0)
+
+    # same weights as a per-page_type UCBBandit on this segment
+    segment = batch[(batch['region'] == 'region_7') & (batch['page_type'] == 'desktop')]
+    models = [Model('desktop', mv, ClickThroughRate(), mv) for mv in ['9', '10']]
+    bandit = UCBBandit('desktop', models, min_weight=0.05)
+    bandit.evaluate_batch(segment)
+    bandit.recalc_models_weights()
+    assert np.allclose(
+        list(bandit.get_models_weights().values()),
+        list(results['desktop:region_7'].values()),
+    )
+
+    # all segments go to es in one write
+    assert len(storage.written) == 1
+    config, weights, conversions = storage.written[0]['desktop:region_7']
+    assert config == models_config['desktop']
+    assert weights == results['desktop:region_7']
+
+
+class BulkRecordingWeightStorage(object):
+    def __init__(self):
+        self.bulks = []
+
+    def publish_bulk(self, segments, stats=None):
+        self.bulks.append((segments, stats))
+
+    def update_page_type_models_weights(self, **kwargs):
+        raise AssertionError('bulk updater writes page_types one by one')
+
+
+def test_bulk_updater():
+    config = {
+        'desktop': {'1': {'parameters': {}}, '2': {'parameters': {}}},
+        'mobile': {'3': {'parameters': {}}, '4': {'parameters': {}}},
+    }
+    batch = pd.DataFrame({
+        'page_type': ['desktop', 'desktop', 'mobile', 'mobile'],
+        'model_version': ['1', '2', '3', '4'],
+        'clicks': [10, 20, 5, 7],
+        'shows': [1000, 1000, 500, 500],
+    })
+    storage = BulkRecordingWeightStorage()
+    updater = BanditUpdater(storage, batch, True, bulk=True)
+    updater.init_bandits(config)
+    results = updater.update_bandits(config, max_workers=2)
+
+    assert len(storage.bulks) == 1
+    segments, stats = storage.bulks[0]
+    # mobile is still not published
+    assert list(segments) == ['desktop']
+    page_type_config, weights, conversions = segments['desktop']
+    assert weights == results['desktop']
+    assert stats['desktop']['2'] == {'clicks': 20, 'shows': 1000, 'events_cnt': 2000}
+
+
+def test_set_batch_reuses_engine():
+    config = {'desktop': {'1': {}, '2': {}}}
+    first = pd.DataFrame({
+        'page_type': ['desktop', 'desktop'],
+        'model_version': ['1', '2'],
+        'clicks': [10, 20],
+        'shows': [1000, 1000],
+    })
+    updater = BanditUpdater(None, first, False)
+    updater.init_bandits(config)
+    updater.update_bandits(config)
+    engine = updater.engine
+
+    # model 2 has no events in the next batch: its old statistics are not reused
+    updater.set_batch(first.iloc[:1])
+    results = updater.update_bandits(config)
+    assert updater.engine is engine
+    desktop = updater.bandits[0]
+    assert desktop.models['2'].metric.shows is None
+    assert results['desktop']['1'] > results['desktop']['2']
+
+
+def test_segmented_set_batch():
+    config = {'desktop': {'9': {'parameters': {}}, '10': {'parameters': {}}}}
+    rows = []
+    for region in ['msk', 'spb']:
+        rows += [['desktop', region, '9', 10, 1000], ['desktop', region, '10', 20, 1000]]
+    batch = pd.DataFrame(rows, columns=['page_type', 'region', 'model_version', 'clicks', 'shows'])
+    msk = batch[batch['region'] == 'msk']
+
+    updater = SegmentedBanditUpdater(RecordingWeightStorage(), batch, True, segment_columns=['region'])
+    updater.init_bandits(config)
+    updater.update_bandits(config)
+
+    # same segments: the warm updater publishes what a fresh one does
+    assert updater.set_batch(batch.copy())
+    warm = updater.update_bandits(config)
+    fresh = SegmentedBanditUpdater(RecordingWeightStorage(), batch, True, segment_columns=['region'])
+    fresh.init_bandits(config)
+    assert warm == fresh.update_bandits(config)
+
+    # spb has no rows: it must not be published with uniform weights
+    assert not updater.set_batch(msk)
+    updater = SegmentedBanditUpdater(updater.weights_storage, msk, True, segment_columns=['region'])
+    updater.init_bandits(config)
+    assert list(updater.update_bandits(config)) == ['desktop:msk']
+
+
+def test_segmented_updater_rewards():
+    from cian_bandit.rewards import CompositeReward
+    from cian_bandit.rewards import MissingRewardColumn
+
+    config = {
+        'desktop': {'9': {'parameters': {}}, '10': {'parameters': {}}},
+        'rewards': {'desktop': {'phone_conversion': 1.0}},
+    }
+    # 10 is clicked more, 9 gets more phone calls
+    rows = []
+    for region in ['msk', 'spb']:
+        rows += [['desktop', region, '9', 10, 30, 10000], ['desktop', region, '10', 50, 5, 10000]]
+    batch = pd.DataFrame(rows, columns=['page_type', 'region', 'model_version', 'clicks', 'phones', 'shows'])
+
+    updater = SegmentedBanditUpdater(RecordingWeightStorage(), batch, True, segment_columns=['region'])
+    updater.init_bandits(config)
+    results = updater.update_bandits(config)
+    assert results['desktop:msk']['9'] > results['desktop:msk']['10']
+
+    # same weights as a per-page_type UCBBandit with the reward
+    segment = batch[batch['region'] == 'msk']
+    models = [Model('desktop', mv, ClickThroughRate(), mv) for mv in ['9', '10']]
+    bandit = UCBBandit('desktop', models, min_weight=0.05, reward=CompositeReward.from_config(config, 'desktop'))
+    bandit.evaluate_batch(segment)
+    bandit.recalc_models_weights()
+    assert np.allclose(
+        list(bandit.get_models_weights().values()),
+        list(results['desktop:msk'].values()),
+    )
+
+    updater = SegmentedBanditUpdater(RecordingWeightStorage(), batch.drop(columns=['phones']), True,
+                                     segment_columns=['region'])
+    updater.init_bandits(config)
+    with pytest.raises(MissingRewardColumn):
+        updater.update_bandits(config)
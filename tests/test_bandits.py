@@ -0,0 +1,287 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from cian_bandit.bandits import DiscountedUCBBandit
+from cian_bandit.bandits import HeuristicBandit
+from cian_bandit.bandits import SlidingWindowUCBBandit
+from cian_bandit.bandits import SimpleBandit
+from cian_bandit.bandits import ThompsonBandit
+from cian_bandit.bandits import UCBBandit
+from cian_bandit.bandits import ZeroConversion
+from cian_bandit.engine import BanditEngine
+from cian_bandit.engine import MultipleBanditsPerPageType
+from cian_bandit.metrics import ClickThroughRate
+from cian_bandit.models import Model
+
+
+def make_models(page_type, model_versions):
+    return [
+        Model(
+            page_type=page_type,
+            model_version=model_version,
+            metric=ClickThroughRate(),
+            name=model_version,
+        )
+        for model_version in model_versions
+    ]
+
+
+def make_batch(page_type, clicks, shows):
+    rows = [
+        [page_type, model_version, clicks[model_version], shows[model_version]]
+        for model_version in clicks
+    ]
+    batch = pd.DataFrame(rows)
+    batch.columns = ['page_type', 'model_version', 'clicks', 'shows']
+    return batch
+
+
+@pytest.mark.parametrize('bandit_cls', [SimpleBandit, UCBBandit])
+def test_weights_order(bandit_cls):
+    batch = make_batch(
+        'desktop',
+        clicks={'7': 200, '8': 250, '9': 300},
+        shows={'7': 10000, '8': 10000, '9': 10000},
+    )
+    bandit = bandit_cls('desktop', make_models('desktop', ['7', '8', '9']), min_weight=0.05)
+    bandit.evaluate_batch(batch)
+    bandit.recalc_models_weights()
+
+    weights = bandit.get_models_weights()
+    assert weights['7'] < weights['8'] < weights['9']
+    assert np.isclose(sum(weights.values()), 1.0)
+    assert bandit.models['9'].metric.value == 300 / 11000.
+
+
+def test_min_weight():
+    batch = make_batch(
+        'desktop',
+        clicks={'1': 0, '2': 5000},
+        shows={'1': 100000, '2': 100000},
+    )
+    bandit = SimpleBandit('desktop', make_models('desktop', ['1', '2']), min_weight=0.05)
+    bandit.evaluate_batch(batch)
+    bandit.recalc_models_weights()
+
+    weights = bandit.get_models_weights()
+    assert np.isclose(weights['1'], 0.05 / 1.05)
+    assert np.isclose(weights['2'], 1.0 / 1.05)
+
+
+def test_zero_conversion():
+    batch = make_batch('mobile', clicks={'1': 0, '2': 0}, shows={'1': 10, '2': 10})
+    bandit = UCBBandit('mobile', make_models('mobile', ['1', '2']), min_weight=0.05)
+    bandit.evaluate_batch(batch)
+    with pytest.raises(ZeroConversion):
+        bandit.recalc_models_weights()
+    assert bandit.get_models_weights() == {'1': None, '2': None}
+
+
+def test_shared_engine():
+    engine = BanditEngine()
+    desktop = UCBBandit('desktop', make_models('desktop', ['1', '2']), 0.05, engine=engine)
+    mobile = UCBBandit('mobile', make_models('mobile', ['1', '2', '3']), 0.05, engine=engine)
+    with pytest.raises(MultipleBanditsPerPageType):
+        SimpleBandit('mobile', make_models('mobile', ['4']), 0.05, engine=engine)
+
+    batch = pd.concat([
+        make_batch('desktop', clicks={'1': 10, '2': 20}, shows={'1': 1000, '2': 1000}),
+        make_batch('mobile', clicks={'1': 30, '2': 20, '3': 10}, shows={'1': 1000, '2': 1000, '3': 1000}),
+    ])
+    desktop.evaluate_batch(batch)
+    mobile.evaluate_batch(batch)
+    desktop.recalc_models_weights()
+    mobile.recalc_models_weights()
+    separate = engine.weights.copy()
+
+    # one batched pass over all page types gives the same weights
+    values = engine.conversions() + engine.ucb_bonus()
+    assert engine.zero_conversion_page_types(values) == []
+    engine.set_weights(values, min_weight=0.05)
+    assert np.allclose(engine.weights, separate)
+    assert np.isclose(engine.weights[engine.arms('mobile')].sum(), 1.0)
+    assert np.isclose(engine.weights[engine.arms('desktop')].sum(), 1.0)
+
+
+def test_thompson_prob_best():
+    batch = make_batch(
+        'desktop',
+        clicks={'7': 200, '8': 290, '9': 300, '10': 0},
+        shows={'7': 10000, '8': 10000, '9': 10000, '10': 0},
+    )
+    bandit = ThompsonBandit(
+        'desktop',
+        make_models('desktop', ['7', '8', '9', '10']),
+        min_weight=0.05,
+        draws=20000,
+        chunk_size=10000,
+        seed=0,
+    )
+    bandit.evaluate_batch(batch)
+    bandit.recalc_models_weights()
+
+    weights = bandit.get_models_weights()
+    assert np.isclose(sum(weights.values()), 1.0)
+    # unexplored arm has flat posterior and is almost surely the best one
+    assert weights['10'] > 0.9 * (1 - 3 * 0.05)
+    assert weights['7'] == min(weights.values())
+    assert min(weights.values()) >= 0.05 / 1.2
+
+
+def test_thompson_zero_conversion():
+    batch = make_batch('mobile', clicks={'1': 0, '2': 0}, shows={'1': 10, '2': 10})
+    bandit = ThompsonBandit('mobile', make_models('mobile', ['1', '2']), min_weight=0.05)
+    bandit.evaluate_batch(batch)
+    with pytest.raises(ZeroConversion):
+        bandit.recalc_models_weights()
+
+
+def test_heuristic_bandit_state(tmp_path):
+    state_path = str(tmp_path / 'desktop.npz')
+    batch = make_batch(
+        'desktop',
+        clicks={'1': 200, '2': 400},
+        shows={'1': 10000, '2': 10000},
+    )
+
+    def run(steps):
+        bandit = HeuristicBandit(
+            'desktop',
+            make_models('desktop', ['1', '2']),
+            min_weight=0.05,
+            state_path=state_path,
+            penalty_ramp_steps=30,
+        )
+        for _ in range(steps):
+            bandit.evaluate_batch(batch)
+            bandit.recalc_models_weights()
+        return bandit
+
+    bandit = run(30)
+    assert bandit.step == 30
+    weights = bandit.get_models_weights()
+    assert weights['1'] < weights['2']
+
+    # state is restored, penalty keeps growing for the losing arm
+    bandit = run(30)
+    assert bandit.step == 60
+    assert bandit.get_models_weights()['1'] < weights['1']
+
+
+def test_columns_and_records_ingest():
+    clicks = {'7': 20, '8': 25, '9': 30}
+    shows = {'7': 1000, '8': 1000, '9': 1000}
+    batch = pd.concat([
+        make_batch('desktop', clicks=clicks, shows=shows),
+        make_batch('mobile', clicks={'7': 1000}, shows={'7': 1000}),
+    ])
+
+    def weights_of(evaluate):
+        bandit = UCBBandit('desktop', make_models('desktop', ['7', '8', '9']), min_weight=0.05)
+        evaluate(bandit)
+        bandit.recalc_models_weights()
+        return bandit.get_models_weights()
+
+    expected = weights_of(lambda bandit: bandit.evaluate_batch(batch))
+
+    # split rows of one model are summed
+    columns = {
+        'page_type': np.array(['desktop'] * 4 + ['mobile']),
+        'model_version': np.array(['7', '8', '9', '9', '7']),
+        'clicks': np.array([20, 25, 10, 20, 1000]),
+        'shows': np.array([1000, 1000, 400, 600, 1000]),
+    }
+    assert weights_of(lambda bandit: bandit.evaluate_columns(columns)) == expected
+
+    structured = batch[batch['page_type'] == 'desktop'][['model_version', 'clicks', 'shows']]
+    structured = structured.to_records(index=False)
+    assert weights_of(lambda bandit: bandit.evaluate_columns(structured)) == expected
+
+    # single shows of pio_recs.sopr_shows
+    events = [
+        {'page_type': page_type, 'model_version': model_version, 'clicked_cnt': int(i < c[model_version])}
+        for page_type, c, s in [('desktop', clicks, shows), ('mobile', {'7': 1000}, {'7': 1000})]
+        for model_version in s
+        for i in range(s[model_version])
+    ]
+    weights = weights_of(lambda bandit: bandit.evaluate_records(iter(events)))
+    assert np.allclose(list(weights.values()), list(expected.values()))
+
+
+def test_discounted_ucb(tmp_path):
+    state_path = str(tmp_path / 'ducb.npz')
+    bandit = DiscountedUCBBandit('desktop', make_models('desktop', ['1', '2']), 0.05,
+                                 state_path=state_path, discount=0.5)
+    bandit.evaluate_batch(make_batch('desktop', {'1': 100, '2': 10}, {'1': 1000, '2': 1000}))
+    # new events only: arm 2 became better
+    bandit.evaluate_batch(make_batch('desktop', {'1': 10, '2': 100, '3': 5}, {'1': 1000, '2': 1000, '3': 10}))
+    assert np.allclose(bandit.clicks, [60, 105])
+    assert np.allclose(bandit.shows, [1500, 1500])
+    assert bandit.events_cnt == 0.5 * 2000 + 2010
+    assert bandit.models['2'].metric.value == 105. / 2500
+
+    bandit.recalc_models_weights()
+    weights = bandit.get_models_weights()
+    assert weights['2'] > weights['1']
+
+    # counters survive restart
+    restarted = DiscountedUCBBandit('desktop', make_models('desktop', ['1', '2']), 0.05,
+                                    state_path=state_path, discount=0.5)
+    assert restarted.step == 2
+    restarted.recalc_models_weights()
+    assert restarted.get_models_weights() == weights
+
+    # other model versions: state is reset
+    changed = DiscountedUCBBandit('desktop', make_models('desktop', ['1', '3']), 0.05,
+                                  state_path=state_path)
+    assert changed.step == 0
+    assert np.allclose(changed.shows, 0)
+
+
+def test_sliding_window_ucb(tmp_path):
+    state_path = str(tmp_path / 'swucb.npz')
+    bandit = SlidingWindowUCBBandit('desktop', make_models('desktop', ['1', '2']), 0.05,
+                                    state_path=state_path, window=2)
+    for clicks in [100, 50, 10]:
+        bandit.evaluate_records([
+            {'page_type': 'desktop', 'model_version': '1', 'clicks': clicks, 'shows': 1000},
+            {'page_type': 'mobile', 'model_version': '1', 'clicks': 1000, 'shows': 1000},
+        ])
+    # last two batches only, arm 2 never shown
+    assert bandit.models['1'].metric.clicks == 60
+    assert bandit.models['1'].metric.shows == 2000 + 1000
+    assert bandit.models['2'].metric.shows is None
+
+    restarted = SlidingWindowUCBBandit('desktop', make_models('desktop', ['1', '2']), 0.05,
+                                       state_path=state_path, window=2)
+    restarted.add_increment(['2'], [30], [1000])
+    assert restarted.models['1'].metric.clicks == 10
+    assert restarted.models['2'].metric.clicks == 30
+    assert restarted.engine.events_cnt[0] == 2000
+
+
+def test_sliding_window_forgets_arm(tmp_path):
+    state_path = str(tmp_path / 'swucb.npz')
+
+    def make_bandit():
+        return SlidingWindowUCBBandit('desktop', make_models('desktop', ['1', '2']), 0.05,
+                                      state_path=state_path, window=2)
+
+    bandit = make_bandit()
+    bandit.add_increment(['1', '2'], [10, 90], [1000, 1000])
+    bandit.add_increment(['1'], [10], [1000])
+    bandit.add_increment(['1'], [10], [1000])
+    # arm 2 left the window: it is never evaluated again, not stuck at its old CTR
+    assert np.isnan(bandit.engine.shows[1])
+    assert bandit.models['2'].metric.value is None
+    bandit.recalc_models_weights()
+    weights = bandit.get_models_weights()
+    assert weights['1'] > weights['2']
+
+    restarted = make_bandit()
+    restarted.recalc_models_weights()
+    assert np.allclose(
+        list(restarted.get_models_weights().values()),
+        list(weights.values()),
+    )
@@ -0,0 +1,47 @@
+import numpy as np
+
+from cian_bandit.contextual import LinUCBBandit
+from cian_bandit.metrics import ClickThroughRate
+from cian_bandit.models import Model
+
+
+def make_bandit(n_features, alpha=1.0):
+    models = [
+        Model(page_type='desktop', model_version=mv, metric=ClickThroughRate(), name=mv)
+        for mv in ['9', '10', '11']
+    ]
+    return LinUCBBandit('desktop', models, n_features=n_features, alpha=alpha)
+
+
+def test_sherman_morrison_matches_inverse():
+    rng = np.random.default_rng(0)
+    bandit = make_bandit(n_features=4)
+    model_versions = rng.choice(['9', '10', '11', 'unknown'], size=300)
+    contexts = rng.random((300, 4))
+    rewards = rng.random(300) < 0.1
+    bandit.update(model_versions[:100], contexts[:100], rewards[:100])
+    bandit.update(model_versions[100:], contexts[100:], rewards[100:])
+
+    for i, mv in enumerate(['9', '10', '11']):
+        mask = model_versions == mv
+        x = contexts[mask]
+        a = np.eye(4) + x.T @ x
+        b = (rewards[mask][:, None] * x).sum(axis=0)
+        assert np.allclose(bandit.A_inv[i], np.linalg.inv(a))
+        assert np.allclose(bandit.theta[i], np.linalg.solve(a, b))
+        assert bandit.events_cnt[i] == mask.sum()
+
+
+def test_choose_by_context():
+    rng = np.random.default_rng(1)
+    bandit = make_bandit(n_features=2, alpha=0.1)
+    # '9' is good for first feature (region), '10' for second, '11' is bad
+    contexts = np.eye(2)[rng.integers(2, size=6000)]
+    model_versions = rng.choice(['9', '10', '11'], size=6000)
+    ctr = np.where(model_versions == '9', contexts[:, 0] * 0.3, 0.0)
+    ctr = np.where(model_versions == '10', contexts[:, 1] * 0.3, ctr)
+    ctr = np.where(model_versions == '11', 0.05, ctr)
+    bandit.update(model_versions, contexts, rng.random(6000) < ctr)
+
+    assert list(bandit.choose(np.eye(2))) == ['9', '10']
+    assert bandit.score(np.eye(2)).shape == (2, 3)
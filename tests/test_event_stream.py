@@ -0,0 +1,144 @@
+import json
+
+import numpy as np
+
+from cian_bandit.bandit_updater import BanditUpdater
+from cian_bandit.event_stream import JsonlEventReader
+from cian_bandit.event_stream import StreamingUpdater
+from cian_bandit.event_stream import aggregate_events
+from cian_bandit.metrics import ClickThroughRate
+
+
+class FakeClock(object):
+    def __init__(self):
+        self.now = 0.
+
+    def __call__(self):
+        return self.now
+
+
+class RecordingUpdater(BanditUpdater):
+    def __init__(self):
+        BanditUpdater.__init__(self, weights_storage=None, batch=None, really_update_es=False)
+        self.published = []
+
+    def publish(self, bandit, config):
+        self.published.append((bandit.page_type, bandit.get_models_weights()))
+
+
+def write_events(path, events, tail=''):
+    with open(path, 'a') as f:
+        for event in events:
+            f.write(json.dumps(event) + '\n')
+        f.write(tail)
+
+
+def shows(model_version, n, clicks):
+    return [
+        {'page_type': 'desktop', 'model_version': model_version, 'clicked_cnt': int(i < clicks)}
+        for i in range(n)
+    ]
+
+
+def test_reader_keeps_partial_lines(tmp_path):
+    path = str(tmp_path / 'shows.jsonl')
+    reader = JsonlEventReader(path)
+    assert reader.read() == []
+
+    write_events(path, shows('9', 3, 1), tail='{"page_type": "desk')
+    assert len(reader.read()) == 3
+    write_events(path, [], tail='top", "model_version": 9}\n')
+    events = reader.read()
+    assert events == [{'page_type': 'desktop', 'model_version': 9}]
+    stats, malformed = aggregate_events(events)
+    assert stats['desktop']['9'] == [0, 1] and malformed == 0
+
+
+def test_streaming_updater(tmp_path):
+    path = str(tmp_path / 'shows.jsonl')
+    config = {'mobile': {}, 'desktop': {'9': {}, '10': {}}}
+    clock = FakeClock()
+    updater = RecordingUpdater()
+    streaming = StreamingUpdater(
+        updater=updater,
+        reader=JsonlEventReader(path),
+        config=config,
+        publish_interval=60.,
+        change_threshold=0.1,
+        clock=clock,
+    )
+
+    write_events(path, shows('9', 1000, 50) + shows('10', 1000, 50))
+    assert streaming.poll() == ['desktop']
+    first = updater.published[-1][1]
+    assert np.isclose(first['9'], first['10'])
+
+    # small change: neither threshold nor interval reached
+    clock.now = 10.
+    write_events(path, shows('9', 100, 10))
+    assert streaming.poll() == []
+
+    clock.now = 61.
+    assert streaming.poll() == ['desktop']
+    assert updater.published[-1][1]['9'] > updater.published[-1][1]['10']
+    assert streaming.poll() == []
+
+    # big change is published right away
+    clock.now = 62.
+    write_events(path, shows('10', 5000, 2500))
+    assert streaming.poll() == ['desktop']
+    assert streaming.events_cnt == 7100
+    desktop = [b for b in updater.bandits if b.page_type == 'desktop'][0]
+    assert desktop.models['10'].metric.clicks == 2550
+    assert desktop.models['10'].metric.shows == 6000 + ClickThroughRate().smooth
+
+
+class FailingReader(object):
+    def __init__(self, events, failures):
+        self.events = events
+        self.failures = failures
+
+    def read(self):
+        if self.failures:
+            self.failures -= 1
+            raise IOError('log is not mounted')
+        events, self.events = self.events, []
+        return events
+
+
+class FlakyUpdater(RecordingUpdater):
+    def __init__(self, failures):
+        RecordingUpdater.__init__(self)
+        self.failures = failures
+
+    def publish(self, bandit, config):
+        if self.failures:
+            self.failures -= 1
+            raise ConnectionError('es is down')
+        RecordingUpdater.publish(self, bandit, config)
+
+
+def test_streaming_updater_errors(tmp_path):
+    path = str(tmp_path / 'shows.jsonl')
+    config = {'mobile': {}, 'desktop': {'9': {}, '10': {}}}
+    updater = FlakyUpdater(failures=1)
+    streaming = StreamingUpdater(updater, JsonlEventReader(path), config, clock=FakeClock())
+
+    write_events(path, shows('9', 100, 5) + [
+        {'model_version': '9', 'clicked_cnt': 1},
+        {'page_type': 'desktop', 'model_version': '10', 'clicked_cnt': 'x'},
+        [1, 2],
+    ] + shows('10', 100, 5))
+    # es error: logged, desktop is published on the next poll
+    assert streaming.poll() == []
+    assert streaming.last_poll_failed and streaming.publish_errors == 1
+    assert streaming.malformed_cnt == 3 and streaming.events_cnt == 200
+    assert streaming.poll() == ['desktop']
+    assert not streaming.last_poll_failed
+
+    sleeps = []
+    streaming.reader = FailingReader(shows('9', 10, 1), failures=3)
+    streaming.run(poll_interval=1., max_polls=5, max_backoff=5., sleep=sleeps.append)
+    # backs off while the reader fails, then back to poll_interval
+    assert sleeps == [2., 4., 5., 1., 1.]
+    assert streaming.events_cnt == 210
@@ -28,3 +28,82 @@ def test_events_storage():
     batch = events_storage.get_batch()
     # how to test db?
     assert len(batch) > 0 and batch['clicks'].sum() > 1000
+
+
+def make_sopr_shows():
+    return pd.DataFrame({
+        'model_version': ['a', 'a', 'a', 'a', 'b', 'b', 'b', 'b'],
+        'cid': [1, 2, 1, 3, 4, 4, 5, 6],
+        'clicked_cnt': [1, 0, 2, 1, 0, 0, 1, 1],
+        'phoned_cnt': [0, 0, 1, 0, 0, 1, 0, 0],
+        'recommended_dadd': [
+            '2019-03-02 10:00:00', '2019-03-02 11:00:00',
+            '2019-03-02 12:00:00', '2019-03-01 09:00:00',
+            '2019-03-02 10:00:00', '2019-03-02 10:00:00',
+            '2019-03-02 09:00:00', '2019-03-01 23:00:00',
+        ],
+        'ptn_dadd': [
+            '2019-03-02', '2019-03-02', '2019-03-02', '2019-03-01',
+            '2019-03-02', '2019-03-02', '2019-03-02', '2019-02-27',
+        ],
+        'unused': range(8),
+    })
+
+
+def test_aggregate_last_events():
+    from cian_bandit.events_storage import aggregate_last_events
+
+    events = make_sopr_shows()
+    events['recommended_dadd'] = pd.to_datetime(events['recommended_dadd'])
+    batch = aggregate_last_events(events, 2).set_index('model_version')
+
+    assert list(batch.reset_index().columns) == metrics_sql_columns
+    # a: two freshest events
+    assert batch.loc['a'].tolist() == [2, 1, 2, 2, 1, 1]
+    # b: both 10:00 events tie for the first place as in rank()
+    assert batch.loc['b'].tolist() == [0, 1, 2, 1, 0, 1]
+
+
+def test_local_events_backend(tmp_path):
+    from datetime import date
+    from cian_bandit.events_storage import LocalEventsBackend
+
+    path = str(tmp_path / 'sopr_shows.csv')
+    make_sopr_shows().to_csv(path, index=False)
+
+    backend = LocalEventsBackend(path, days=1, current_date=date(2019, 3, 2))
+    events_storage = EventsStorage(3, backend=backend)
+    batch = events_storage.get_batch().set_index('model_version')
+    # 2019-02-27 partition of b is out of the window
+    assert batch['shows'].to_dict() == {'a': 3, 'b': 3}
+    assert batch.loc['a', 'clicks'] == 3
+
+    batches = events_storage.get_batches([1, 10])
+    assert batches[1]['shows'].tolist() == [1, 2]
+    assert batches[10]['shows'].tolist() == [4, 3]
+
+    all_events = LocalEventsBackend(path, days=None).download(10)
+    assert all_events['shows'].tolist() == [4, 4]
+
+    # segments: events are ranked and aggregated per region and model_version
+    events = make_sopr_shows().assign(region=['msk', 'spb'] * 4)
+    events.to_csv(path, index=False)
+    by_region = LocalEventsBackend(path, days=None).download(1, group_columns=['region'])
+    assert list(by_region.columns) == ['region'] + metrics_sql_columns
+    assert by_region[['region', 'model_version', 'shows']].values.tolist() == [
+        ['msk', 'a', 1], ['msk', 'b', 1], ['spb', 'a', 1], ['spb', 'b', 1],
+    ]
+
+
+def test_local_events_backend_parquet(tmp_path):
+    pytest.importorskip('pyarrow')
+    from cian_bandit.events_storage import LocalEventsBackend
+
+    csv_path = str(tmp_path / 'sopr_shows.csv')
+    parquet_path = str(tmp_path / 'sopr_shows.parquet')
+    make_sopr_shows().to_csv(csv_path, index=False)
+    make_sopr_shows().to_parquet(parquet_path)
+
+    from_csv = LocalEventsBackend(csv_path, days=None).download(2)
+    from_parquet = LocalEventsBackend(parquet_path, days=None).download(2)
+    pd.testing.assert_frame_equal(from_csv, from_parquet)
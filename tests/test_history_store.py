@@ -0,0 +1,131 @@
+import numpy as np
+import pytest
+
+from cian_bandit.history_store import HISTORY_DTYPE
+from cian_bandit.history_store import HistoryFormatError
+from cian_bandit.history_store import HistoryStore
+from cian_bandit.metrics import ClickThroughRate
+from cian_bandit.models import Model
+from cian_bandit.weights_storage import WeightStorage
+from es_fakes import FakeConflictingEs
+
+
+def test_append_and_read(tmp_path):
+    path = str(tmp_path / 'history.bin')
+    store = HistoryStore(path)
+    assert len(store) == 0
+    assert len(store.last(10)) == 0
+
+    for step in range(100):
+        store.append(
+            timestamp=1000.0 + step,
+            page_type='desktop',
+            model_versions=['1', '2'],
+            probs=[0.4, 0.6],
+            conversions=[0.01, 0.02],
+            shows=[1000 + step, 2000],
+            clicks=[10, 40],
+        )
+        store.append(1000.0 + step, 'mobile', ['3'], [1.0], [0.03])
+
+    assert len(store) == 300
+    records = store.records()
+    assert records.dtype == HISTORY_DTYPE
+    assert isinstance(records, np.memmap)
+
+    last = store.last(3, page_type='desktop', model_version='1')
+    assert last['shows'].tolist() == [1097, 1098, 1099]
+    assert store.range(1010.0, 1012.0, page_type='mobile')['timestamp'].tolist() == [1010.0, 1011.0]
+    assert len(store.last(5, page_type='unknown')) == 0
+
+    with pytest.raises(ValueError):
+        store.append(999.0, 'desktop', ['1'], [1.0], [0.01])
+
+    # reopened store sees the same records and keys
+    reopened = HistoryStore(path)
+    timestamps, model_versions, probs, conversions = reopened.arm_series('desktop', 10)
+    assert timestamps.tolist() == [1090.0 + i for i in range(10)]
+    assert model_versions == ['1', '2']
+    assert probs.shape == (10, 2)
+    assert np.allclose(conversions[:, 1], 0.02)
+    assert reopened.previous_weights('mobile', 4)['3'] == [1.0] * 4
+
+    with open(str(tmp_path / 'not_history.bin'), 'wb') as f:
+        f.write(b'garbage' * 10)
+    with pytest.raises(HistoryFormatError):
+        HistoryStore(str(tmp_path / 'not_history.bin'))
+
+
+def test_weight_storage_history(tmp_path, monkeypatch):
+    now = [100.0]
+    store = HistoryStore(str(tmp_path / 'history.bin'))
+    storage = WeightStorage(['localhost'], clock=lambda: now[0], history_store=store)
+    storage.es_client = FakeConflictingEs(
+        source={'mobile': {}, 'desktop': {'1': {'prob': 0.5}}, 'config_version': 3},
+        taken_versions=[],
+    )
+    metric = ClickThroughRate(smooth=1000)
+    metric.add_batch({'clicks': 30, 'shows': 2000}, 2000)
+    model = Model(page_type='desktop', model_version='1', metric=metric, name='1')
+    for weight in [0.3, 0.5, 0.7]:
+        now[0] += 60
+        model.weight = weight
+        storage.update_page_type_models_weights(
+            page_type='desktop',
+            models={'1': model},
+            page_type_config={'1': {'parameters': {}}},
+        )
+
+    last = store.last(1)
+    assert last['shows'].tolist() == [2000]
+    assert last['clicks'].tolist() == [30]
+    assert np.isclose(last['conversion'][0], 0.01)
+    assert storage.get_previous_weights('desktop', 2)['1'] == [0.7, 0.5]
+
+    # clock stepped back: the version is still published, its history skipped
+    now[0] -= 600
+    model.weight = 0.9
+    doc = storage.update_page_type_models_weights(
+        page_type='desktop',
+        models={'1': model},
+        page_type_config={'1': {'parameters': {}}},
+    )
+    assert storage.es_client.created[-1] == str(doc['config_version'])
+    assert len(store) == 3
+
+
+def test_last_scans_from_tail(tmp_path, monkeypatch):
+    from cian_bandit import history_store
+
+    monkeypatch.setattr(history_store, 'LAST_CHUNK', 10)
+    store = HistoryStore(str(tmp_path / 'history.bin'))
+    store.append(1.0, 'mobile', ['3'], [1.0], [0.03])
+    for step in range(100):
+        store.append(2.0 + step, 'desktop', ['1', '2'], [0.4, 0.6], [0.01, 0.02])
+
+    assert store.last(3, page_type='desktop', model_version='2')['timestamp'].tolist() == [99.0, 100.0, 101.0]
+    # the only mobile record is at the head: all chunks are scanned
+    assert store.last(2, page_type='mobile')['timestamp'].tolist() == [1.0]
+    assert len(store.last(25, page_type='desktop')) == 25
+    assert store.last(2)['model_version'].tolist() == [store._code('1'), store._code('2')]
+
+
+def test_two_writers(tmp_path):
+    path = str(tmp_path / 'history.bin')
+    daemon = HistoryStore(path)
+    cron = HistoryStore(path)
+
+    daemon.append(100.0, 'desktop', ['1', '2'], [0.4, 0.6], [0.01, 0.02])
+    cron.append(160.0, 'mobile', ['3', '1'], [0.5, 0.5], [0.03, 0.01])
+    daemon.append(220.0, 'desktop', ['2'], [1.0], [0.02])
+
+    for store in [daemon, cron, HistoryStore(path)]:
+        records = store.records()
+        assert [store.key(code) for code in records['page_type']] == ['desktop'] * 2 + ['mobile'] * 2 + ['desktop']
+        assert [store.key(code) for code in records['model_version']] == ['1', '2', '3', '1', '2']
+    with open(path + '.keys') as f:
+        assert len(f.readlines()) == 5
+
+    # the other writer's timestamp is seen too
+    with pytest.raises(ValueError):
+        cron.append(200.0, 'mobile', ['3'], [1.0], [0.03])
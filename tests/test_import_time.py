@@ -0,0 +1,46 @@
+import json
+import os
+import subprocess
+import sys
+
+
+# bandit math and weight reading: standard library and numpy only
+CORE_MODULES = [
+    'cian_bandit.bandit_updater',
+    'cian_bandit.bandits',
+    'cian_bandit.contextual',
+    'cian_bandit.engine',
+    'cian_bandit.event_stream',
+    'cian_bandit.history_store',
+    'cian_bandit.rewards',
+    'cian_bandit.instrumentation',
+    'cian_bandit.sampler',
+    'cian_bandit.weights_storage',
+]
+HEAVY_MODULES = ['pandas', 'scipy', 'elasticsearch', 'pyhive', 'requests']
+IMPORT_TIME_BUDGET = 1.0
+
+MEASURE = """
+import json, sys, time
+started = time.perf_counter()
+for module in {modules!r}:
+    __import__(module)
+elapsed = time.perf_counter() - started
+print(json.dumps({{
+    'seconds': elapsed,
+    'heavy': [m for m in {heavy!r} if m in sys.modules],
+}}))
+"""
+
+
+def measure_import(modules):
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    code = MEASURE.format(modules=modules, heavy=HEAVY_MODULES)
+    output = subprocess.check_output([sys.executable, '-c', code], cwd=root)
+    return json.loads(output.decode().strip().splitlines()[-1])
+
+
+def test_core_imports_are_light():
+    result = measure_import(CORE_MODULES)
+    assert result['heavy'] == []
+    assert result['seconds'] < IMPORT_TIME_BUDGET
@@ -0,0 +1,112 @@
+import json
+
+import pandas as pd
+
+from cian_bandit import instrumentation
+from cian_bandit.bandit_updater import BanditUpdater
+from cian_bandit.instrumentation import Instrumentation
+from cian_bandit.instrumentation import NullInstrumentation
+
+
+def test_spans_and_counters(tmp_path):
+    instr = Instrumentation(clock=lambda: 100.0)
+    for _ in range(3):
+        with instr.span('evaluate'):
+            pass
+    instr.incr('rows_fetched', 10)
+    instr.incr('rows_fetched', 5)
+
+    snapshot = instr.snapshot()
+    assert snapshot['spans']['evaluate']['count'] == 3
+    assert snapshot['spans']['evaluate']['seconds'] >= 0
+    assert snapshot['counters'] == {'rows_fetched': 15}
+
+    text = instr.to_prometheus()
+    assert 'cian_bandit_stage_runs_total{stage="evaluate"} 3' in text
+    assert 'cian_bandit_rows_fetched_total 15' in text
+
+    prom_path = str(tmp_path / 'bandit.prom')
+    instr.export(prom_path)
+    instr.export(prom_path)
+    with open(prom_path) as f:
+        assert f.read() == text
+
+    jsonl_path = str(tmp_path / 'bandit.jsonl')
+    instr.export(jsonl_path, 'jsonl')
+    instr.export(jsonl_path, 'jsonl')
+    with open(jsonl_path) as f:
+        lines = [json.loads(line) for line in f]
+    assert len(lines) == 2
+    assert lines[0]['counters'] == {'rows_fetched': 15}
+
+
+def test_disabled_by_default():
+    assert isinstance(instrumentation.get_instrumentation(), NullInstrumentation)
+    with instrumentation.span('evaluate'):
+        instrumentation.incr('rows_fetched')
+
+
+def test_updater_instrumentation():
+    config = {
+        'desktop': {'1': {}, '2': {}},
+        'mobile': {'3': {}, '4': {}},
+    }
+    batch = pd.DataFrame({
+        'page_type': ['desktop', 'desktop', 'mobile', 'mobile'],
+        'model_version': ['1', '2', '3', '4'],
+        'clicks': [10, 20, 0, 0],
+        'shows': [1000, 1000, 1000, 1000],
+    })
+    instr = Instrumentation()
+    previous = instrumentation.set_instrumentation(instr)
+    try:
+        updater = BanditUpdater(weights_storage=None, batch=batch, really_update_es=False)
+        updater.init_bandits(config)
+        updater.update_bandits(config)
+    finally:
+        instrumentation.set_instrumentation(previous)
+
+    snapshot = instr.snapshot()
+    assert snapshot['counters'] == {'arms_updated': 2, 'zero_conversion': 1}
+    assert snapshot['spans']['evaluate']['count'] == 2
+    assert snapshot['spans']['recompute']['count'] == 2
+    # really_update_es=False: nothing is written, nothing is timed as a write
+    assert 'es_write' not in snapshot['spans']
+
+
+class MemoryEs(object):
+    def search(self, **kwargs):
+        return {'hits': {'hits': [{'_id': '1', '_source': {'config_version': 1, 'desktop': {}}}]}}
+
+    def create(self, **kwargs):
+        pass
+
+
+def test_es_spans(monkeypatch):
+    from elasticsearch import helpers
+    from cian_bandit.weights_storage import WeightStorage
+
+    monkeypatch.setattr(helpers, 'bulk', lambda client, actions, **kwargs: (len(list(actions)), []))
+    config = {'desktop': {'1': {}, '2': {}}, 'mobile': {'3': {}}}
+    batch = pd.DataFrame({
+        'page_type': ['desktop', 'desktop', 'mobile'],
+        'model_version': ['1', '2', '3'],
+        'clicks': [10, 20, 5],
+        'shows': [1000, 1000, 1000],
+    })
+    for bulk in (False, True):
+        instr = Instrumentation()
+        previous = instrumentation.set_instrumentation(instr)
+        try:
+            storage = WeightStorage(['localhost'], cache_ttl=0)
+            storage.es_client = MemoryEs()
+            updater = BanditUpdater(storage, batch, True, bulk=bulk)
+            updater.init_bandits(config)
+            updater.update_bandits(config)
+        finally:
+            instrumentation.set_instrumentation(previous)
+        spans = instr.snapshot()['spans']
+        # one read of the last version and one write of desktop (mobile is not published)
+        assert spans['es_read']['count'] == 1
+        assert spans['es_write']['count'] == 1
+        assert 'es_bulk' not in spans
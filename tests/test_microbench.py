@@ -0,0 +1,71 @@
+import json
+import pstats
+
+import pandas as pd
+
+from cian_bandit import microbench
+from cian_bandit.bandit_updater import BanditUpdater
+
+
+def test_microbench_quick(tmp_path, capsys):
+    results = microbench.run(
+        arm_counts=(2,),
+        batch_rows=(100,),
+        repeat=1,
+        min_seconds=0.0,
+        names=['evaluate_batch', 'simple', 'add_batch', 'config_doc', 'LinUCB'],
+    )
+    assert list(results) == [
+        'evaluate_batch/arms=2/rows=100',
+        'LinUCBBandit.update/arms=2/rows=100',
+        'recalc_models_weights/simple/arms=2',
+        'ClickThroughRate.add_batch/arms=2',
+        'WeightStorage.config_doc/arms=2',
+    ]
+    assert all(seconds > 0 for seconds in results.values())
+
+    baseline_path = str(tmp_path / 'baseline.json')
+    args = ['--quick', '--repeat', '1', '--filter', 'config_doc/arms=20']
+    assert microbench.main(args + ['--save', baseline_path]) == 0
+    with open(baseline_path) as f:
+        baseline = json.load(f)
+    # times in calibration units, not seconds of this machine
+    assert list(baseline) == ['relative']
+    assert list(baseline['relative']) == ['WeightStorage.config_doc/arms=20']
+
+    # a baseline nobody can beat is a regression
+    with open(baseline_path, 'w') as f:
+        json.dump({'relative': {'WeightStorage.config_doc/arms=20': 1e-12}}, f)
+    assert microbench.main(args + ['--compare', baseline_path]) == 1
+    assert 'REGRESSION' in capsys.readouterr().out
+
+
+def test_relative():
+    unit = microbench.calibrate(repeat=1, min_seconds=0.0)
+    assert unit > 0
+    ratios = microbench.relative({'a': 2 * unit}, unit)
+    assert ratios == {'a': 2.0}
+
+
+def test_compare():
+    baseline = {'a': 1.0, 'b': 1.0}
+    results = {'a': 1.2, 'b': 1.3, 'new': 5.0}
+    assert microbench.compare(results, baseline, tolerance=0.25) == [('b', 1.0, 1.3)]
+
+
+def test_update_bandits_profile(tmp_path):
+    config = {'desktop': {'1': {}, '2': {}}}
+    batch = pd.DataFrame({
+        'page_type': ['desktop', 'desktop'],
+        'model_version': ['1', '2'],
+        'clicks': [10, 20],
+        'shows': [1000, 1000],
+    })
+    profile_path = str(tmp_path / 'update.pstats')
+    updater = BanditUpdater(None, batch, False, profile_path=profile_path)
+    updater.init_bandits(config)
+    results = updater.update_bandits(config)
+
+    assert results['desktop']['2'] > results['desktop']['1']
+    functions = [func for _, _, func in pstats.Stats(profile_path).stats]
+    assert 'recalc_models_weights' in functions
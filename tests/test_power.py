@@ -0,0 +1,104 @@
+import numpy as np
+import pandas as pd
+
+from cian_bandit.metrics_sql import metrics_sql_columns
+from cian_bandit.metrics_sql import metrics_windows_columns
+from cian_bandit.metrics_sql import metrics_windows_dtype
+from cian_bandit.events_storage import split_windows
+from cian_bandit.power import adaptive_batch
+from cian_bandit.power import choose_windows
+from cian_bandit.power import default_windows
+from cian_bandit.power import required_events
+
+
+def make_batch(ctrs, cnt):
+    model_versions = list(ctrs)
+    shows = np.full(len(model_versions), cnt)
+    return pd.DataFrame({
+        'model_version': model_versions,
+        'clicks': (shows * np.array([ctrs[mv] for mv in model_versions])).astype(int),
+        'phones': 0,
+        'shows': shows,
+        'users': shows,
+        'click_bounced': 0,
+        'phone_bounced': 0,
+    })[metrics_sql_columns]
+
+
+def test_required_events():
+    # textbook value for 5% vs 6% CTR
+    assert required_events(0.05, 0.06) == 8158
+    assert required_events(0.05, 0.06, power=0.9) > 8158
+    assert required_events(0.05, 0.06, alpha=0.01) > 8158
+    assert np.isinf(required_events(0.05, 0.05))
+    assert default_windows(50000) == [5000, 10000, 25000, 50000]
+
+
+def test_choose_windows():
+    windows = [5000, 10000, 25000, 50000]
+    ctrs = {'leader': 0.10, 'bad': 0.05, 'close': 0.095}
+    batches = {cnt: make_batch(ctrs, cnt) for cnt in windows}
+    chosen = choose_windows(batches)
+    # the leader is close to the runner-up: all arms need the largest window
+    assert chosen == {'leader': 50000, 'bad': 50000, 'close': 50000}
+
+    clear = {cnt: make_batch({'leader': 0.10, 'bad': 0.05, 'worse': 0.04}, cnt) for cnt in windows}
+    batch, chosen = adaptive_batch(clear)
+    shows = dict(zip(batch['model_version'], batch['shows']))
+    assert shows == {'leader': 5000, 'bad': 5000, 'worse': 5000}
+    assert list(batch.columns) == metrics_sql_columns
+
+    one_model = {cnt: make_batch({'only': 0.1}, cnt) for cnt in windows}
+    assert choose_windows(one_model) == {'only': 50000}
+
+
+def test_split_windows():
+    windows = [10, 100]
+    assert metrics_windows_columns(windows)[:3] == ['model_version', 'clicks_10', 'phones_10']
+    result = np.zeros(2, dtype=metrics_windows_dtype(windows))
+    result['model_version'] = ['1', '2']
+    result['shows_10'] = [10, 10]
+    result['shows_100'] = [100, 70]
+    batches = split_windows(result, windows)
+    assert list(batches[10].columns) == metrics_sql_columns
+    assert batches[10]['shows'].tolist() == [10, 10]
+    assert batches[100]['shows'].tolist() == [100, 70]
+
+
+def test_choose_windows_by_segment():
+    windows = [5000, 50000]
+    msk = {'leader': 0.10, 'bad': 0.05}
+    spb = {'leader': 0.10, 'bad': 0.099}
+    batches = {
+        cnt: pd.concat([
+            make_batch(msk, cnt).assign(region='msk'),
+            make_batch(spb, cnt).assign(region='spb'),
+        ], ignore_index=True)
+        for cnt in windows
+    }
+    # arms are compared within their region only
+    chosen = choose_windows(batches, group_columns=['region'])
+    assert chosen[('msk', 'bad')] == chosen[('msk', 'leader')] == 5000
+    assert chosen[('spb', 'bad')] == chosen[('spb', 'leader')] == 50000
+
+    batch, _ = adaptive_batch(batches, group_columns=['region'])
+    assert len(batch) == 4
+    assert batch.loc[batch['region'] == 'msk', 'shows'].tolist() == [5000, 5000]
+    assert batch.loc[batch['region'] == 'spb', 'shows'].tolist() == [50000, 50000]
+
+
+def test_adaptive_batch_bonus_is_not_biased():
+    from cian_bandit.bandits import UCBBandit
+    from cian_bandit.metrics import ClickThroughRate
+    from cian_bandit.models import Model
+
+    windows = [5000, 50000]
+    # a and b are equal, c is clearly worse: it alone would do with 5000 events
+    batches = {cnt: make_batch({'a': 0.10, 'b': 0.10, 'c': 0.02}, cnt) for cnt in windows}
+    batch, _ = adaptive_batch(batches)
+    models = [Model('desktop', mv, ClickThroughRate(), mv) for mv in ['a', 'b', 'c']]
+    bandit = UCBBandit('desktop', models, min_weight=0.05)
+    bandit.evaluate_batch(batch)
+    bonus = bandit.engine.ucb_bonus(bandit.arms)
+    # the same window for all arms: no exploration bonus for the short-window arm
+    assert np.allclose(bonus, bonus[0])
@@ -0,0 +1,123 @@
+import asyncio
+import threading
+import time
+
+import pytest
+
+from cian_bandit import presto
+from cian_bandit.metrics_sql import metrics_sql_columns
+from cian_bandit.metrics_sql import metrics_sql_dtype
+from cian_bandit.presto import ColumnOverflow
+from cian_bandit.presto import PrestoClient
+
+
+class SlowCursor(object):
+    running = 0
+    max_running = 0
+    lock = threading.Lock()
+
+    def __init__(self, username):
+        self.username = username
+
+    def execute(self, sql_body):
+        with SlowCursor.lock:
+            SlowCursor.running += 1
+            SlowCursor.max_running = max(SlowCursor.max_running, SlowCursor.running)
+        self.sql_body = sql_body
+        time.sleep(float(sql_body))
+        with SlowCursor.lock:
+            SlowCursor.running -= 1
+
+    def fetchall(self):
+        return [(self.sql_body, self.username)]
+
+    def close(self):
+        pass
+
+
+class SlowConnection(object):
+    def __init__(self, username, **kwargs):
+        self.username = username
+
+    def cursor(self):
+        return SlowCursor(self.username)
+
+    def close(self):
+        pass
+
+
+def test_run_many(monkeypatch):
+    monkeypatch.setattr(presto.presto, 'connect', SlowConnection)
+    client = PrestoClient(username='bandit', pool_size=2)
+    queries = {'slow': '0.3', 'fast_1': '0.05', 'fast_2': '0.05'}
+
+    async def collect():
+        return [key async for key, rows in client.as_completed(queries)]
+
+    assert asyncio.run(collect())[-1] == 'slow'
+    assert SlowCursor.max_running == 2
+
+    SlowCursor.max_running = 0
+    results = client.run_many(queries, username='other')
+    assert SlowCursor.max_running == 2
+    assert results['fast_1'] == [('0.05', 'other')]
+    # global config is untouched
+    assert presto.presto_config['username'] == 'alaktionov'
+    client.close()
+
+
+class RowsCursor(object):
+    rows = []
+
+    def __init__(self):
+        self.fetched = 0
+        self.arraysize = 1
+
+    def execute(self, sql_body):
+        pass
+
+    def fetchmany(self, size):
+        rows = RowsCursor.rows[self.fetched:self.fetched + size]
+        self.fetched += len(rows)
+        return rows
+
+    def close(self):
+        pass
+
+
+class RowsConnection(object):
+    def __init__(self, **kwargs):
+        pass
+
+    def cursor(self):
+        return RowsCursor()
+
+    def close(self):
+        pass
+
+
+def test_fetch_arrays(monkeypatch):
+    monkeypatch.setattr(presto.presto, 'connect', RowsConnection)
+    RowsCursor.rows = [[str(i), i, None, 10 * i, i, 0, 0] for i in range(25)]
+    client = PrestoClient(username='bandit')
+
+    chunks = [len(chunk) for chunk in client.iter_arrays('', metrics_sql_dtype, arraysize=10)]
+    assert chunks == [10, 10, 5]
+
+    result = client.fetch_arrays('', metrics_sql_dtype, arraysize=4)
+    assert result.dtype.names == tuple(metrics_sql_columns)
+    assert len(result) == 25
+    assert result['model_version'][24] == '24'
+    assert result['shows'].sum() == 10 * sum(range(25))
+    assert (result['phones'] == 0).all()
+    client.close()
+
+
+def test_fetch_arrays_overflow(monkeypatch):
+    monkeypatch.setattr(presto.presto, 'connect', RowsConnection)
+    RowsCursor.rows = [['1', 1, 0, 10, 1, 0, 0], ['x' * 65, 1, 0, 10, 1, 0, 0]]
+    client = PrestoClient(username='bandit')
+    # model_version would be silently truncated by numpy
+    with pytest.raises(ColumnOverflow):
+        client.fetch_arrays('', metrics_sql_dtype)
+    client.close()
@@ -0,0 +1,125 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from cian_bandit.bandit_updater import BanditUpdater
+from cian_bandit.bandit_updater import config_page_types
+from cian_bandit.bandits import DiscountedUCBBandit
+from cian_bandit.bandits import UCBBandit
+from cian_bandit.metrics import ClickThroughRate
+from cian_bandit.models import Model
+from cian_bandit.rewards import CompositeReward
+from cian_bandit.rewards import MissingRewardColumn
+from cian_bandit.rewards import UnknownReward
+
+
+def make_batch():
+    # model 1 gets more clicks, model 2 gets more phone calls
+    return pd.DataFrame({
+        'page_type': ['desktop', 'desktop', 'desktop', 'desktop', 'mobile'],
+        'model_version': ['1', '2', '1', '2', '1'],
+        'clicks': [300, 150, 100, 50, 999],
+        'phones': [5, 40, 5, 20, 999],
+        'shows': [6000, 6000, 4000, 4000, 10],
+        'users': [1000, 1000, 1000, 1000, 10],
+        'click_bounced': [200, 100, 50, 50, 10],
+        'phone_bounced': [5, 30, 5, 20, 10],
+    })
+
+
+def test_composite_reward():
+    reward = CompositeReward({'ctr': 0.5, 'phone_conversion': 10.0, 'user_ctr': 0.0})
+    assert reward.columns == ['clicks', 'shows', 'phones', 'users']
+    batch = make_batch()
+    rewards, objective = reward.evaluate(
+        arms=np.array([0, 1, 0, 1, 2]),
+        columns={column: batch[column].values for column in reward.columns},
+        n_arms=4,
+    )
+    assert np.allclose(rewards['ctr'][:2], [0.04, 0.02])
+    assert np.allclose(rewards['phone_conversion'][:2], [0.001, 0.006])
+    assert np.allclose(rewards['user_ctr'][:2], [0.2, 0.1])
+    assert np.allclose(objective[:2], [0.5 * 0.04 + 0.01, 0.5 * 0.02 + 0.06])
+    # never shown arm
+    assert objective[3] == 0.0
+
+    with pytest.raises(UnknownReward):
+        CompositeReward({'revenue': 1.0})
+
+
+def test_bandit_reward():
+    def make_bandit(reward):
+        models = [Model('desktop', mv, ClickThroughRate(smooth=0), mv) for mv in ['1', '2']]
+        bandit = UCBBandit('desktop', models, 0.05, reward=reward)
+        bandit.evaluate_batch(make_batch())
+        bandit.recalc_models_weights()
+        return bandit
+
+    ctr_bandit = make_bandit(None)
+    weights = ctr_bandit.get_models_weights()
+    assert weights['1'] > weights['2']
+
+    phones_bandit = make_bandit(CompositeReward({'phone_conversion': 1.0}))
+    weights = phones_bandit.get_models_weights()
+    assert weights['2'] > weights['1']
+    assert np.isclose(phones_bandit.models['2'].metric.value, 0.006)
+    assert np.allclose(phones_bandit.rewards['phone_conversion'], [0.001, 0.006])
+    # events_cnt is the same whatever the reward
+    assert phones_bandit.engine.events_cnt[0] == ctr_bandit.engine.events_cnt[0] == 20000
+
+
+def test_rewards_from_models_config():
+    config = {
+        'config_version': 3,
+        'desktop': {'1': {}, '2': {}},
+        'mobile': {'1': {}, '2': {}},
+        'rewards': {'desktop': {'phone_conversion': 1.0}},
+    }
+    assert config_page_types(config) == ['desktop', 'mobile']
+    assert CompositeReward.from_config(config, 'mobile') is None
+
+    updater = BanditUpdater(weights_storage=None, batch=make_batch(), really_update_es=False)
+    updater.init_bandits(config)
+    results = updater.update_bandits(config)
+    assert results['desktop']['2'] > results['desktop']['1']
+
+
+def test_reward_on_every_path():
+    def make_bandit(cls=UCBBandit):
+        models = [Model('desktop', mv, ClickThroughRate(smooth=0), mv) for mv in ['1', '2']]
+        return cls('desktop', models, 0.05, reward=CompositeReward({'phone_conversion': 1.0}))
+
+    batch = make_batch()
+    expected = [0.001, 0.006]
+
+    records = make_bandit()
+    records.evaluate_records(batch.to_dict('records'))
+    assert np.allclose(records.engine.conversions(records.arms), expected)
+
+    # single shows: phoned_cnt is the phones of a show
+    single = make_bandit()
+    single.evaluate_records(
+        [{'page_type': 'desktop', 'model_version': '1', 'phoned_cnt': int(i < 1)} for i in range(100)] +
+        [{'page_type': 'desktop', 'model_version': '2', 'clicked_cnt': 1} for _ in range(100)]
+    )
+    assert np.allclose(single.engine.conversions(single.arms), [0.01, 0.0])
+
+    increment = make_bandit()
+    desktop = batch[batch['page_type'] == 'desktop']
+    increment.add_increment(
+        list(desktop['model_version']),
+        desktop['clicks'].values,
+        desktop['shows'].values,
+        columns={'phones': desktop['phones'].values},
+    )
+    assert np.allclose(increment.engine.conversions(increment.arms), expected)
+    with pytest.raises(MissingRewardColumn):
+        increment.add_increment(['1'], [1], [10])
+
+    discounted = make_bandit(DiscountedUCBBandit)
+    discounted.evaluate_batch(batch)
+    assert np.allclose(discounted.engine.conversions(discounted.arms), expected)
+    with pytest.raises(MissingRewardColumn):
+        discounted.evaluate_batch(batch[['page_type', 'model_version', 'clicks', 'shows']])
+    with pytest.raises(MissingRewardColumn):
+        discounted.evaluate_records([{'model_version': '1', 'clicks': 1, 'shows': 10}])
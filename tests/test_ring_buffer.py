@@ -0,0 +1,31 @@
+import numpy as np
+from scipy.stats import ttest_rel
+
+from cian_bandit.ring_buffer import ArmsRingBuffer
+
+
+def test_running_stats_match_window():
+    rng = np.random.default_rng(0)
+    buf = ArmsRingBuffer(capacity=7, n_arms=3)
+    rows = rng.random((30, 3))
+    for i, row in enumerate(rows):
+        buf.push(row)
+        window = rows[max(0, i - 6):i + 1]
+        assert np.allclose(buf.window(), window)
+        assert np.allclose(buf.mean(), window.mean(axis=0))
+        if len(window) >= 2:
+            pvalues = buf.paired_ttest(i % 3)
+            for arm in range(3):
+                if arm == i % 3:
+                    continue
+                expected = ttest_rel(window[:, i % 3], window[:, arm]).pvalue
+                assert np.isclose(pvalues[arm], expected)
+
+
+def test_arrays_roundtrip():
+    buf = ArmsRingBuffer(capacity=4, n_arms=2)
+    for i in range(6):
+        buf.push([i, 2 * i])
+    restored = ArmsRingBuffer.from_arrays(buf.to_arrays('x_'), 'x_')
+    assert np.allclose(restored.window(), buf.window())
+    assert np.allclose(restored.last(), [5, 10])
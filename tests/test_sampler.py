@@ -0,0 +1,79 @@
+import numpy as np
+import pytest
+
+from cian_bandit.sampler import AliasTable
+from cian_bandit.sampler import NoWeightsForPageType
+from cian_bandit.sampler import WeightSampler
+
+
+def make_config_doc(config_version, desktop_probs):
+    return {
+        '_source': {
+            'mobile': {},
+            'desktop': {
+                model_version: {'prob': prob, 'parameters': {}}
+                for model_version, prob in desktop_probs.items()
+            },
+            'updated': '2018-03-20 00:22:33',
+            'config_version': config_version,
+        }
+    }
+
+
+def test_alias_table_distribution():
+    weights = [0.1, 0.2, 0.3, 0.4, 0.0]
+    table = AliasTable(['a', 'b', 'c', 'd', 'e'], weights)
+    draws = table.sample(200000, rng=np.random.default_rng(0))
+    freqs = [np.mean(draws == mv) for mv in ['a', 'b', 'c', 'd', 'e']]
+    assert np.allclose(freqs, weights, atol=0.01)
+
+    single = [table.choice() for _ in range(20000)]
+    assert 'e' not in single
+    assert abs(single.count('d') / 20000. - 0.4) < 0.03
+
+
+def test_hot_swap():
+    sampler = WeightSampler(config_doc=make_config_doc(1, {'7': 1.0, '8': 0.0}))
+    assert set(sampler.sample('desktop', 1000)) == {'7'}
+    with pytest.raises(NoWeightsForPageType):
+        sampler.choice('mobile')
+
+    assert not sampler.load(make_config_doc(1, {'7': 0.0, '8': 1.0}))
+    assert sampler.choice('desktop') == '7'
+
+    assert sampler.load(make_config_doc(2, {'7': 0.0, '8': 1.0}))
+    assert sampler.config_version == 2
+    assert sampler.choice('desktop') == '8'
+
+
+def test_segmented_config_doc(monkeypatch):
+    from elasticsearch import helpers
+
+    from cian_bandit.weights_storage import WeightStorage
+    from es_fakes import FakeConflictingEs
+    from es_fakes import fake_bulk
+
+    monkeypatch.setattr(helpers, 'bulk', fake_bulk)
+    storage = WeightStorage(['localhost'])
+    storage.es_client = FakeConflictingEs(
+        source={
+            'mobile': {},
+            'desktop': {'1': {'prob': 0.5, 'parameters': {}}, '2': {'prob': 0.5, 'parameters': {}}},
+            'rewards': {'desktop': {'ctr': 1.0}},
+            'config_version': 3,
+        },
+        taken_versions=[],
+    )
+    page_type_config = {'1': {'parameters': {}}, '2': {'parameters': {}}}
+    for _ in range(2):
+        doc, _ = storage.publish_bulk({
+            'desktop:msk': (page_type_config, {'1': 0.3, '2': 0.7}, {'1': 0.01, '2': 0.02}),
+        }, segment_docs=True)
+
+    # the segments pointer is carried over to every later version
+    assert doc['config_version'] == 5 and 'segments' in doc
+    sampler = WeightSampler(config_doc=doc)
+    assert sampler.config_version == 5
+    assert sampler.choice('desktop') in {'1', '2'}
+    with pytest.raises(NoWeightsForPageType):
+        sampler.choice('segments')
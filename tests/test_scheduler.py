@@ -0,0 +1,78 @@
+import json
+import os
+import time
+
+import pytest
+
+from cian_bandit.scheduler import AlreadyRunning
+from cian_bandit.scheduler import ConfigWatcher
+from cian_bandit.scheduler import IntervalScheduler
+from cian_bandit.scheduler import ProcessLock
+
+
+def test_config_watcher(tmp_path):
+    path = str(tmp_path / 'models_config.json')
+    with open(path, 'w') as f:
+        json.dump({'desktop': {'9': {}}}, f)
+    watcher = ConfigWatcher(path)
+    first = watcher.get()
+    assert watcher.get() is first
+
+    with open(path, 'w') as f:
+        f.write('{"desktop": ')
+    os.utime(path, (time.time() + 10, time.time() + 10))
+    assert watcher.get() is first
+
+    with open(path, 'w') as f:
+        json.dump({'desktop': {'10': {}}}, f)
+    os.utime(path, (time.time() + 20, time.time() + 20))
+    assert watcher.get() == {'desktop': {'10': {}}}
+
+
+def test_process_lock(tmp_path):
+    path = str(tmp_path / 'update.lock')
+    with ProcessLock(path):
+        with pytest.raises(AlreadyRunning):
+            with ProcessLock(path):
+                pass
+    with ProcessLock(path):
+        pass
+
+
+class FakeClock(object):
+    def __init__(self):
+        self.now = 0.
+        self.waits = []
+
+    def __call__(self):
+        return self.now
+
+    def wait(self, seconds):
+        self.waits.append(seconds)
+        self.now += seconds
+
+
+def test_scheduler_skips_overlapping_ticks():
+    clock = FakeClock()
+    starts = []
+
+    def job():
+        starts.append(clock.now)
+        if len(starts) == 1:
+            clock.now += 0.25
+        if len(starts) == 3:
+            raise ValueError('failed update does not stop the daemon')
+
+    scheduler = IntervalScheduler(interval=0.1, clock=clock, wait=clock.wait)
+    scheduler.run(job, max_runs=4)
+    assert scheduler.runs == 4
+    assert scheduler.failures == 1
+    # first run took 2.5 intervals: next one waits for the 0.3 tick
+    assert starts == pytest.approx([0., 0.3, 0.4, 0.5])
+
+
+def test_scheduler_stop():
+    scheduler = IntervalScheduler(interval=60.)
+    # stop() during a run: no wait for the next tick
+    scheduler.run(scheduler.stop)
+    assert scheduler.runs == 1
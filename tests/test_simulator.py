@@ -0,0 +1,79 @@
+import numpy as np
+
+from cian_bandit.bandits import SimpleBandit
+from cian_bandit.bandits import ThompsonBandit
+from cian_bandit.bandits import UCBBandit
+from cian_bandit.simulator import TrafficSimulator
+from cian_bandit.simulator import benchmark
+
+
+def test_benchmark():
+    simulator = TrafficSimulator(
+        true_ctrs={'7': 0.02, '8': 0.025, '9': 0.03},
+        batch_size=20000,
+        seed=0,
+    )
+    factories = {
+        'simple': lambda page_type, models: SimpleBandit(page_type, models, 0.05),
+        'ucb': lambda page_type, models: UCBBandit(page_type, models, 0.05),
+        'thompson': lambda page_type, models: ThompsonBandit(page_type, models, 0.05, draws=2000, seed=0),
+    }
+    table = benchmark(factories, simulator, rounds=50).set_index('bandit')
+
+    assert list(table.index) == ['simple', 'ucb', 'thompson']
+    # uniform traffic would cost 0.005 per event
+    assert (table['regret_per_event'] < 0.005).all()
+    assert table.loc['thompson', 'regret'] < table.loc['simple', 'regret']
+    assert table['convergence_round'].notnull().all()
+
+
+def test_drift():
+    simulator = TrafficSimulator(
+        true_ctrs={'1': 0.05, '2': 0.02},
+        drift={'1': -0.0005},
+        batch_size=50000,
+        window_rounds=2,
+        seed=1,
+    )
+    bandit = UCBBandit(simulator.page_type, simulator.make_models(), 0.05)
+    result = simulator.run(bandit, rounds=100)
+    # arm 1 is better at first, arm 2 after round 60
+    assert result['weights'][10, 0] > result['weights'][10, 1]
+    assert result['weights'][-1, 0] < result['weights'][-1, 1]
+    assert result['convergence_round'] > 60
+    assert np.all(np.diff(result['cumulative_regret']) >= 0)
+
+
+def test_discounted_ucb_drift():
+    from cian_bandit.bandits import DiscountedUCBBandit
+
+    simulator = TrafficSimulator(
+        true_ctrs={'1': 0.05, '2': 0.02},
+        drift={'1': -0.0005},
+        batch_size=50000,
+        # new events only, recency comes from the bandit counters
+        window_rounds=1,
+        seed=1,
+    )
+    bandit = DiscountedUCBBandit(simulator.page_type, simulator.make_models(), 0.05, discount=0.5)
+    result = simulator.run(bandit, rounds=100)
+    assert result['weights'][10, 0] > result['weights'][10, 1]
+    assert result['weights'][-1, 0] < result['weights'][-1, 1]
+
+
+def test_from_logged_ctrs():
+    import pandas as pd
+
+    batch = pd.DataFrame({
+        'page_type': ['desktop', 'desktop', 'mobile'],
+        'model_version': ['7', '8', '1'],
+        'clicks': [100, 300, 5],
+        'shows': [10000, 10000, 10],
+    })
+    simulator = TrafficSimulator.from_logged_ctrs(batch, batch_size=20000, seed=0)
+    assert simulator.model_versions == ['7', '8']
+    assert np.allclose(simulator.true_ctrs, [0.01, 0.03])
+
+    bandit = UCBBandit(simulator.page_type, simulator.make_models(), 0.05)
+    result = simulator.run(bandit, rounds=20)
+    assert result['weights'][-1, 1] > result['weights'][-1, 0]
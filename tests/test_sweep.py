@@ -0,0 +1,34 @@
+from cian_bandit.sweep import grid
+from cian_bandit.sweep import random_search
+from cian_bandit.sweep import sweep
+
+
+SIMULATOR_KWARGS = {
+    'true_ctrs': {'7': 0.02, '8': 0.025, '9': 0.03},
+    'batch_size': 10000,
+}
+
+
+def test_grid_and_random_search():
+    configs = grid({'bandit': ['simple', 'ucb'], 'min_weight': [0.01, 0.05, 0.1]})
+    assert len(configs) == 6
+    assert configs[0] == {'bandit': 'simple', 'min_weight': 0.01}
+
+    configs = random_search({'smooth': (0, 5000), 'min_weight': (0.01, 0.1), 'bandit': ['ucb']}, n=5)
+    assert configs == random_search({'smooth': (0, 5000), 'min_weight': (0.01, 0.1), 'bandit': ['ucb']}, n=5)
+    assert all(isinstance(config['smooth'], int) for config in configs)
+    assert all(0.01 <= config['min_weight'] <= 0.1 for config in configs)
+
+
+def test_sweep_reproducible():
+    configs = grid({
+        'bandit': ['simple', 'ucb', 'thompson'],
+        'min_weight': [0.01, 0.1],
+        'last_events_cnt': [10000],
+    })
+    pooled = sweep(configs, SIMULATOR_KWARGS, rounds=10, processes=2, seed=42)
+    serial = sweep(configs, SIMULATOR_KWARGS, rounds=10, processes=1, seed=42)
+
+    assert len(pooled) == 6
+    assert list(pooled['regret']) == list(serial['regret'])
+    assert pooled['regret'].is_monotonic_increasing
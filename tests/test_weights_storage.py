@@ -15,6 +15,8 @@ from cian_bandit.bandits import SimpleBandit
 from cian_bandit.bandits import ZeroConversion
 from cian_bandit.metrics import ClickThroughRate
 from cian_bandit.models import Model
+from es_fakes import FakeConflictingEs
+from es_fakes import fake_bulk
 
 EVENTS_PER_MODEL = 100000
 
@@ -93,3 +95,150 @@ def test_writing_config(set_previous_config):
         got_weight = new_conf['_source']['weights']['desktop'][model_version]
         assert weight == got_weight, 'wrote wrong weight'
 
+
+
+def test_writing_config_conflict():
+    model = Model(page_type='desktop', model_version='1', metric=ClickThroughRate(), name='1')
+    model.weight = 1.0
+    storage = WeightStorage(['localhost'])
+    storage.es_client = FakeConflictingEs(
+        source={'mobile': {}, 'desktop': {'1': {'prob': 0.5}}, 'config_version': 3},
+        taken_versions=[4, 5],
+    )
+
+    doc = storage.update_page_type_models_weights(
+        page_type='desktop',
+        models={'1': model},
+        page_type_config={'1': {'parameters': {}}},
+    )
+    assert storage.es_client.created == ['6']
+    assert doc['config_version'] == 6
+    assert doc['desktop']['1']['prob'] == 1.0
+
+
+def test_config_cache():
+    now = [0.]
+    storage = WeightStorage(['localhost'], cache_ttl=10., clock=lambda: now[0])
+    storage.es_client = FakeConflictingEs(
+        source={'mobile': {}, 'desktop': {'1': {'prob': 0.5}}, 'config_version': 3},
+        taken_versions=[],
+    )
+    for _ in range(5):
+        assert storage.get_last_config_doc()['_source']['config_version'] == 3
+    assert storage.es_client.searches == 1
+    assert storage.cache_stats() == {'hits': 4, 'misses': 1}
+
+    model = Model(page_type='desktop', model_version='1', metric=ClickThroughRate(), name='1')
+    model.weight = 1.0
+    storage.update_page_type_models_weights(
+        page_type='desktop',
+        models={'1': model},
+        page_type_config={'1': {'parameters': {}}},
+    )
+    # own write is visible at once, without es search
+    assert storage.get_last_config_doc()['_source']['config_version'] == 4
+    assert storage.es_client.searches == 1
+
+    # lagging search never rolls the cached version back
+    now[0] = 11.
+    assert storage.get_last_config_doc()['_source']['config_version'] == 4
+    assert storage.es_client.searches == 2
+    assert storage.get_last_config_doc(max_age=0)['_source']['config_version'] == 4
+    assert storage.es_client.searches == 3
+
+
+def test_writing_segments(monkeypatch):
+    from cian_bandit.weights_storage import SEGMENTS_INDEX
+    from elasticsearch import helpers
+
+    monkeypatch.setattr(helpers, 'bulk', fake_bulk)
+    storage = WeightStorage(['localhost'])
+    storage.es_client = FakeConflictingEs(
+        source={'mobile': {}, 'desktop': {'1': {'prob': 0.5}}, 'config_version': 3},
+        taken_versions=[],
+    )
+    page_type_config = {'1': {'parameters': {}}, '2': {'parameters': {}}}
+    doc, errors = storage.publish_bulk({
+        'desktop:msk': (page_type_config, {'1': 0.3, '2': 0.7}, {'1': 0.01, '2': None}),
+        'desktop:spb': (page_type_config, {'1': 0.6, '2': 0.4}, {'1': 0.02, '2': 0.01}),
+    }, segment_docs=True)
+    assert storage.es_client.created == ['4']
+    assert doc['desktop'] == {'1': {'prob': 0.5}}
+    # segments are not fields of the config doc
+    assert 'desktop:msk' not in doc
+    pointer = doc['segments']
+    assert pointer['index'] == SEGMENTS_INDEX
+    assert pointer['keys'] == ['desktop:msk', 'desktop:spb']
+
+    segments = storage.es_client.segments
+    msk = segments['{0}:desktop:msk'.format(pointer['run_id'])]
+    assert msk['models']['2'] == {'parameters': {}, 'prob': 0.7, 'conversion': 10e-6}
+    assert segments['{0}:desktop:spb'.format(pointer['run_id'])]['models']['1']['prob'] == 0.6
+    assert 'prob' not in page_type_config['1']
+    assert len(storage.es_client.history) == 4
+
+
+def test_publish_bulk(monkeypatch):
+    from elasticsearch import helpers
+
+    monkeypatch.setattr(helpers, 'bulk', fake_bulk)
+    storage = WeightStorage(['localhost'])
+    storage.es_client = FakeConflictingEs(
+        source={'mobile': {}, 'desktop': {'1': {'prob': 0.5}}, 'config_version': 3},
+        taken_versions=[4],
+    )
+    page_type_config = {'1': {'parameters': {}}, '2': {'parameters': {}}}
+    doc, errors = storage.publish_bulk(
+        {
+            'desktop:msk': (page_type_config, {'1': 0.3, '2': 0.7}, {'1': 0.01, '2': 0.02}),
+            'desktop:spb': (page_type_config, {'1': 0.6, '2': 0.4}, {'1': 0.02, '2': 0.01}),
+        },
+        stats={
+            'desktop:msk': {'1': {'clicks': 10, 'shows': 1000}, '2': {'fail': True}},
+        },
+    )
+    # conflict on version 4: the whole bulk is rebuilt on top of it
+    assert storage.es_client.bulks == 2
+    assert storage.es_client.created == ['5']
+    assert doc['desktop:msk']['2']['prob'] == 0.7
+    assert storage.get_last_config_doc()['_source']['config_version'] == 5
+
+    # history ids do not depend on config_version: records of the lost attempt are overwritten
+    history = storage.es_client.history
+    assert len(history) == 3
+    assert all(record['config_version'] == 5 for record in history.values())
+    msk_1 = [r for r in history.values() if r['segment'] == 'desktop:msk' and r['model_version'] == '1']
+    assert msk_1[0]['clicks'] == 10 and msk_1[0]['prob'] == 0.3
+
+    assert len(errors) == 1
+    assert errors[0]['index']['status'] == 400
+
+
+def test_publish_bulk_exhausted_retries(monkeypatch):
+    from cian_bandit.weights_storage import NotUpdatedConfig
+    from elasticsearch import helpers
+
+    monkeypatch.setattr(helpers, 'bulk', fake_bulk)
+    storage = WeightStorage(['localhost'])
+    storage.es_client = FakeConflictingEs(
+        source={'mobile': {}, 'desktop': {'1': {'prob': 0.5}}, 'config_version': 3},
+        taken_versions=[4, 5, 6],
+    )
+    page_type_config = {'1': {'parameters': {}}}
+    with pytest.raises(NotUpdatedConfig):
+        storage.publish_bulk(
+            {'desktop:msk': (page_type_config, {'1': 1.0}, {'1': 0.01})},
+            max_retries=2,
+        )
+    assert storage.es_client.bulks == 3
+    # no history of weights that were never served
+    assert storage.es_client.history == {}
+
+    storage.es_client.segments = {}
+    with pytest.raises(NotUpdatedConfig):
+        storage.publish_bulk(
+            {'desktop:msk': (page_type_config, {'1': 1.0}, {'1': 0.01})},
+            max_retries=0,
+            segment_docs=True,
+        )
+    assert storage.es_client.history == {} and storage.es_client.segments == {}